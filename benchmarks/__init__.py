@@ -0,0 +1,9 @@
+#
+# For the license of this file, please consult the LICENSE file in the
+# root directory of this distribution.
+#
+
+# All modules in the benchmark suite.  Each module provides bench_*
+# functions, which take the options of run_benchmarks.py and return a
+# dictionary of results.
+__all__ = ( "core_benchmarks", "story_benchmarks" )
@@ -0,0 +1,121 @@
+#
+# Micro-benchmarks of the interpreter's hot paths.
+#
+# For the license of this file, please consult the LICENSE file in the
+# root directory of this distribution.
+#
+from timeit import default_timer
+
+from zvm import zmemory, zstackmanager, zopdecoder, zstring
+from zvm import zobjectparser, zlexer, zmachine, quetzal, headlesszui
+
+def load_story():
+    # We use Graham Nelson's 'curses' game for our benchmarks.
+    with open("stories/curses.z5", "rb") as story:
+        return story.read()
+
+def time_calls(func, args_list, repeat):
+    """Call FUNC with each tuple of arguments in ARGS_LIST, REPEAT
+    times over, and return the timings as a dictionary."""
+    start = default_timer()
+    for i in range(repeat):
+        for args in args_list:
+            func(*args)
+    seconds = default_timer() - start
+    calls = repeat * len(args_list)
+    return {
+        "calls": calls,
+        "seconds": seconds,
+        "calls_per_second": calls / seconds if seconds else None,
+        }
+
+def bench_opdecoder(options):
+    """Decode every instruction of the story's entry routine, both
+    through the instruction cache and from scratch."""
+    mem = zmemory.ZMemory(load_story())
+    decoder = zopdecoder.ZOpDecoder(mem, zstackmanager.ZStackManager(mem))
+    # Collect the addresses of the first instructions laid out after
+    # the story's entry point which only read constants and globals,
+    # as there is no stack to read the others from.
+    addresses = []
+    pc = decoder.program_counter
+    while len(addresses) < 100:
+        instruction = decoder._decode_instruction(pc)
+        if all(kind in (zopdecoder.OPERAND_CONSTANT,
+                        zopdecoder.OPERAND_GLOBAL)
+               for kind, value in instruction[2]):
+            addresses.append(pc)
+        pc = instruction[-1]
+
+    def get_next_instruction(pc):
+        decoder.program_counter = pc
+        decoder.get_next_instruction()
+
+    args_list = [(pc,) for pc in addresses]
+    return {
+        "get_next_instruction":
+            time_calls(get_next_instruction, args_list, options.repeat * 100),
+        "decode_uncached":
+            time_calls(decoder._decode_instruction, args_list,
+                       options.repeat * 10),
+        }
+
+def bench_stringfactory(options):
+    """Decode the first words of the story's dictionary."""
+    mem = zmemory.ZMemory(load_story())
+    lexer = zlexer.ZLexer(mem)
+    # Stay within the default size of the string cache.
+    args_list = [(addr,) for addr in sorted(lexer._dict.values())[:500]]
+    cached = zstring.ZStringFactory(mem)
+    uncached = zstring.ZStringFactory(mem, cache_size=0)
+    return {
+        "get_cached": time_calls(cached.get, args_list, options.repeat * 10),
+        "get_uncached": time_calls(uncached.get, args_list, options.repeat),
+        }
+
+def bench_objectparser(options):
+    """Look up a spread of properties on the first objects."""
+    mem = zmemory.ZMemory(load_story())
+    objects = zobjectparser.ZObjectParser(mem)
+    args_list = [(objectnum, propnum)
+                 for objectnum in range(1, 101)
+                 for propnum in (1, 2, 5, 10, 20, 40)]
+    return {
+        "get_prop_addr_len":
+            time_calls(objects.get_prop_addr_len, args_list,
+                       options.repeat * 10),
+        }
+
+def bench_lexer(options):
+    """Tokenise and look up typical player commands."""
+    lexer = zlexer.ZLexer(zmemory.ZMemory(load_story()))
+    args_list = [("look",),
+                 ("take the lamp and go north",),
+                 ("put the brass key in the box, then open the door",),
+                 ("x sundial",)]
+    return {
+        "parse_input":
+            time_calls(lexer.parse_input, args_list, options.repeat * 100),
+        }
+
+def _read_chunk(data, chunk_id):
+    """Return the payload of the first chunk CHUNK_ID of the IFF form in
+    DATA."""
+    offset = 12
+    while offset < len(data):
+        size = int.from_bytes(data[offset + 4:offset + 8], "big")
+        if data[offset:offset + 4] == chunk_id:
+            return data[offset + 8:offset + 8 + size]
+        offset += 8 + size + (size & 1)
+    raise KeyError(chunk_id)
+
+def bench_quetzal_cmem(options):
+    """Decompress the dynamic memory image of a Quetzal save file."""
+    machine = zmachine.ZMachine(load_story(), headlesszui.create_zui([]))
+    with open("stories/curses.save1", "rb") as savefile:
+        cmem = _read_chunk(savefile.read(), b"CMem")
+    parser = quetzal.QuetzalParser(machine)
+    return {
+        "parse_cmem": time_calls(parser._parse_cmem, [(cmem,)],
+                                 options.repeat * 10),
+        }
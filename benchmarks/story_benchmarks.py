@@ -0,0 +1,109 @@
+#
+# Macro-benchmarks which run a whole story, headless, through a
+# scripted input stream.
+#
+# For the license of this file, please consult the LICENSE file in the
+# root directory of this distribution.
+#
+import random
+import tracemalloc
+from timeit import default_timer
+
+from zvm import headlesszui, zmachine, zopdecoder
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows.
+    resource = None
+
+# The commands typed into the story, one per turn.
+DEFAULT_SCRIPT = ["look", "inventory", "north", "south", "take all",
+                  "examine sundial", "open door", "wait"]
+
+
+def run_story(options, instrument=None):
+    """Play OPTIONS.turns turns of curses from the start, and return a
+    dictionary describing the run. INSTRUMENT, if given, is called
+    with the CPU before it starts."""
+    with open("stories/curses.z5", "rb") as story:
+        story_image = story.read()
+    script = (DEFAULT_SCRIPT * options.turns)[:options.turns]
+    ui = headlesszui.create_zui(script)
+    machine = zmachine.ZMachine(story_image, ui)
+    cpu = machine._cpu
+    if instrument is not None:
+        instrument(cpu)
+
+    # The story's random numbers must not vary between runs.
+    random.seed(0)
+    stopped_by = "quit"
+    start = default_timer()
+    try:
+        machine.run()
+    except headlesszui.HeadlessInputExhausted:
+        stopped_by = "end of script"
+    except Exception as e:
+        # The interpreter is not complete yet; record how far the
+        # story got.
+        stopped_by = "%s: %s" % (e.__class__.__name__, e)
+    seconds = default_timer() - start
+
+    return {
+        "instructions": cpu.instruction_count,
+        "seconds": seconds,
+        "turns": ui.keyboard_input.turns,
+        "characters_written": len(ui.screen.get_output()),
+        "stopped_by": stopped_by,
+        }
+
+def _instrument_opcode_classes(cpu, timings):
+    """Wrap every handler of CPU's dispatch table so as to accumulate
+    [calls, seconds] per opcode class into TIMINGS."""
+    def timed(func, stats):
+        def timed_handler(*operands):
+            start = default_timer()
+            try:
+                return func(*operands)
+            finally:
+                stats[0] += 1
+                stats[1] += default_timer() - start
+        return timed_handler
+
+    for index, handler in enumerate(cpu._dispatch):
+        if handler is None:
+            continue
+        implemented, func = handler
+        opcode_class = zopdecoder.OPCODE_STRINGS[
+            min(index >> 5, zopdecoder.OPCODE_EXT)]
+        stats = timings.setdefault(opcode_class, [0, 0.0])
+        cpu._dispatch[index] = (implemented, timed(func, stats))
+
+def bench_story(options):
+    """Play curses for a number of turns, and report the instruction
+    rate, the time spent in each opcode class, and peak memory."""
+    runs = [run_story(options) for i in range(options.repeat)]
+    instructions = sum(run["instructions"] for run in runs)
+    seconds = sum(run["seconds"] for run in runs)
+    result = dict(runs[-1])
+    result["runs"] = len(runs)
+    result["instructions_per_second"] = (instructions / seconds
+                                         if seconds else None)
+
+    timings = {}
+    run_story(options, lambda cpu: _instrument_opcode_classes(cpu, timings))
+    result["opcode_classes"] = dict(
+        (name, {"calls": calls, "seconds": seconds})
+        for name, (calls, seconds) in timings.items() if calls)
+
+    tracemalloc.start()
+    try:
+        run_story(options)
+        result["peak_traced_bytes"] = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    if resource is not None:
+        # Kilobytes on Linux, bytes on macOS.
+        result["max_rss"] = resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss
+    return result
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+#
+# Run the benchmark suite, and print its results as JSON so that they
+# can be compared across commits.
+#
+# For the license of this file, please consult the LICENSE file in the
+# root directory of this distribution.
+
+import argparse
+import importlib
+import json
+import platform
+import subprocess
+
+import benchmarks
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                       stderr=subprocess.DEVNULL
+                                       ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run the ZVM benchmarks and print the results as JSON.")
+    parser.add_argument("names", nargs="*",
+                        help="benchmarks to run, e.g. 'story' or "
+                        "'opdecoder' (default: all)")
+    parser.add_argument("--turns", type=int, default=20,
+                        help="turns of the story to play (default: 20)")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="repetitions of each benchmark (default: 3)")
+    parser.add_argument("--output", help="write the JSON to this file")
+    options = parser.parse_args()
+
+    results = {}
+    for module_name in benchmarks.__all__:
+        module = importlib.import_module("benchmarks.%s" % module_name)
+        for name in sorted(dir(module)):
+            if not name.startswith("bench_"):
+                continue
+            if options.names and name[len("bench_"):] not in options.names:
+                continue
+            results[name[len("bench_"):]] = getattr(module, name)(options)
+
+    report = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "turns": options.turns,
+        "repeat": options.repeat,
+        "benchmarks": results,
+        }
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+#
+# Replay scripts of commands through a story at full speed, without a
+# terminal, and report how long each run took.
+#
+# For the license of this file, please consult the LICENSE file in the
+# root directory of this distribution.
+
+import argparse
+import os.path
+import sys
+
+from zvm import zfarm
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Replay scripts of commands through a Z-Machine "
+        "story, one command per line, without a user interface.")
+    parser.add_argument("story", help="the story file")
+    parser.add_argument("scripts", nargs="+",
+                        help="files of commands to replay, one run each")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="number of worker processes to replay the "
+                        "scripts with (default: 1, 0 for one per CPU)")
+    parser.add_argument("--seed", type=int,
+                        help="seed the random number generator with this "
+                        "value before each run")
+    parser.add_argument("--transcripts",
+                        help="write the output of each run into this "
+                        "directory, named after its script")
+    parser.add_argument("--show-output", action="store_true",
+                        help="print the output of each run")
+    options = parser.parse_args()
+
+    if not os.path.isfile(options.story):
+        print("%s is not a file." % options.story)
+        sys.exit(1)
+
+    if options.transcripts:
+        os.makedirs(options.transcripts, exist_ok=True)
+
+    farm = zfarm.WalkthroughFarm(
+        processes=options.jobs or None, seed=options.seed,
+        keep_transcripts=bool(options.transcripts or options.show_output))
+    jobs = [(options.story, script) for script in options.scripts]
+
+    failures = 0
+    total_seconds = 0
+    for result in farm.run(jobs):
+        total_seconds += result.seconds
+        status = "ok"
+        if result.error is not None:
+            failures += 1
+            status = "stopped by %s" % result.error
+        print("%s: %d commands, %d instructions, %.3fs, %s, %s"
+              % (result.script, result.turns, result.instructions,
+                 result.seconds, result.transcript_hash, status))
+        sys.stdout.flush()
+
+        if options.show_output and result.transcript is not None:
+            print(result.transcript)
+        if options.transcripts and result.transcript is not None:
+            name = os.path.splitext(os.path.basename(result.script))[0]
+            path = os.path.join(options.transcripts, name + ".txt")
+            with open(path, "w") as f:
+                f.write(result.transcript)
+
+    print("%d runs, %d stopped by errors, %.3fs in total"
+          % (len(jobs), failures, total_seconds))
+    if failures:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
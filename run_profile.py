@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+#
+# Profile a story: replay a script of commands through it, and report
+# where the time goes, per opcode handler and per Z-routine.
+#
+# For the license of this file, please consult the LICENSE file in the
+# root directory of this distribution.
+
+import argparse
+import cProfile
+import os.path
+import random
+import sys
+
+from zvm import headlesszui, zfarm, zmachine, zprofiler
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Replay a script of commands through a Z-Machine "
+        "story, and report the time spent in each opcode handler and "
+        "each routine of the story.")
+    parser.add_argument("story", help="the story file")
+    parser.add_argument("script", nargs="?",
+                        help="file of commands to replay, one per line "
+                        "(default: none, run up to the first input)")
+    parser.add_argument("--debug-file",
+                        help="Inform debug information file (XML) naming "
+                        "the story's routines")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="seed for the random number generator "
+                        "(default: 0)")
+    parser.add_argument("--limit", type=int, default=30,
+                        help="number of entries in each table of the "
+                        "report (default: 30)")
+    parser.add_argument("--report",
+                        help="write the report to this file instead of "
+                        "printing it")
+    parser.add_argument("--collapsed",
+                        help="write the routine call stacks to this file, "
+                        "in the collapsed format read by flamegraph.pl")
+    parser.add_argument("--weight", default=zprofiler.WEIGHT_TIME,
+                        choices=[zprofiler.WEIGHT_TIME,
+                                 zprofiler.WEIGHT_INSTRUCTIONS],
+                        help="weigh the collapsed stacks by time in "
+                        "microseconds, or by instructions (default: time; "
+                        "samples when sampling)")
+    parser.add_argument("--sampling", action="store_true",
+                        help="sample the program counter and routines "
+                        "periodically instead of instrumenting every "
+                        "instruction, and report the histograms as JSON")
+    parser.add_argument("--sample-interval", type=float, default=0.005,
+                        help="seconds between samples (default: 0.005)")
+    parser.add_argument("--cprofile",
+                        help="also profile the interpreter itself, and "
+                        "write the Python profile to this file")
+    options = parser.parse_args()
+
+    if not os.path.isfile(options.story):
+        print("%s is not a file." % options.story)
+        sys.exit(1)
+    with open(options.story, "rb") as story_file:
+        story = story_file.read()
+    commands = []
+    if options.script:
+        commands = zfarm.read_script(options.script)
+
+    ui = headlesszui.create_zui(commands)
+    machine = zmachine.ZMachine(story, ui)
+    routine_names = None
+    if options.debug_file:
+        routine_names = zprofiler.load_routine_names(options.debug_file,
+                                                     machine._mem)
+    if options.sampling:
+        profiler = zprofiler.ZSamplingProfiler(options.sample_interval,
+                                               routine_names)
+        profiler.add(machine)
+    else:
+        profiler = zprofiler.ZProfiler(machine, routine_names)
+    python_profiler = None
+    if options.cprofile:
+        python_profiler = cProfile.Profile()
+
+    random.seed(options.seed)
+    stopped_by = "quit"
+    with profiler:
+        if python_profiler is not None:
+            python_profiler.enable()
+        try:
+            machine.run()
+        except headlesszui.HeadlessInputExhausted:
+            stopped_by = "end of script"
+        except Exception as e:
+            stopped_by = "%s: %s" % (e.__class__.__name__, e)
+        finally:
+            if python_profiler is not None:
+                python_profiler.disable()
+
+    report = sys.stdout
+    if options.report:
+        report = open(options.report, "w")
+    report.write("%d commands, stopped by %s\n\n"
+                 % (ui.keyboard_input.turns, stopped_by))
+    if options.sampling:
+        profiler.dump(report, options.limit)
+    else:
+        report.write(profiler.report(options.limit))
+    if report is not sys.stdout:
+        report.close()
+    if options.collapsed:
+        with open(options.collapsed, "w") as f:
+            if options.sampling:
+                profiler.histograms()["default"].write_collapsed(
+                    f, routine_names)
+            else:
+                profiler.write_collapsed(f, options.weight)
+    if python_profiler is not None:
+        python_profiler.dump_stats(options.cprofile)
+
+if __name__ == '__main__':
+    main()
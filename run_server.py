@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+#
+# Serve sessions of a story to clients on a local Unix socket, many
+# sessions per process.  See zvm/zserver.py for the protocol.
+#
+# For the license of this file, please consult the LICENSE file in the
+# root directory of this distribution.
+
+import argparse
+import asyncio
+import os.path
+import sys
+
+from zvm import zprofiler, zserver
+
+async def serve(story, options):
+    sampler = None
+    if options.samples:
+        sampler = zprofiler.ZSamplingProfiler(options.sample_interval)
+        sampler.install_signal_handler(options.samples)
+        sampler.start()
+    server = zserver.ZSessionServer(
+        story, max_sessions=options.max_sessions,
+        max_turns=options.max_turns,
+        max_instructions=options.max_instructions,
+        idle_timeout=options.idle_timeout,
+        time_slice=options.time_slice,
+        turn_instructions=options.turn_instructions,
+        turn_seconds=options.turn_seconds,
+        max_overruns=options.max_overruns,
+        sampler=sampler)
+    await server.start(options.socket)
+    print("Serving %s on %s" % (options.story, options.socket))
+    sys.stdout.flush()
+    try:
+        while True:
+            await asyncio.sleep(options.report_interval)
+            metrics = server.metrics()
+            print("%d active sessions, %d finished, %d rejected, "
+                  "%d turns, %.1f instructions/turn, %.4fs mean turn, "
+                  "%.4fs max turn, %d budget overruns, "
+                  "%.0f%% peak budget usage"
+                  % (metrics["active_sessions"],
+                     metrics["finished_sessions"],
+                     metrics["rejected_sessions"], metrics["turns"],
+                     metrics["instructions_per_turn"],
+                     metrics["mean_turn_seconds"],
+                     metrics["max_turn_seconds"],
+                     metrics["budget_overruns"],
+                     metrics["peak_budget_usage"] * 100))
+            sys.stdout.flush()
+    finally:
+        await server.close()
+        if sampler is not None:
+            sampler.stop()
+            with open(options.samples, "w") as f:
+                sampler.dump(f)
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Serve sessions of a Z-Machine story on a Unix "
+        "socket, one session per connection.")
+    parser.add_argument("story", help="the story file")
+    parser.add_argument("socket", help="the path of the socket to create")
+    parser.add_argument("--max-sessions", type=int, default=1000,
+                        help="number of concurrent sessions to accept "
+                        "(default: 1000)")
+    parser.add_argument("--max-turns", type=int,
+                        help="end sessions after this many commands")
+    parser.add_argument("--max-instructions", type=int,
+                        help="end sessions after this many instructions")
+    parser.add_argument("--idle-timeout", type=float,
+                        help="close sessions which send no command for "
+                        "this many seconds")
+    parser.add_argument("--time-slice", type=int,
+                        default=zserver.DEFAULT_TIME_SLICE,
+                        help="instructions a session runs before letting "
+                        "the others run (default: %d)"
+                        % zserver.DEFAULT_TIME_SLICE)
+    parser.add_argument("--turn-instructions", type=int,
+                        help="budget of instructions for each turn")
+    parser.add_argument("--turn-seconds", type=float,
+                        help="budget of seconds of execution for each turn")
+    parser.add_argument("--max-overruns", type=int, default=3,
+                        help="end sessions whose turn runs over budget "
+                        "more than this many times (default: 3)")
+    parser.add_argument("--samples",
+                        help="sample the sessions' program counters and "
+                        "routines, and write the histograms to this file "
+                        "on SIGUSR1 and on exit")
+    parser.add_argument("--sample-interval", type=float, default=0.005,
+                        help="seconds between samples (default: 0.005)")
+    parser.add_argument("--report-interval", type=float, default=60,
+                        help="seconds between metrics reports "
+                        "(default: 60)")
+    options = parser.parse_args()
+
+    if not os.path.isfile(options.story):
+        print("%s is not a file." % options.story)
+        sys.exit(1)
+    with open(options.story, "rb") as story_file:
+        story = story_file.read()
+
+    try:
+        asyncio.run(serve(story, options))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
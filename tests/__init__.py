@@ -5,4 +5,9 @@
 
 # All tests in the test suite.
 __all__ = ( "bitfield_tests", "zscii_tests", "lexer_tests",
-            "quetzal_tests", "glk_tests" )
+            "quetzal_tests", "glk_tests", "zopdecoder_tests", "zlogging_tests",
+            "ztables_tests", "zmemory_tests", "zstringindex_tests",
+            "headlesszui_tests", "zfarm_tests", "zsession_tests", "zcpu_tests",
+            "zprofiler_tests",
+            "zserver_tests", "zstackmanager_tests",
+            "zobjectparser_tests", "zundo_tests" )
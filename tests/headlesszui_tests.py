@@ -0,0 +1,32 @@
+#
+# Unit tests for the headless user interface.
+#
+# For the license of this file, please consult the LICENSE file in the
+# root directory of this distribution.
+#
+from unittest import TestCase
+from zvm import zmachine, headlesszui
+
+def make_zmachine(commands):
+    # We use Graham Nelson's 'curses' game for our unittests.
+    with open("stories/curses.z5", "rb") as story:
+      story_image = story.read()
+    ui = headlesszui.create_zui(commands)
+    return zmachine.ZMachine(story_image, ui), ui
+
+class HeadlessZUITests(TestCase):
+    def testOutputIsCaptured(self):
+        machine, ui = make_zmachine([])
+        # Curses waits for a key before anything else.
+        self.assertRaises(headlesszui.HeadlessInputExhausted, machine.run)
+        assert "Welcome to CURSES" in ui.screen.get_output()
+        self.assertEqual(ui.keyboard_input.turns, 0)
+
+    def testScriptedInput(self):
+        screen = headlesszui.HeadlessScreen()
+        keyboard = headlesszui.ScriptedInputStream(screen, ["look", ""])
+        self.assertEqual(keyboard.read_line(max_length=2), "lo")
+        self.assertEqual(keyboard.read_char(), 13)
+        self.assertRaises(headlesszui.HeadlessInputExhausted,
+                          keyboard.read_char)
+        self.assertEqual(screen.get_output(), "lo\n")
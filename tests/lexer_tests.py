@@ -46,3 +46,12 @@ class ZLexerTests(TestCase):
                        ['bird', 30576], ['are', 0], ['odd', 36525], \
                        ['and', 29874], ['round', 38361], [',', 0], \
                        ['no', 36300]]
+
+  def testTokeniseInput(self):
+    lexer = ZLexer(self.mem)
+    self.assertEqual(lexer.tokenise_input("the fish,  house"),
+                     [('the', 40278, 0), ('fish', 33150, 4), (',', 0, 8),
+                      ('house', 34572, 11)])
+    # Only the first 9 letters of a word are looked up.
+    self.assertEqual(lexer.tokenise_input("adamantine"),
+                     [('adamantine', 29667, 0)])
@@ -40,3 +40,37 @@ class QuetzalParserTest(TestCase):
       b'IFhd': 13,
     }
     self.assertEqual(savefile_metadata, expected_metadata)
+
+  def testLoadIntoSameStacks(self):
+    machine = make_zmachine()
+    stackmanager = machine._stackmanager
+    parser = quetzal.QuetzalParser(machine)
+    parser.load("stories/curses.save1")
+    # The CPU and the decoder keep using the machine's stacks.
+    self.assertIs(machine._stackmanager, stackmanager)
+    self.assertEqual(len(stackmanager.get_frames()), 4)
+    # The innermost routine was called through the stack, so it can't
+    # be told.
+    self.assertEqual(stackmanager.get_routine_addresses(),
+                     (0xd338, 0xd6e4, 0))
+
+  def _find_routine_addr(self, code, num_locals):
+    # Put CODE in dynamic memory, after some zeros, and find the
+    # routine called by a frame returning to the end of it.
+    machine = make_zmachine()
+    addr = 0x1000
+    machine._mem[addr - 20:addr] = bytes(20)
+    machine._mem[addr:addr + len(code)] = code
+    parser = quetzal.QuetzalParser(machine)
+    return parser._find_routine_addr(addr + len(code), num_locals)
+
+  def testFindRoutineCalledThroughVariable(self):
+    # call_vs G00 -> sp
+    self.assertEqual(self._find_routine_addr(b'\xe0\xbf\x10\x00', 3), 0)
+
+  def testFindRoutineAfterShorterDecode(self):
+    # call_vs 0x8f1d -> sp, a routine with 7 locals.  Its last three
+    # bytes also decode as call_1n 0x1d00, whose header doesn't have 7
+    # locals.
+    self.assertEqual(self._find_routine_addr(b'\xe0\x3f\x8f\x1d\x00', 7),
+                     0x8f1d * 4)
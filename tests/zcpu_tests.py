@@ -0,0 +1,213 @@
+#
+# Unit tests for the ZCpu class.
+#
+# For the license of this file, please consult the LICENSE file in the
+# root directory of this distribution.
+#
+import os
+import random
+import shutil
+import tempfile
+from unittest import TestCase
+from zvm import headlesszui, zcpu, zlogging, zmachine
+
+def make_zmachine(commands=(), debugmode=False, log_dir=None):
+    with open("stories/curses.z5", "rb") as f:
+        story = f.read()
+    kwargs = {}
+    if log_dir is not None:
+        kwargs = {"debug_log": os.path.join(log_dir, "debug.log"),
+                  "disasm_log": os.path.join(log_dir, "disasm.log")}
+    return zmachine.ZMachine(story, headlesszui.create_zui(commands),
+                             debugmode=debugmode, **kwargs)
+
+class ZCpuStepTests(TestCase):
+    def testBudget(self):
+        machine = make_zmachine()
+        result = machine.step(100)
+        self.assertEqual(result, (zcpu.STEP_RUNNING, 100))
+        self.assertEqual(machine._cpu.instruction_count, 100)
+
+    def testNeedsInput(self):
+        log_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, log_dir)
+        self.addCleanup(zlogging.set_debug, False)
+        for debugmode in (False, True):
+            machine = make_zmachine(debugmode=debugmode, log_dir=log_dir)
+            result = machine.step()
+            self.assertEqual(result.status, zcpu.STEP_NEEDS_CHAR)
+            # The keyboard was never asked.
+            self.assertEqual(machine._ui.keyboard_input.turns, 0)
+            # Without input, nothing runs.
+            self.assertEqual(machine.step(), (zcpu.STEP_NEEDS_CHAR, 0))
+            count = machine._cpu.instruction_count
+            self.assertRaises(zcpu.ZCpuNotImplemented, machine.step,
+                              None, 32)
+            assert machine._cpu.instruction_count > count
+        assert os.path.getsize(os.path.join(log_dir, "disasm.log")) > 0
+
+    def testDebugLogsStayOpen(self):
+        log_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, log_dir)
+        self.addCleanup(zlogging.set_debug, False)
+        debugged = make_zmachine(debugmode=True, log_dir=log_dir)
+        # Another machine, not in debug mode, doesn't close its logs.
+        make_zmachine()
+        debugged.step(10)
+        self.assertNotEqual(zlogging.disasm.handlers, [])
+        assert os.path.getsize(os.path.join(log_dir, "disasm.log")) > 0
+
+    def testSameAsRun(self):
+        random.seed(1)
+        stepped = make_zmachine()
+        stepped.step()
+        self.assertRaises(zcpu.ZCpuNotImplemented, stepped.step, None, 32)
+        random.seed(1)
+        ran = make_zmachine([" "])
+        self.assertRaises(zcpu.ZCpuNotImplemented, ran.run)
+        self.assertEqual(stepped._ui.screen.get_output(),
+                         ran._ui.screen.get_output())
+
+    def testInputNotRequested(self):
+        machine = make_zmachine()
+        self.assertRaises(zcpu.ZCpuNoInputRequested, machine.step, 10, "x")
+
+    def testQuit(self):
+        machine = make_zmachine()
+        # Point the program counter at a quit instruction in dynamic
+        # memory.
+        machine._mem[0x40] = 0xBA
+        machine._opdecoder.program_counter = 0x40
+        self.assertEqual(machine.step(), (zcpu.STEP_QUIT, 1))
+        self.assertEqual(machine.step(), (zcpu.STEP_QUIT, 0))
+        self.assertEqual(machine.run(), None)
+
+class ZCpuBudgetTests(TestCase):
+    def setUp(self):
+        # How much curses runs before its first input depends on the
+        # random numbers it draws; with this seed, it asks within 1000
+        # instructions.
+        random.seed(0)
+
+    def testInstructionBudget(self):
+        machine = make_zmachine()
+        cpu = machine._cpu
+        machine.set_turn_budget(instructions=500)
+        self.assertEqual(machine.step(), (zcpu.STEP_OVER_BUDGET, 500))
+        self.assertEqual(cpu.turn_instructions, 500)
+        self.assertEqual(cpu.budget_usage(), 1.0)
+        self.assertEqual(cpu.budget_overruns, 1)
+        # Resuming starts a new budget window for the same turn.
+        result = machine.step()
+        self.assertEqual(result.status, zcpu.STEP_NEEDS_CHAR)
+        assert result.instructions < 500
+        self.assertEqual(cpu.turn_instructions, 500 + result.instructions)
+        self.assertEqual(cpu.peak_budget_usage, 1.0)
+
+    def testBudgetWithinStep(self):
+        machine = make_zmachine()
+        machine.set_turn_budget(instructions=500)
+        self.assertEqual(machine.step(300), (zcpu.STEP_RUNNING, 300))
+        self.assertEqual(machine.step(300), (zcpu.STEP_OVER_BUDGET, 200))
+
+    def testTimeBudget(self):
+        # This seed runs past the first check of the clock.
+        random.seed(1)
+        machine = make_zmachine()
+        machine.set_turn_budget(seconds=1e-9)
+        self.assertEqual(machine.step(), (zcpu.STEP_OVER_BUDGET,
+                                          zcpu.BUDGET_CHECK_INTERVAL))
+        assert machine._cpu.budget_usage() > 1
+
+    def testRunOverBudget(self):
+        machine = make_zmachine([" "])
+        machine.set_turn_budget(instructions=500)
+        self.assertRaises(zcpu.ZCpuOverBudget, machine.run)
+        self.assertEqual(machine._cpu.instruction_count, 500)
+        # The turn ends at the request for input, so the next turn
+        # starts with a fresh budget.
+        self.assertRaises(zcpu.ZCpuNotImplemented, machine.run)
+        self.assertEqual(machine._cpu.budget_overruns, 1)
+
+class ZCpuObjectTests(TestCase):
+    # In curses, objects 2 to 13 are the children of object 1, in
+    # order.
+    def setUp(self):
+        # Without a mirror, the object opcodes read memory directly.
+        self.machine = make_zmachine()
+        self.cpu = self.machine._cpu
+        self.objects = self.machine._objectparser
+        self.decoder = self.machine._opdecoder
+
+    def _branches(self, opcode, *operands):
+        """Run OPCODE as if it had a branch if true to an offset of
+        100, and return whether it branched."""
+        self.decoder._branch = (True, 100)
+        pc = self.decoder.program_counter
+        opcode(*operands)
+        return self.decoder.program_counter == pc + 98
+
+    def _children(self, objectnum):
+        children = []
+        child = self.objects.get_child(objectnum)
+        while child != 0:
+            children.append(child)
+            child = self.objects.get_sibling(child)
+        return children
+
+    def testJin(self):
+        self.assertTrue(self._branches(self.cpu.op_jin, 5, 1))
+        self.assertFalse(self._branches(self.cpu.op_jin, 5, 2))
+
+    def testGetSibling(self):
+        self.decoder._store_address = 0x10
+        self.assertTrue(self._branches(self.cpu.op_get_sibling, 5))
+        self.assertEqual(self.machine._mem.read_global(0x10), 6)
+        self.assertFalse(self._branches(self.cpu.op_get_sibling, 13))
+        self.assertEqual(self.machine._mem.read_global(0x10), 0)
+
+    def testRemoveMiddleSibling(self):
+        self.cpu.op_remove_obj(7)
+        self.assertEqual(self._children(1),
+                         [2, 3, 4, 5, 6] + list(range(8, 14)))
+        self.assertEqual(self.objects.get_parent(7), 0)
+        self.assertEqual(self.objects.get_sibling(7), 0)
+        self.assertEqual(self.objects.get_sibling(6), 8)
+
+    def testInsertIntoSameParent(self):
+        self.cpu.op_insert_obj(7, 1)
+        self.assertEqual(self._children(1),
+                         [7, 2, 3, 4, 5, 6] + list(range(8, 14)))
+        self.assertEqual(self.objects.get_parent(7), 1)
+
+class ZCpuLineInputTests(TestCase):
+    def testAread(self):
+        machine = make_zmachine()
+        mem = machine._mem
+        # aread 0x1100 0x1200 -> sp; quit
+        code = bytes((0xE4, 0x0F, 0x11, 0x00, 0x12, 0x00, 0x00, 0xBA))
+        mem[0x1000:0x1000 + len(code)] = code
+        mem[0x1100] = 30
+        mem[0x1101] = 0
+        mem[0x1200] = 10
+        machine._opdecoder.program_counter = 0x1000
+        self.assertEqual(machine.step(), (zcpu.STEP_NEEDS_LINE, 0))
+        self.assertEqual(machine.step(None, "Look at the fish, house"),
+                         (zcpu.STEP_QUIT, 2))
+
+        text = "look at the fish, house"
+        self.assertEqual(mem[0x1101], len(text))
+        self.assertEqual(bytes(mem[0x1102:0x1102 + len(text)]),
+                         text.encode("ascii"))
+        # The words, with their dictionary addresses, lengths and
+        # positions in the text buffer.
+        words = machine._cpu._lexer.tokenise_input(text)
+        self.assertEqual(mem[0x1201], len(words))
+        for i, (word, dict_addr, position) in enumerate(words):
+            entry = 0x1202 + 4 * i
+            self.assertEqual((mem.read_word(entry), mem[entry + 2],
+                              mem[entry + 3]),
+                             (dict_addr, len(word), position + 2))
+        self.assertEqual(words[3], ("fish", 33150, 12))
+        # The terminating character is a carriage return.
+        self.assertEqual(machine._stackmanager.pop_stack(), 13)
@@ -0,0 +1,51 @@
+#
+# Unit tests for the walkthrough farm.
+#
+# For the license of this file, please consult the LICENSE file in the
+# root directory of this distribution.
+#
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from zvm import zfarm
+
+STORY = "stories/curses.z5"
+
+class WalkthroughFarmTests(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.scripts = []
+        for i in range(4):
+            path = os.path.join(self.tmpdir, "walkthrough%d.txt" % i)
+            with open(path, "w") as f:
+                f.write("look\n\ninventory\n")
+            self.scripts.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def testInProcess(self):
+        farm = zfarm.WalkthroughFarm(processes=1, seed=1,
+                                     keep_transcripts=True)
+        results = list(farm.run([(STORY, s) for s in self.scripts]))
+        self.assertEqual([r.script for r in results], self.scripts)
+        assert "Welcome to CURSES" in results[0].transcript
+        assert results[0].instructions > 0
+        self.assertEqual(len(set(r.transcript_hash for r in results)), 1)
+
+    def testWorkerProcesses(self):
+        jobs = [(STORY, s) for s in self.scripts]
+        serial = zfarm.WalkthroughFarm(processes=1, seed=1).run(jobs)
+        parallel = zfarm.WalkthroughFarm(processes=2, seed=1).run(jobs)
+        self.assertEqual(
+            sorted((r.script, r.transcript_hash, r.instructions)
+                   for r in serial),
+            sorted((r.script, r.transcript_hash, r.instructions)
+                   for r in parallel))
+
+    def testMissingScript(self):
+        farm = zfarm.WalkthroughFarm(processes=1)
+        result, = farm.run([(STORY, os.path.join(self.tmpdir, "missing"))])
+        assert result.error is not None
+        self.assertEqual(result.transcript_hash, None)
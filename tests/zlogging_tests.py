@@ -0,0 +1,36 @@
+#
+# Unit tests for the zlogging module.
+#
+# For the license of this file, please consult the LICENSE file in the
+# root directory of this distribution.
+#
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from zvm import zlogging
+
+class ZLoggingTests(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.mainlog_path = os.path.join(self.tmpdir, "main.log")
+        self.disasm_path = os.path.join(self.tmpdir, "disasm.log")
+
+    def tearDown(self):
+        zlogging.set_debug(False)
+        shutil.rmtree(self.tmpdir)
+
+    def testNoFilesUntilDebugging(self):
+        zlogging.set_debug(False)
+        zlogging.log("not written")
+        self.assertEqual(zlogging.mainlog.handlers, [])
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+    def testDebugWritesToGivenPaths(self):
+        zlogging.set_debug(True, self.mainlog_path, self.disasm_path)
+        zlogging.log("hello")
+        zlogging.log_disasm(0x1234, "2OP", 1, "op_je", "1, 2")
+        zlogging.set_debug(False)
+        self.assertEqual(zlogging.mainlog.handlers, [])
+        assert "hello" in open(self.mainlog_path).read()
+        assert "001234  2OP:01 op_je 1, 2" in open(self.disasm_path).read()
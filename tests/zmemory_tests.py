@@ -0,0 +1,148 @@
+#
+# Unit tests for the ZMemory class.
+#
+# For the license of this file, please consult the LICENSE file in the
+# root directory of this distribution.
+#
+from unittest import TestCase
+from zvm import zmemory
+
+def make_zmemory():
+    # We use Graham Nelson's 'curses' game for our unittests.
+    storydata = open("stories/curses.z5", "rb").read()
+    return zmemory.ZMemory(storydata)
+
+class ZMemoryTests(TestCase):
+    def testRawSharesMemory(self):
+        mem = make_zmemory()
+        mem[0x40] = 0x12
+        self.assertEqual(mem.raw[0x40], 0x12)
+        self.assertEqual(mem.raw[mem.static_start], mem[mem.static_start])
+
+    def testCheckRange(self):
+        mem = make_zmemory()
+        mem.check_range(0)
+        mem.check_range(mem.size - 2, 2)
+        self.assertRaises(zmemory.ZMemoryOutOfBounds,
+                          mem.check_range, -1)
+        self.assertRaises(zmemory.ZMemoryOutOfBounds,
+                          mem.check_range, mem.size - 1, 2)
+
+    def testWriteGlobal(self):
+        mem = make_zmemory()
+        mem.write_global(0x10, 0xABCD)
+        self.assertEqual(mem.read_global(0x10), 0xABCD)
+
+    def testCopy(self):
+        mem = make_zmemory()
+        mem_copy = mem.copy()
+        mem_copy[0x40] = mem[0x40] ^ 0xFF
+        self.assertNotEqual(mem[0x40], mem_copy[0x40])
+        self.assertEqual(mem_copy.raw[0x40], mem_copy[0x40])
+        self.assertEqual(mem_copy.static_start, mem.static_start)
+
+    def testCopySharingStatic(self):
+        mem = make_zmemory()
+        mem_copy = mem.copy(share_static=True)
+        static_start = mem.static_start
+        self.assertEqual(len(mem_copy.raw), static_start)
+        self.assertIs(mem_copy.static_raw, mem.raw)
+        self.assertEqual(mem_copy.generate_checksum(),
+                         mem.generate_checksum())
+        mem_copy[0x40] = mem[0x40] ^ 0xFF
+        self.assertNotEqual(mem[0x40], mem_copy[0x40])
+        # Reads across the start of static memory see both parts.
+        self.assertEqual(mem_copy[static_start - 1], mem[static_start - 1])
+        self.assertEqual(mem_copy[static_start], mem[static_start])
+        self.assertEqual(mem_copy.read_word(static_start - 1),
+                         mem.read_word(static_start - 1))
+        self.assertEqual(bytes(mem_copy[static_start - 2:static_start + 2]),
+                         bytes(mem[static_start - 2:static_start + 2]))
+        self.assertRaises(zmemory.ZMemoryIllegalWrite,
+                          mem_copy.__setitem__, static_start, 0)
+        # Writes running from dynamic into static memory are refused
+        # as a whole.
+        self.assertRaises(zmemory.ZMemoryIllegalWrite, mem_copy.__setitem__,
+                          slice(static_start - 2, static_start + 2), b'abcd')
+        self.assertRaises(zmemory.ZMemoryIllegalWrite,
+                          mem_copy.__setslice__, static_start - 2,
+                          static_start + 2, b'abcd')
+        self.assertRaises(zmemory.ZMemoryIllegalWrite,
+                          mem_copy.write_word, static_start - 1, 0)
+        self.assertRaises(zmemory.ZMemoryIllegalWrite,
+                          mem_copy.write_word, static_start, 0)
+        self.assertEqual(len(mem_copy.raw), static_start)
+
+class ZMemoryWatchTests(TestCase):
+    def setUp(self):
+        self.mem = make_zmemory()
+        self.writes = []
+        self.watch = self.mem.watch(0x1000, 0x1010, self._callback)
+
+    def _callback(self, address, length):
+        self.writes.append((address, length))
+
+    def testWritesInside(self):
+        self.mem[0x1000] = 1
+        self.mem.write_word(0x100f, 2)
+        self.mem[0x0ffe:0x1001] = b'abc'
+        self.assertEqual(self.writes,
+                         [(0x1000, 1), (0x100f, 2), (0x0ffe, 3)])
+        self.assertTrue(self.watch.dirty)
+
+    def testWritesOutside(self):
+        self.mem[0x0fff] = 1
+        self.mem[0x1010] = 1
+        self.mem.write_word(0x0ffe, 2)
+        self.mem.write_global(0x10, 3)
+        self.assertEqual(self.writes, [])
+        self.assertFalse(self.watch.dirty)
+
+    def testWriteGlobal(self):
+        globals_start = self.mem.read_word(0x0c)
+        watch = self.mem.watch(globals_start + 2, globals_start + 3)
+        self.mem.write_global(0x10, 1)
+        self.assertFalse(watch.dirty)
+        self.mem.write_global(0x11, 1)
+        self.assertTrue(watch.dirty)
+
+    def testUnwatch(self):
+        self.mem.unwatch(self.watch)
+        self.mem[0x1000] = 1
+        self.assertEqual(self.writes, [])
+        self.assertFalse(self.watch.dirty)
+
+    def testCopiesAreNotWatched(self):
+        mem_copy = self.mem.copy()
+        mem_copy[0x1000] = 1
+        self.assertEqual(self.writes, [])
+
+class ZMemoryDirtyPageTests(TestCase):
+    def setUp(self):
+        self.mem = make_zmemory()
+
+    def testStartsClean(self):
+        self.assertEqual(self.mem.get_dirty_pages(), [])
+
+    def testWritesMarkPages(self):
+        page = zmemory.PAGE_SIZE
+        self.mem[3 * page] = 1
+        # A word across a page boundary dirties both pages.
+        self.mem.write_word(6 * page - 1, 2)
+        self.mem[8 * page + 10:8 * page + 12] = b'ab'
+        self.mem.write_global(0x10, 3)
+        globals_page = self.mem.read_word(0x0c) // page
+        self.assertEqual(self.mem.get_dirty_pages(),
+                         sorted(set([3, 5, 6, 8, globals_page])))
+
+    def testClear(self):
+        self.mem[0x1000] = 1
+        self.mem.clear_dirty_pages()
+        self.assertEqual(self.mem.get_dirty_pages(), [])
+        self.mem[0x1000] = 2
+        self.assertEqual(self.mem.get_dirty_pages(),
+                         [0x1000 // zmemory.PAGE_SIZE])
+
+    def testCopiesStartClean(self):
+        self.mem[0x1000] = 1
+        self.assertEqual(self.mem.copy().get_dirty_pages(), [])
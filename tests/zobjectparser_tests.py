@@ -0,0 +1,158 @@
+#
+# Unit tests for the object table parser.
+#
+# For the license of this file, please consult the LICENSE file in the
+# root directory of this distribution.
+#
+from unittest import TestCase
+from zvm.zmemory import ZMemory
+from zvm.zobjectparser import ZObjectParser, ZObjectIllegalPropertyNumber
+
+# Object 2 of curses is the "north wall", with properties 24, 20, 8
+# and 1, in that order.
+NORTH_WALL = 2
+
+class ZObjectParserPropertyTests(TestCase):
+    def setUp(self):
+        with open("stories/curses.z5", "rb") as f:
+            self.mem = ZMemory(f.read())
+        self.objects = ZObjectParser(self.mem)
+
+    def testGetAllProperties(self):
+        self.assertEqual(self.objects.get_shortname(NORTH_WALL),
+                         "north wall")
+        self.assertEqual(self.objects.get_all_properties(NORTH_WALL),
+                         {24: (7602, 2), 20: (7605, 2), 8: (7608, 2),
+                          1: (7612, 6)})
+
+    def testGetPropAddrLen(self):
+        self.assertEqual(self.objects.get_prop_addr_len(NORTH_WALL, 20),
+                         (7605, 2))
+        # Missing properties have their default value.
+        default_addr = self.mem.read_word(0x0a) + 2 * (5 - 1)
+        self.assertEqual(self.objects.get_prop_addr_len(NORTH_WALL, 5),
+                         (default_addr, 2))
+
+    def testGetPropAddr(self):
+        self.assertEqual(self.objects.get_prop_addr(NORTH_WALL, 1), 7612)
+        self.assertEqual(self.objects.get_prop_addr(NORTH_WALL, 5), 0)
+
+    def testGetNextProp(self):
+        props = []
+        prop = self.objects.get_next_prop(NORTH_WALL, 0)
+        while prop != 0:
+            props.append(prop)
+            prop = self.objects.get_next_prop(NORTH_WALL, prop)
+        self.assertEqual(props, [24, 20, 8, 1])
+        self.assertEqual(self.objects.get_next_prop(1, 0), 0)
+        self.assertRaises(ZObjectIllegalPropertyNumber,
+                          self.objects.get_next_prop, NORTH_WALL, 5)
+
+    def testSetProperty(self):
+        self.objects.set_property(NORTH_WALL, 20, 0x1234)
+        self.assertEqual(self.objects.get_prop(NORTH_WALL, 20), 0x1234)
+        self.assertEqual(self.mem.read_word(7605), 0x1234)
+        self.assertRaises(ZObjectIllegalPropertyNumber,
+                          self.objects.set_property, NORTH_WALL, 5, 0)
+
+
+# Object 1 of curses is the compass, whose children are objects 2 to
+# 13; object 14 has no relatives.
+COMPASS = 1
+DARKNESS = 14
+
+class ZObjectTreeTests(TestCase):
+    mirror_tree = False
+
+    def setUp(self):
+        with open("stories/curses.z5", "rb") as f:
+            self.mem = ZMemory(f.read())
+        self.objects = ZObjectParser(self.mem,
+                                     mirror_tree=self.mirror_tree)
+        # A parser without a mirror, reading memory directly.
+        self.plain = ZObjectParser(self.mem)
+
+    def _children(self, objectnum, objects=None):
+        objects = objects or self.objects
+        children = []
+        child = objects.get_child(objectnum)
+        while child != 0:
+            children.append(child)
+            child = objects.get_sibling(child)
+        return children
+
+    def _assertInSync(self):
+        for objectnum in range(1, 20):
+            self.assertEqual(
+                (self.objects.get_parent(objectnum),
+                 self.objects.get_sibling(objectnum),
+                 self.objects.get_child(objectnum),
+                 self.objects.get_all_attributes(objectnum)),
+                (self.plain.get_parent(objectnum),
+                 self.plain.get_sibling(objectnum),
+                 self.plain.get_child(objectnum),
+                 self.plain.get_all_attributes(objectnum)))
+
+    def testTraversal(self):
+        self.assertEqual(self._children(COMPASS), list(range(2, 14)))
+        self.assertEqual(self.objects.get_parent(5), COMPASS)
+        self._assertInSync()
+
+    def testInsertIntoOtherParent(self):
+        self.objects.insert_object(DARKNESS, 5)
+        self.assertEqual(self._children(DARKNESS), [5])
+        self.assertEqual(self._children(COMPASS),
+                         [2, 3, 4] + list(range(6, 14)))
+        self.assertEqual(self.objects.get_parent(5), DARKNESS)
+        self._assertInSync()
+
+    def testInsertIntoSameParent(self):
+        self.objects.insert_object(COMPASS, 13)
+        self.assertEqual(self._children(COMPASS),
+                         [13] + list(range(2, 13)))
+        self.objects.insert_object(COMPASS, 13)
+        self.assertEqual(self._children(COMPASS),
+                         [13] + list(range(2, 13)))
+        self._assertInSync()
+
+    def testRemoveMiddleSibling(self):
+        self.objects.remove_object(7)
+        self.assertEqual(self._children(COMPASS),
+                         [2, 3, 4, 5, 6] + list(range(8, 14)))
+        self.assertEqual(self.objects.get_parent(7), 0)
+        self.assertEqual(self.objects.get_sibling(7), 0)
+        self._assertInSync()
+
+    def testInsertMiddleSiblingIntoSameParent(self):
+        self.objects.insert_object(COMPASS, 7)
+        self.assertEqual(self._children(COMPASS),
+                         [7, 2, 3, 4, 5, 6] + list(range(8, 14)))
+        self._assertInSync()
+
+    def testRemoveObject(self):
+        self.objects.remove_object(2)
+        self.objects.remove_object(DARKNESS)
+        self.assertEqual(self._children(COMPASS), list(range(3, 14)))
+        self.assertEqual(self.objects.get_parent(2), 0)
+        self.assertEqual(self.objects.get_sibling(2), 0)
+        self._assertInSync()
+
+
+class ZObjectTreeMirrorTests(ZObjectTreeTests):
+    mirror_tree = True
+
+    def testMirrorCoversAllObjects(self):
+        mirror = self.objects._mirror
+        self.assertEqual(mirror.count, 502)
+        self.assertEqual(self.objects._get_object_addr(mirror.count + 1),
+                         self.objects._get_proptable_addr(1))
+
+    def testDirectWrites(self):
+        # Make object 14 the parent of object 2, and set its attribute
+        # 0, by writing straight into the object table.
+        addr = self.objects._get_object_addr(2)
+        self.mem.write_word(addr + 6, DARKNESS)
+        self.mem[addr] = self.mem[addr] | 0x80
+        self.assertEqual(self.objects.get_parent(2), DARKNESS)
+        self.assertEqual(self.objects.get_attribute(2, 0), 1)
+        self._assertInSync()
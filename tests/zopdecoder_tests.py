@@ -0,0 +1,57 @@
+#
+# Unit tests for the ZOpDecoder class.
+#
+# For the license of this file, please consult the LICENSE file in the
+# root directory of this distribution.
+#
+from unittest import TestCase
+from zvm import zmemory, zstackmanager, zopdecoder
+
+def make_zopdecoder():
+    # We use Graham Nelson's 'curses' game for our unittests.
+    storydata = open("stories/curses.z5", "rb").read()
+    mem = zmemory.ZMemory(storydata)
+    return zopdecoder.ZOpDecoder(mem, zstackmanager.ZStackManager(mem))
+
+class ZOpDecoderTests(TestCase):
+    def testDecodeFirstInstruction(self):
+        # The first instruction of curses is 'call_1n 0x34ce'.
+        decoder = make_zopdecoder()
+        start = decoder.program_counter
+        self.assertEqual(decoder.get_next_instruction(),
+                         (zopdecoder.OPCODE_1OP, 15, [0x34ce]))
+        self.assertEqual(decoder.get_store_address(), None)
+        self.assertEqual(decoder.program_counter, start + 3)
+
+    def testInstructionCache(self):
+        decoder = make_zopdecoder()
+        start = decoder.program_counter
+        first = decoder.get_next_instruction()
+        assert start in decoder._instruction_cache
+        decoder.program_counter = start
+        self.assertEqual(decoder.get_next_instruction(), first)
+
+    def testDecodeAcrossStaticStart(self):
+        storydata = open("stories/curses.z5", "rb").read()
+        mem = zmemory.ZMemory(storydata)
+        session_mem = mem.copy(share_static=True)
+        # An 'add' of two small constants, whose second operand and
+        # store variable are the first bytes of static memory.
+        addr = mem.static_start - 2
+        for m in (mem, session_mem):
+            m[addr:addr + 2] = bytes((0x14, 0x07))
+        expected = zopdecoder.ZOpDecoder(mem, None)._decode_instruction(addr)
+        decoder = zopdecoder.ZOpDecoder(session_mem, None)
+        self.assertEqual(decoder._decode_instruction(addr), expected)
+        self.assertEqual(expected[:3], (zopdecoder.OPCODE_2OP, 20,
+                                        ((zopdecoder.OPERAND_CONSTANT, 7),
+                                         (zopdecoder.OPERAND_CONSTANT,
+                                          mem[addr + 2]))))
+
+    def testDynamicMemoryIsNotCached(self):
+        decoder = make_zopdecoder()
+        # Address 0x40 is in dynamic memory, just past the header.
+        decoder.program_counter = 0x40
+        decoder._memory[0x40] = 0xB0 # rtrue
+        decoder.get_next_instruction()
+        assert 0x40 not in decoder._instruction_cache
@@ -0,0 +1,161 @@
+#
+# Unit tests for the profiler.
+#
+# For the license of this file, please consult the LICENSE file in the
+# root directory of this distribution.
+#
+import io
+import json
+import os
+import signal
+import tempfile
+from unittest import TestCase
+from zvm import headlesszui, zcpu, zmachine, zprofiler
+
+def make_zmachine():
+    with open("stories/curses.z5", "rb") as f:
+        story = f.read()
+    return zmachine.ZMachine(story, headlesszui.create_zui([]))
+
+class ZProfilerTests(TestCase):
+    def setUp(self):
+        self.machine = make_zmachine()
+        self.profiler = zprofiler.ZProfiler(self.machine)
+        with self.profiler:
+            self.result = self.machine.step()
+
+    def testCounts(self):
+        self.assertEqual(self.result.status, zcpu.STEP_NEEDS_CHAR)
+        instructions = self.machine._cpu.instruction_count
+        self.assertEqual(sum(calls for calls, seconds
+                             in self.profiler.opcodes.values()),
+                         instructions)
+        self.assertEqual(sum(count for count, seconds
+                             in self.profiler.stacks.values()),
+                         instructions)
+        # The pending read_char isn't counted.
+        self.assertEqual(self.profiler.opcodes["op_read_char"][0], 0)
+        assert self.profiler.opcodes["op_je"][0] > 0
+
+    def testDispatchRestored(self):
+        cpu = self.machine._cpu
+        self.assertEqual(cpu._dispatch, cpu._build_dispatch_table())
+
+    def testRoutines(self):
+        routines = self.profiler.get_routines()
+        names = [routine[0] for routine in routines]
+        self.assertIn(zprofiler.MAIN_NAME, names)
+        main = routines[names.index(zprofiler.MAIN_NAME)]
+        # Everything runs under main.
+        self.assertAlmostEqual(main[3], sum(routine[2]
+                                            for routine in routines))
+        self.assertEqual(sum(routine[1] for routine in routines),
+                         self.machine._cpu.instruction_count)
+
+    def testCollapsed(self):
+        output = io.StringIO()
+        self.profiler.write_collapsed(output,
+                                      zprofiler.WEIGHT_INSTRUCTIONS)
+        lines = output.getvalue().splitlines()
+        total = 0
+        for line in lines:
+            stack, count = line.rsplit(" ", 1)
+            assert stack.startswith(zprofiler.MAIN_NAME)
+            total += int(count)
+        self.assertEqual(total, self.machine._cpu.instruction_count)
+        self.assertRaises(zprofiler.ZProfilerError,
+                          self.profiler.write_collapsed, output, "bogus")
+
+    def testReport(self):
+        report = self.profiler.report(limit=5)
+        self.assertIn("op_je", report)
+        self.assertIn(zprofiler.MAIN_NAME, report)
+
+    def testRoutineNames(self):
+        stack = max(self.profiler.stacks, key=len)
+        fd, path = tempfile.mkstemp(suffix=".xml")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write("<inform-story-file>"
+                        "<routine><identifier>Main</identifier>"
+                        "<address>%d</address></routine>"
+                        "<routine><identifier>Inner</identifier>"
+                        "<value>%d</value></routine>"
+                        "</inform-story-file>"
+                        % (stack[0], stack[-1] // 4))
+            names = zprofiler.load_routine_names(path, self.machine._mem)
+        finally:
+            os.remove(path)
+        self.assertEqual(names, {stack[0]: "Main", stack[-1]: "Inner"})
+        profiler = zprofiler.ZProfiler(self.machine, names)
+        self.assertEqual(profiler.routine_name(stack[0]), "Main")
+        self.assertEqual(profiler.routine_name(0x1234), "routine_01234")
+
+class ZSamplingProfilerTests(TestCase):
+    def testSample(self):
+        machine = make_zmachine()
+        machine.step(100)
+        sampler = zprofiler.ZSamplingProfiler()
+        sampler.add(machine, "curses")
+        # Not executing: nothing to sample.
+        sampler.sample()
+        self.assertEqual(sampler.idle_samples, 1)
+        machine._cpu.executing = True
+        sampler.sample()
+        histogram = sampler.histograms()["curses"]
+        self.assertEqual(histogram.samples, 1)
+        pc = machine._opdecoder.program_counter
+        self.assertEqual(histogram.pcs[pc], 1)
+        stack = machine._stackmanager.get_routine_addresses()
+        self.assertEqual(histogram.stacks[stack], 1)
+        self.assertEqual(histogram.depths[len(stack)], 1)
+
+        result = histogram.as_dict()
+        self.assertEqual(result["pcs"], [["0x%05x" % pc, 1]])
+        self.assertEqual(result["routines"],
+                         [["routine_%05x" % stack[-1], 1]])
+        output = io.StringIO()
+        histogram.write_collapsed(output)
+        self.assertEqual(output.getvalue().split()[-1], "1")
+
+        # The histograms returned are copies.
+        sampler.sample()
+        self.assertEqual(histogram.samples, 1)
+        self.assertEqual(sampler.histograms()["curses"].samples, 2)
+
+        sampler.remove(machine)
+        sampler.sample()
+        self.assertEqual(sampler.histograms()["curses"].samples, 2)
+
+    def testThread(self):
+        machines = [make_zmachine() for i in range(30)]
+        sampler = zprofiler.ZSamplingProfiler(interval=0.001)
+        for machine in machines:
+            sampler.add(machine)
+        with sampler:
+            for machine in machines:
+                machine.step()
+        assert sampler.histograms()["default"].samples > 0
+        output = io.StringIO()
+        sampler.dump(output)
+        self.assertEqual(json.loads(output.getvalue())["interval"], 0.001)
+
+    def testSignal(self):
+        if not hasattr(signal, "SIGUSR1"):
+            return
+        fd, path = tempfile.mkstemp(suffix=".json")
+        os.close(fd)
+        previous = signal.getsignal(signal.SIGUSR1)
+        try:
+            sampler = zprofiler.ZSamplingProfiler()
+            sampler.add(make_zmachine())
+            sampler.install_signal_handler(path)
+            # The signal may arrive while the main thread is in the
+            # middle of adding or removing a machine.
+            with sampler._lock:
+                os.kill(os.getpid(), signal.SIGUSR1)
+            with open(path) as f:
+                self.assertIn("default", json.load(f)["histograms"])
+        finally:
+            signal.signal(signal.SIGUSR1, previous)
+            os.remove(path)
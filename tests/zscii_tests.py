@@ -57,3 +57,33 @@ class ZStringTranslatorTest(TestCase):
         expected_zstr = [6, 9, 6, 18, 6, 19, 25, 14, 19]
         output_zstr = z.get(29667)
         self.assertEqual(output_zstr, expected_zstr)
+
+    def testWordAcrossStaticStart(self):
+        mem = make_zmemory()
+        session_mem = mem.copy(share_static=True)
+        z = zstring.ZStringTranslator(session_mem)
+        addr = mem.static_start - 1
+        self.assertEqual(z._read_word(addr), mem.read_word(addr))
+
+
+class ZStringFactoryTest(TestCase):
+    def testStaticStringsAreCached(self):
+        factory = zstring.ZStringFactory(make_zmemory())
+        # The dictionary word 'adamantin' lives in static memory.
+        self.assertEqual(factory.get(29667), 'adamantin')
+        self.assertEqual(factory.get(29667), 'adamantin')
+        self.assertEqual(factory.cache_info().hits, 1)
+
+    def testDynamicStringsAreNotCached(self):
+        mem = make_zmemory()
+        factory = zstring.ZStringFactory(mem)
+        # Copy the first word of 'adamantin' into dynamic memory.
+        mem[0x40] = mem[29667] | 0x80
+        mem[0x41] = mem[29668]
+        self.assertEqual(factory.get(0x40), 'ada')
+        self.assertEqual(factory.cache_info().currsize, 0)
+
+    def testDisabledCache(self):
+        factory = zstring.ZStringFactory(make_zmemory(), cache_size=0)
+        self.assertEqual(factory.get(29667), 'adamantin')
+        self.assertEqual(factory.cache_info(), None)
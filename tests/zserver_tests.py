@@ -0,0 +1,163 @@
+#
+# Unit tests for the session server.
+#
+# For the license of this file, please consult the LICENSE file in the
+# root directory of this distribution.
+#
+import asyncio
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from zvm import zprofiler, zserver
+from zvm.zsession import ZSessionFactory
+
+STORY = "stories/curses.z5"
+
+def _read_story():
+    with open(STORY, "rb") as f:
+        return f.read()
+
+class ZServerSessionTests(TestCase):
+    def setUp(self):
+        self.factory = ZSessionFactory(_read_story())
+
+    def tearDown(self):
+        self.factory.close()
+
+    def testParksOnInput(self):
+        session = zserver.ZServerSession(1, self.factory)
+        reply = asyncio.run(session.play())
+        self.assertEqual(reply["state"], zserver.STATE_INPUT)
+        self.assertEqual(reply["input"], "char")
+        assert "Welcome to CURSES" in reply["output"]
+        instructions = session.metrics.instructions
+        assert instructions > 0
+        self.assertEqual(session.machine._cpu.instruction_count,
+                         instructions)
+
+        reply = asyncio.run(session.play(" "))
+        assert "Welcome to CURSES" not in reply["output"]
+        assert reply["output"]
+        self.assertEqual(session.metrics.turns, 2)
+        assert session.metrics.instructions > instructions
+
+    def testLineInput(self):
+        session = zserver.ZServerSession(1, self.factory)
+        mem = session.machine._mem
+        # aread 0x1100 0 -> sp; quit
+        code = bytes((0xE4, 0x1F, 0x11, 0x00, 0x00, 0x00, 0xBA))
+        mem[0x1000:0x1000 + len(code)] = code
+        mem[0x1100] = 20
+        mem[0x1101] = 0
+        session.machine._opdecoder.program_counter = 0x1000
+        reply = asyncio.run(session.play())
+        self.assertEqual(reply["input"], "line")
+        reply = asyncio.run(session.play("Look"))
+        self.assertEqual(reply["state"], zserver.STATE_ENDED)
+        self.assertEqual(reply["error"], None)
+        self.assertEqual(bytes(mem[0x1101:0x1106]), b"\x04look")
+
+    def testErrorIsLogged(self):
+        session = zserver.ZServerSession(1, self.factory)
+        # set_attr 1 1, which isn't implemented.
+        session.machine._mem[0x1000:0x1003] = bytes((0x0B, 0x01, 0x01))
+        session.machine._opdecoder.program_counter = 0x1000
+        with self.assertLogs(zserver.log, "ERROR") as logs:
+            reply = asyncio.run(session.play())
+        self.assertEqual(reply["state"], zserver.STATE_ENDED)
+        assert reply["error"].startswith("ZCpuNotImplemented")
+        self.assertEqual(len(logs.records), 1)
+        assert logs.records[0].exc_info is not None
+
+    def testInstructionQuota(self):
+        session = zserver.ZServerSession(1, self.factory,
+                                         max_instructions=10, time_slice=5)
+        reply = asyncio.run(session.play())
+        self.assertEqual(reply["state"], zserver.STATE_ENDED)
+        assert "quota" in reply["error"]
+        # Stopped in the middle of the turn.
+        self.assertEqual(session.metrics.instructions, 15)
+        self.assertRaises(zserver.ZServerError, asyncio.run,
+                          session.play("look"))
+
+    def testOverBudget(self):
+        session = zserver.ZServerSession(1, self.factory,
+                                         turn_instructions=100,
+                                         max_overruns=2)
+        reply = asyncio.run(session.play())
+        self.assertEqual(reply["state"], zserver.STATE_ENDED)
+        assert "budget" in reply["error"]
+        self.assertEqual(session.metrics.instructions, 300)
+        self.assertEqual(session.metrics.budget_overruns, 3)
+        self.assertEqual(session.metrics.peak_budget_usage, 1.0)
+
+    def testTimeSlicing(self):
+        async def play_both():
+            first = zserver.ZServerSession(1, self.factory, time_slice=100)
+            second = zserver.ZServerSession(2, self.factory, time_slice=100)
+            return await asyncio.gather(first.play(), second.play())
+
+        first, second = asyncio.run(play_both())
+        for reply in (first, second):
+            self.assertEqual(reply["state"], zserver.STATE_INPUT)
+            assert "Welcome to CURSES" in reply["output"]
+
+
+class ZSessionServerTests(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "socket")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def testSessions(self):
+        async def play():
+            server = zserver.ZSessionServer(_read_story(), max_sessions=2,
+                                            sampler=sampler)
+            await server.start(self.path)
+            first = await zserver.ZSessionClient.connect(self.path)
+            second = await zserver.ZSessionClient.connect(self.path)
+            third = await zserver.ZSessionClient.connect(self.path)
+            replies = [await first.read_reply(), await second.read_reply(),
+                       await third.read_reply()]
+            metrics = server.metrics()
+            replies.append(await first.send(" "))
+            await first.close()
+            await second.close()
+            await third.close()
+            await server.close()
+            return replies, metrics
+
+        sampler = zprofiler.ZSamplingProfiler()
+        replies, metrics = asyncio.run(play())
+        self.assertIn("sessions", sampler.histograms())
+        self.assertEqual(sampler._machines, {})
+        self.assertEqual([r["session"] for r in replies[:2]], [1, 2])
+        assert "Welcome to CURSES" in replies[0]["output"]
+        self.assertEqual(replies[2]["state"], zserver.STATE_ENDED)
+        self.assertEqual(replies[2]["error"], "Too many sessions")
+        self.assertEqual(replies[3]["session"], 1)
+        self.assertEqual(metrics["active_sessions"], 2)
+        self.assertEqual(metrics["rejected_sessions"], 1)
+        self.assertEqual(metrics["turns"], 2)
+        self.assertEqual(sorted(metrics["sessions"]), [1, 2])
+
+    def testIdleTimeout(self):
+        async def play():
+            server = zserver.ZSessionServer(_read_story(),
+                                            idle_timeout=0.01)
+            await server.start(self.path)
+            client = await zserver.ZSessionClient.connect(self.path)
+            replies = [await client.read_reply(), await client.read_reply()]
+            await client.close()
+            metrics = server.metrics()
+            await server.close()
+            return replies, metrics
+
+        replies, metrics = asyncio.run(play())
+        self.assertEqual(replies[0]["state"], zserver.STATE_INPUT)
+        # The server hung up.
+        self.assertEqual(replies[1], None)
+        self.assertEqual(metrics["finished_sessions"], 1)
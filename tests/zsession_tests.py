@@ -0,0 +1,63 @@
+#
+# Unit tests for the session factory.
+#
+# For the license of this file, please consult the LICENSE file in the
+# root directory of this distribution.
+#
+import random
+from unittest import TestCase
+from zvm import headlesszui
+from zvm.zsession import ZSessionFactory
+
+class ZSessionFactoryTests(TestCase):
+    def setUp(self):
+        with open("stories/curses.z5", "rb") as f:
+            self.story = f.read()
+        self.factory = ZSessionFactory(self.story)
+
+    def tearDown(self):
+        self.factory.close()
+
+    def _new_session(self, commands=()):
+        return self.factory.new_session(headlesszui.create_zui(commands))
+
+    def testSessionsStartFromTheStory(self):
+        machine = self._new_session()
+        static_start = machine._mem.static_start
+        # Only dynamic memory is private to the session.
+        self.assertEqual(bytes(machine._mem.raw), self.story[:static_start])
+        self.assertIs(machine._mem.static_raw,
+                      self.factory._pristine_mem.raw)
+        self.assertEqual(bytes(machine._mem[0:machine._mem.size - 1]),
+                         self.story[:-1])
+        self.assertEqual(machine._mem.static_start, 0x6633)
+        self.assertEqual(machine._mem[0x6633:0x6635],
+                         bytearray(self.story[0x6633:0x6635]))
+
+    def testSessionsAreIndependent(self):
+        first = self._new_session()
+        second = self._new_session()
+        first._mem[0x40] = 0xAB
+        first._mem.write_global(16, 0x1234)
+        self.assertEqual(first._mem[0x40], 0xAB)
+        self.assertEqual(second._mem[0x40], self.story[0x40])
+        self.assertNotEqual(second._mem.read_global(16), 0x1234)
+        self.assertEqual(self.factory._pristine_mem[0x40], self.story[0x40])
+        self.assertEqual(self._new_session()._mem[0x40], self.story[0x40])
+
+    def testSliceAssignment(self):
+        machine = self._new_session()
+        machine._mem[0x40:0x44] = [1, 2, 3, 4]
+        self.assertEqual(list(machine._mem[0x40:0x44]), [1, 2, 3, 4])
+
+    def testSessionPlays(self):
+        random.seed(1)
+        machine = self._new_session(["look"])
+        # The one command answers the first keypress; the story then
+        # asks for more.
+        self.assertRaises(headlesszui.HeadlessInputExhausted, machine.run)
+        assert "CURSES" in machine._ui.screen.get_output()
+
+    def testClosedFactory(self):
+        self.factory.close()
+        self.assertRaises(ValueError, self._new_session)
@@ -0,0 +1,122 @@
+#
+# Unit tests for the data stack and call stack manager.
+#
+# For the license of this file, please consult the LICENSE file in the
+# root directory of this distribution.
+#
+from unittest import TestCase
+from zvm import zmachine, trivialzui, quetzal
+from zvm.zmemory import ZMemory
+from zvm.zstackmanager import (ZStackManager, ZStackNoRoutine,
+                               ZStackNoSuchVariable, ZStackPopError)
+
+# A spot in dynamic memory to write routine headers at.
+ROUTINE_ADDR = 0x1000
+
+class ZStackManagerTests(TestCase):
+    def setUp(self):
+        with open("stories/curses.z5", "rb") as f:
+            self.mem = ZMemory(f.read())
+        self.stack = ZStackManager(self.mem)
+
+    def _start_routine(self, num_locals, args, store_var=0, pc=0x4000):
+        self.mem[ROUTINE_ADDR] = num_locals
+        return self.stack.start_routine(ROUTINE_ADDR, store_var, pc, args)
+
+    def testLocalsOutsideRoutine(self):
+        self.assertRaises(ZStackNoRoutine,
+                          self.stack.get_local_variable, 0)
+        self.assertRaises(ZStackNoRoutine,
+                          self.stack.set_local_variable, 0, 1)
+
+    def testStartRoutine(self):
+        start = self._start_routine(3, [7, 8])
+        self.assertEqual(start, ROUTINE_ADDR + 1)
+        self.assertEqual(self.stack.get_local_variable(0), 7)
+        self.assertEqual(self.stack.get_local_variable(1), 8)
+        self.assertEqual(self.stack.get_local_variable(2), 0)
+        self.assertRaises(ZStackNoSuchVariable,
+                          self.stack.get_local_variable, 3)
+        self.stack.set_local_variable(2, 0xffff)
+        self.assertEqual(self.stack.get_local_variable(2), 0xffff)
+        self.assertEqual(self.stack.get_stack_frame_index(), 1)
+        self.assertEqual(self.stack.get_routine_addresses(),
+                         (ROUTINE_ADDR,))
+
+    def testExtraArgumentsAreDropped(self):
+        self._start_routine(1, [1, 2, 3])
+        self.assertEqual(self.stack.get_local_variable(0), 1)
+        self.assertEqual(self.stack.get_frames()[1][2], 3)
+
+    def testDataStackBelongsToRoutine(self):
+        self.stack.push_stack(1)
+        self._start_routine(2, [])
+        self.assertRaises(ZStackPopError, self.stack.pop_stack)
+        self.stack.push_stack(2)
+        self.stack.push_stack(3)
+        self.assertEqual(self.stack.pop_stack(), 3)
+        self.stack.finish_routine(4)
+        # The routine's leftover value is gone, and its result pushed.
+        self.assertEqual(self.stack.pop_stack(), 4)
+        self.assertEqual(self.stack.pop_stack(), 1)
+        self.assertRaises(ZStackPopError, self.stack.pop_stack)
+
+    def testFinishRoutine(self):
+        self._start_routine(3, [5], pc=0x4000)
+        # The result of the inner routine goes to the outer's local 3.
+        self._start_routine(0, [], store_var=3, pc=0x5000)
+        self.assertEqual(self.stack.finish_routine(9), 0x5000)
+        self.assertEqual(self.stack.get_local_variable(0), 5)
+        self.assertEqual(self.stack.get_local_variable(2), 9)
+        self._start_routine(0, [], store_var=None)
+        self.stack.finish_routine(10)
+        self.assertRaises(ZStackPopError, self.stack.pop_stack)
+        self.assertEqual(self.stack.finish_routine(0), 0x4000)
+        self.assertEqual(self.stack.pop_stack(), 0)
+        self.assertEqual(self.stack.get_stack_frame_index(), 0)
+        self.assertRaises(ZStackNoRoutine, self.stack.finish_routine, 0)
+
+    def testRoutineHeadersAreCached(self):
+        # The story's main routine, in high memory.
+        main = self.mem.read_word(0x6) - 1
+        self.assertEqual(self.stack.start_routine(main, None, 0, []),
+                         main + 1)
+        self.assertEqual(self.stack.start_routine(main, None, 0, []),
+                         main + 1)
+        self.assertEqual(list(self.stack._routine_cache), [main])
+        # Routines in dynamic memory may change, so aren't cached.
+        self._start_routine(2, [])
+        self._start_routine(1, [])
+        self.assertEqual(self.stack.get_frames()[-1][3], [0])
+        self.assertEqual(list(self.stack._routine_cache), [main])
+
+    def testFramesRoundTrip(self):
+        self.stack.push_stack(1)
+        self._start_routine(2, [3], store_var=None, pc=0x4000)
+        self.stack.push_stack(4)
+        self._start_routine(1, [5, 6], store_var=0x20, pc=0x5000)
+        frames = self.stack.get_frames()
+        self.assertEqual(frames, [
+            (0, None, 0, [], [1]),
+            (0x4000, None, 1, [3, 0], [4]),
+            (0x5000, 0x20, 2, [5], []),
+            ])
+        copy = ZStackManager(self.mem)
+        copy.push_stack(1)
+        for frame in frames[1:]:
+            copy.push_frame(*frame)
+        self.assertEqual(copy.get_frames(), frames)
+
+    def testLoadQuetzalStacks(self):
+        with open("stories/curses.z5", "rb") as f:
+            machine = zmachine.ZMachine(f.read(), trivialzui.create_zui())
+        quetzal.QuetzalParser(machine).load("stories/curses.save1")
+        stack = machine._stackmanager
+        self.assertEqual(stack.get_stack_frame_index(), 3)
+        frames = stack.get_frames()
+        self.assertEqual(frames[0], (0, None, 0, [], []))
+        self.assertEqual(frames[1][3], [0, 65, 0, 0])
+        self.assertEqual([frame[0] for frame in frames[1:]],
+                         [41760, 54557, 55037])
+        self.assertEqual(frames[-1][1], 255)
+        self.assertEqual(stack.finish_routine(0), 55037)
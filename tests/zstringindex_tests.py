@@ -0,0 +1,46 @@
+#
+# Unit tests for the ZStringIndex class.
+#
+# For the license of this file, please consult the LICENSE file in the
+# root directory of this distribution.
+#
+from unittest import TestCase
+from zvm import zmemory, zstring, zstringindex
+
+def make_zmemory():
+    # We use Graham Nelson's 'curses' game for our unittests.
+    storydata = open("stories/curses.z5", "rb").read()
+    return zmemory.ZMemory(storydata)
+
+class ZStringIndexTests(TestCase):
+    def testIndexMatchesDecoding(self):
+        mem = make_zmemory()
+        factory = zstring.ZStringFactory(mem)
+        index = zstringindex.ZStringIndex(mem, factory)
+        index.build()
+        assert len(index) > 0
+        assert index.memory_usage() > 0
+
+        plain = zstring.ZStringFactory(mem, cache_size=0)
+        for addr in list(index._static) + list(index._dynamic):
+            self.assertEqual(index.get(addr), plain.get(addr))
+            self.assertEqual(factory.get(addr), plain.get(addr))
+
+    def testDynamicStringsAreValidated(self):
+        mem = make_zmemory()
+        factory = zstring.ZStringFactory(mem)
+        index = zstringindex.ZStringIndex(mem, factory)
+        index.build()
+        addr = min(index._dynamic)
+        assert index.get(addr) is not None
+        mem[addr] = mem[addr] ^ 0x1
+        self.assertEqual(index.get(addr), None)
+        self.assertEqual(factory.get(addr),
+                         zstring.ZStringFactory(mem, 0).get(addr))
+
+    def testBackgroundBuild(self):
+        mem = make_zmemory()
+        factory = zstring.ZStringFactory(mem)
+        index = zstringindex.ZStringIndex(mem, factory)
+        index.build_in_background().join()
+        self.assertEqual(factory._index, index)
@@ -0,0 +1,50 @@
+#
+# Unit tests for the decoding tables of the ztables module.
+#
+# For the license of this file, please consult the LICENSE file in the
+# root directory of this distribution.
+#
+from unittest import TestCase
+from zvm import ztables
+from zvm.bitfield import BitField
+
+class ZTablesTests(TestCase):
+    def testOpcodeForms(self):
+        # 'je' in long form with a variable and a small constant.
+        self.assertEqual(ztables.OPCODE_FORMS[0x41],
+                         (ztables.OPCODE_2OP, 1,
+                          (ztables.VARIABLE, ztables.SMALL_CONSTANT)))
+        # 'call_1n' in short form with a large constant.
+        self.assertEqual(ztables.OPCODE_FORMS[0x8f],
+                         (ztables.OPCODE_1OP, 15, (ztables.LARGE_CONSTANT,)))
+        self.assertEqual(ztables.OPCODE_FORMS[0xb0],
+                         (ztables.OPCODE_0OP, 0, ()))
+        self.assertEqual(ztables.OPCODE_FORMS[0xe0],
+                         (ztables.OPCODE_VAR, 0, None))
+        self.assertEqual(ztables.OPCODE_FORMS[0xc1],
+                         (ztables.OPCODE_2OP, 1, None))
+
+    def testOperandTypes(self):
+        for byte in range(256):
+            bf = BitField(byte)
+            expected = []
+            for operand_type in (bf[6:8], bf[4:6], bf[2:4], bf[0:2]):
+                if operand_type == ztables.ABSENT:
+                    break
+                expected.append(operand_type)
+            self.assertEqual(ztables.OPERAND_TYPES[byte], tuple(expected))
+
+    def testBranchBytes(self):
+        self.assertEqual(ztables.BRANCH_BYTES[0xc5], (True, True, 5))
+        self.assertEqual(ztables.BRANCH_BYTES[0x01], (False, False, 0x100))
+        # A 14-bit offset with its top bit set is negative.
+        self.assertEqual(ztables.BRANCH_BYTES[0xbf][2] + 0xff, -1)
+
+    def testPropertyHeaders(self):
+        # Version 3: size 8 (7+1) for property 31.
+        self.assertEqual(ztables.PROPERTY_HEADERS_V3[0xff], (31, 8))
+        self.assertEqual(ztables.PROPERTY_HEADERS_V4[0x7f], (63, 2))
+        self.assertEqual(ztables.PROPERTY_HEADERS_V4[0x3f], (63, 1))
+        self.assertEqual(ztables.PROPERTY_HEADERS_V4[0x85], (5, None))
+        self.assertEqual(ztables.PROPERTY_SIZES_V4[0x80], 64)
+        self.assertEqual(ztables.PROPERTY_SIZES_V4[0x8a], 10)
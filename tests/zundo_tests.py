@@ -0,0 +1,167 @@
+#
+# Unit tests for the undo buffer.
+#
+# For the license of this file, please consult the LICENSE file in the
+# root directory of this distribution.
+#
+from unittest import TestCase
+from zvm import headlesszui, zmachine
+from zvm.zundo import ZUndoBuffer, encode_delta, apply_delta
+
+def make_zmachine(**kwargs):
+    with open("stories/curses.z5", "rb") as f:
+        story = f.read()
+    return zmachine.ZMachine(story, headlesszui.create_zui([]), **kwargs)
+
+# The first global variable.
+GLOBAL = 0x10
+
+class DeltaTests(TestCase):
+    def testRoundTrip(self):
+        old = bytes(range(256)) * 4
+        new = bytearray(old)
+        new[0] ^= 1
+        new[1] ^= 0xff
+        new[600] = 0
+        new[1000] ^= 0x10
+        delta = encode_delta(old, bytes(new))
+        self.assertEqual(apply_delta(old, delta), bytes(new))
+
+    def testRunsOfZeros(self):
+        old = bytes(1000)
+        new = bytearray(old)
+        new[700] = 5
+        # 700 unchanged bytes take three runs; the trailing ones none.
+        self.assertEqual(encode_delta(old, bytes(new)),
+                         b'\x00\xff\x00\xff\x00\xbb\x05')
+        self.assertEqual(encode_delta(old, old), b'')
+        self.assertEqual(apply_delta(old, b''), old)
+
+
+class ZUndoBufferTests(TestCase):
+    def setUp(self):
+        self.machine = make_zmachine(undo_depth=0)
+        self.mem = self.machine._mem
+        self.stack = self.machine._stackmanager
+        self.undo = ZUndoBuffer(self.mem, self.stack, depth=3)
+
+    def testNothingToRestore(self):
+        self.assertEqual(self.undo.restore(), None)
+
+    def testRestore(self):
+        self.mem.write_global(GLOBAL, 1)
+        self.stack.push_stack(7)
+        self.undo.save(0x1234, 0x20)
+        self.mem.write_global(GLOBAL, 2)
+        self.mem[0x1000] = self.mem[0x1000] ^ 0xff
+        self.stack.push_stack(8)
+        expected = bytes(self.mem.raw)
+        self.undo.save(0x5678, 0)
+        self.mem.write_global(GLOBAL, 3)
+        self.mem[0x2000] = self.mem[0x2000] ^ 0xff
+        self.stack.pop_stack()
+
+        self.assertEqual(self.undo.restore(), (0x5678, 0))
+        self.assertEqual(bytes(self.mem.raw), expected)
+        self.assertEqual(self.stack.pop_stack(), 8)
+        self.assertEqual(self.undo.restore(), (0x1234, 0x20))
+        self.assertEqual(self.mem.read_global(GLOBAL), 1)
+        self.assertEqual(self.stack.pop_stack(), 7)
+        self.assertEqual(self.undo.restore(), None)
+
+    def testSaveAfterRestore(self):
+        self.mem.write_global(GLOBAL, 1)
+        self.undo.save(0, 0)
+        self.mem.write_global(GLOBAL, 2)
+        self.undo.save(0, 0)
+        self.undo.restore()
+        # Nothing was written since the restore, but memory differs
+        # from the first snapshot.
+        self.undo.save(0, 0)
+        self.mem.write_global(GLOBAL, 3)
+        self.undo.restore()
+        self.assertEqual(self.mem.read_global(GLOBAL), 2)
+        self.undo.restore()
+        self.assertEqual(self.mem.read_global(GLOBAL), 1)
+
+    def testDepth(self):
+        for i in range(5):
+            self.mem.write_global(GLOBAL, i)
+            self.undo.save(i, 0)
+        self.assertEqual(len(self.undo), 3)
+        self.assertEqual(len(self.undo.level_sizes()), 3)
+        # The copy of dynamic memory is counted too.
+        self.assertEqual(self.undo.memory_usage(),
+                         sum(self.undo.level_sizes())
+                         + self.mem.static_start)
+        for i in (4, 3, 2):
+            self.assertEqual(self.undo.restore(), (i, 0))
+            self.assertEqual(self.mem.read_global(GLOBAL), i)
+        self.assertEqual(self.undo.restore(), None)
+        self.assertEqual(self.undo.memory_usage(), self.mem.static_start)
+
+    def testNothingCountedBeforeSaving(self):
+        self.assertEqual(self.undo.memory_usage(), 0)
+
+    def testDirtyPagesClearedElsewhere(self):
+        initial = self.mem.read_global(GLOBAL)
+        self.undo.save(0, 0)
+        self.mem.write_global(GLOBAL, 1)
+        # The dirty pages of the memory are not the buffer's own.
+        self.mem.clear_dirty_pages()
+        self.undo.save(0, 0)
+        self.assertEqual(self.mem.get_dirty_pages(), [])
+        self.mem.write_global(GLOBAL, 2)
+        self.mem.clear_dirty_pages()
+        self.undo.restore()
+        self.assertEqual(self.mem.read_global(GLOBAL), 1)
+        self.undo.restore()
+        self.assertEqual(self.mem.read_global(GLOBAL), initial)
+
+    def testMaxBytes(self):
+        undo = ZUndoBuffer(self.mem, self.stack, depth=10, max_bytes=1)
+        for i in range(3):
+            self.mem.write_global(GLOBAL, i)
+            undo.save(i, 0)
+        # The latest snapshot is always kept.
+        self.assertEqual(len(undo), 1)
+        self.assertEqual(undo.restore(), (2, 0))
+
+    def testObjectTreeMirrorFollowsRestore(self):
+        machine = make_zmachine(undo_depth=0, mirror_objects=True)
+        objects = machine._objectparser
+        undo = ZUndoBuffer(machine._mem, machine._stackmanager)
+        undo.save(0, 0)
+        objects.insert_object(14, 5)
+        self.assertEqual(objects.get_parent(5), 14)
+        undo.restore()
+        self.assertEqual(objects.get_parent(5), 1)
+        self.assertEqual(objects.get_child(14), 0)
+
+
+class ZCpuUndoTests(TestCase):
+    def _execute(self, machine, opcode, store_var):
+        # Act as if the given opcode had just been decoded.
+        machine._opdecoder._store_address = store_var
+        opcode()
+
+    def testSaveAndRestoreUndo(self):
+        machine = make_zmachine()
+        cpu = machine._cpu
+        pc = machine._opdecoder.program_counter
+        self._execute(machine, cpu.op_save_undo, GLOBAL)
+        self.assertEqual(machine._mem.read_global(GLOBAL), 1)
+        machine._mem.write_global(GLOBAL + 1, 0x1234)
+        machine._opdecoder.program_counter = pc + 100
+        self._execute(machine, cpu.op_restore_undo, GLOBAL + 2)
+        self.assertEqual(machine._opdecoder.program_counter, pc)
+        self.assertEqual(machine._mem.read_global(GLOBAL), 2)
+        self.assertNotEqual(machine._mem.read_global(GLOBAL + 1), 0x1234)
+        # Nothing left to restore.
+        self._execute(machine, cpu.op_restore_undo, GLOBAL + 2)
+        self.assertEqual(machine._mem.read_global(GLOBAL + 2), 0)
+
+    def testWithoutUndo(self):
+        machine = make_zmachine(undo_depth=0)
+        self._execute(machine, machine._cpu.op_save_undo, GLOBAL)
+        self.assertEqual(machine._mem.read_global(GLOBAL), 0xffff)
@@ -0,0 +1,157 @@
+#
+# A headless user interface for a Z-Machine, for running stories in
+# batch: input comes from a script of commands, and output is captured
+# in memory instead of being displayed.
+#
+# For the license of this file, please consult the LICENSE file in the
+# root directory of this distribution.
+#
+
+from . import zaudio
+from . import zscreen
+from . import zstream
+from . import zfilesystem
+from . import zui
+
+
+class HeadlessInputExhausted(Exception):
+  "The story asked for more input than its script provides."
+  pass
+
+
+class HeadlessAudio(zaudio.ZAudio):
+  def __init__(self):
+    zaudio.ZAudio.__init__(self)
+    self.features = {
+      "has_more_than_a_bleep": False,
+      }
+
+  def play_bleep(self, bleep_type):
+    pass
+
+
+class HeadlessScreen(zscreen.ZScreen):
+  """A screen of infinite height, so that it never shows a [MORE]
+  prompt, which captures everything written to it."""
+
+  def __init__(self):
+    zscreen.ZScreen.__init__(self)
+    self._rows = zscreen.INFINITE_ROWS
+    self._output = []
+
+  def get_output(self):
+    """Return all the text written to the screen so far."""
+    return ''.join(self._output)
+
+  def clear_output(self):
+    """Forget the text written to the screen so far."""
+    self._output = []
+
+  def split_window(self, height):
+    pass
+
+  def select_window(self, window):
+    pass
+
+  def set_cursor_position(self, x, y):
+    pass
+
+  def erase_window(self, window=zscreen.WINDOW_LOWER,
+                   color=zscreen.COLOR_CURRENT):
+    pass
+
+  def erase_line(self):
+    pass
+
+  def set_font(self, font_number):
+    if font_number == zscreen.FONT_NORMAL:
+      return font_number
+    else:
+      return None
+
+  def set_text_style(self, style):
+    pass
+
+  def write(self, string):
+    self._output.append(string)
+
+
+class ScriptedInputStream(zstream.ZInputStream):
+  """An input stream which answers each request for input with the
+  next line of a script, and raises HeadlessInputExhausted once the
+  script has run out.
+
+  A request for a line of input consumes a whole line, which is
+  echoed to the screen like typed text would be.  A request for a
+  single character consumes a line too, and returns its first
+  character, or a carriage return for an empty line."""
+
+  def __init__(self, screen, commands):
+    zstream.ZInputStream.__init__(self)
+    self._screen = screen
+    self._commands = list(commands)
+    # The number of lines of the script consumed so far.
+    self.turns = 0
+
+  def _next_command(self):
+    if self.turns == len(self._commands):
+      raise HeadlessInputExhausted
+    command = self._commands[self.turns]
+    self.turns += 1
+    return command
+
+  def read_line(self, original_text=None, max_length=0,
+                terminating_characters=None,
+                timed_input_routine=None, timed_input_interval=0):
+    result = self._next_command()
+    if max_length > 0:
+      result = result[:max_length]
+    self._screen.write(result + "\n")
+    return result
+
+  def read_char(self, timed_input_routine=None,
+                timed_input_interval=0):
+    command = self._next_command()
+    if command:
+      return ord(command[0])
+    return 13
+
+
+class HeadlessFilesystem(zfilesystem.ZFilesystem):
+  """A filesystem which keeps saved games in memory, and has no
+  transcript files."""
+
+  def __init__(self):
+    self.saved_games = []
+
+  def save_game(self, data, suggested_filename=None):
+    self.saved_games.append(data)
+    return True
+
+  def restore_game(self):
+    if self.saved_games:
+      return self.saved_games[-1]
+    return None
+
+  def open_transcript_file_for_writing(self):
+    return None
+
+  def open_transcript_file_for_reading(self):
+    return None
+
+
+def create_zui(commands):
+  """Creates and returns a ZUI instance which plays the given sequence
+  of commands, and captures the output in its screen."""
+
+  audio = HeadlessAudio()
+  screen = HeadlessScreen()
+  keyboard_input = ScriptedInputStream(screen, commands)
+  filesystem = HeadlessFilesystem()
+
+  return zui.ZUI(
+    audio,
+    screen,
+    keyboard_input,
+    filesystem
+    )
@@ -20,6 +20,13 @@ import os
 from . import bitfield
 from . import zstackmanager
 from .zlogging import log
+from .zmemory import ZMemoryOutOfBounds
+from .zopdecoder import ZOpDecoder, OPERAND_CONSTANT
+from .ztables import CALL_OPCODES
+
+# The most bytes a call instruction can take: an opcode, two bytes of
+# operand types, eight word operands and a store variable.
+MAX_CALL_LENGTH = 20
 
 # The general format of Queztal is that of a "FORM" IFF file, which is
 # a container class for 'chunks'.
@@ -183,26 +190,27 @@ class QuetzalParser(object):
 
     log("  Begin parsing of stack frames")
 
-    # Our strategy here is simply to create an entirely new
-    # ZStackManager object and populate it with a series of ZRoutine
-    # stack-frames parses from the quetzal file.  We then attach this
-    # new ZStackManager to our z-machine, and allow the old one to be
-    # garbage collected.
+    # Our strategy here is to populate a new ZStackManager with the
+    # stack-frames parsed from the quetzal file, and then to copy them
+    # into the z-machine's own ZStackManager, which the CPU and others
+    # hold on to.  A malformed chunk thus leaves the running stacks
+    # alone.
     stackmanager = zstackmanager.ZStackManager(self._zmachine._mem)
 
     self._seen_mem_or_stks = True
     bytes = data
     total_len = len(bytes)
     ptr = 0
+    first_frame = True
 
     # Read successive stack frames:
     while (ptr < total_len):
       log("  Parsing stack frame...")
-      return_pc = (bytes[ptr] << 16) + (bytes[ptr + 1] << 8) + bytes[ptr + 3]
+      return_pc = (bytes[ptr] << 16) + (bytes[ptr + 1] << 8) + bytes[ptr + 2]
       ptr += 3
       flags_bitfield = bitfield.BitField(bytes[ptr])
       ptr += 1
-      varnum = bytes[ptr]  ### TODO: tells us which variable gets the result
+      varnum = bytes[ptr]
       ptr += 1
       argflag = bytes[ptr]
       ptr += 1
@@ -211,7 +219,7 @@ class QuetzalParser(object):
 
       # read anywhere from 0 to 15 local vars
       local_vars = []
-      for i in range(flags_bitfield[0:3]):
+      for i in range(flags_bitfield[0:4]):
         var = (bytes[ptr] << 8) + bytes[ptr + 1]
         ptr += 2
         local_vars.append(var)
@@ -225,26 +233,68 @@ class QuetzalParser(object):
         stack_values.append(val)
       log("    Found %d local stack values" % len(stack_values))
 
-      ### Interesting... the reconstructed stack frames have no 'start
-      ### address'.  I guess it doesn't matter, since we only need to
-      ### pop back to particular return addresses to resume each
-      ### routine.
-
-      ### TODO: I can exactly which of the 7 args is "supplied", but I
-      ### don't understand where the args *are*??
-
-      routine = zstackmanager.ZRoutine(0, return_pc, self._zmachine._mem,
-                                       [], local_vars, stack_values)
-      stackmanager.push_routine(routine)
-      log("    Added new frame to stack.")
-
       if (ptr > total_len):
         raise QuetzalStackFrameOverflow
 
-    self._zmachine._stackmanager = stackmanager
+      # The first frame is a dummy, holding the values pushed outside
+      # of any routine.
+      if first_frame:
+        first_frame = False
+        for val in stack_values:
+          stackmanager.push_stack(val)
+        log("    Added values to the bottom of the stack.")
+        continue
+
+      # Bit 4 of the flags is set when the routine's result is
+      # discarded.  The arguments supplied are the lowest set bits of
+      # argflag.
+      if flags_bitfield[4]:
+        varnum = None
+      num_args = 0
+      while argflag & (1 << num_args):
+        num_args += 1
+      stackmanager.push_frame(return_pc, varnum, num_args,
+                              local_vars, stack_values,
+                              self._find_routine_addr(return_pc,
+                                                      len(local_vars)))
+      log("    Added new frame to stack.")
+
+    self._zmachine._stackmanager.restore(stackmanager.snapshot())
     log("  Successfully installed all stack frames.")
 
 
+  def _find_routine_addr(self, return_pc, num_locals):
+    """Return the header address of the routine called by the
+    instruction ending at RETURN_PC, or 0 if it can't be told.
+
+    The reconstructed stack frames have no 'start address' in the
+    quetzal file; only the profilers care about it.  When the caller
+    gave the routine as a constant, it is found by decoding the call
+    instruction ending at the return address, and checking that the
+    header of the routine it calls has NUM_LOCALS locals."""
+
+    mem = self._zmachine._mem
+    decoder = ZOpDecoder(mem, None)
+    for length in range(2, MAX_CALL_LENGTH + 1):
+      try:
+        (opcode_class, opcode_number, operands, store, branch,
+         zstring, next_pc) = decoder._decode_instruction(return_pc - length)
+        if next_pc != return_pc or not operands:
+          continue
+        if CALL_OPCODES.get((opcode_class, opcode_number), 6) > mem.version:
+          continue
+        kind, packed_address = operands[0]
+        if kind != OPERAND_CONSTANT:
+          continue
+        routine_addr = mem.packed_address(packed_address)
+        if mem[routine_addr] == num_locals:
+          return routine_addr
+      except (ZMemoryOutOfBounds, IndexError):
+        continue
+    log("    Cannot tell the routine returning to %x" % return_pc)
+    return 0
+
+
   def _parse_intd(self, data):
     """Parse a chunk of type IntD, which is interpreter-dependent info."""
 
@@ -6,12 +6,15 @@
 # root directory of this distribution.
 #
 
+import collections
 import random
 import time
+from timeit import default_timer
 
 from . import zopdecoder
 from . import zscreen
-from . import bitfield
+from . import zstream
+from .zlexer import ZLexer
 from .zlogging import log, log_disasm
 
 class ZCpuError(Exception):
@@ -29,16 +32,121 @@ class ZCpuDivideByZero(ZCpuError):
 class ZCpuNotImplemented(ZCpuError):
      "Opcode not yet implemented"
 
+class ZCpuQuit(ZCpuError):
+    "The story executed the quit opcode"
+
+class ZCpuNoInputRequested(ZCpuError):
+    "Input given to step() while the story wasn't asking for any"
+
+class ZCpuOverBudget(ZCpuError):
+    "The current turn used up its instruction or time budget"
+
+# The outcomes of ZCpu.step(): the instructions asked for were run,
+# the story is waiting for a line or a character of input, the turn
+# used up its budget, the story quit, or execution halted on an opcode
+# which isn't implemented yet.
+STEP_RUNNING = 'running'
+STEP_NEEDS_LINE = zstream.INPUT_LINE
+STEP_NEEDS_CHAR = zstream.INPUT_CHAR
+STEP_OVER_BUDGET = 'over_budget'
+STEP_QUIT = 'quit'
+STEP_HALTED = 'halted'
+
+# With a time budget, the clock is checked every this many
+# instructions.
+BUDGET_CHECK_INTERVAL = 1000
+
+# The result of ZCpu.step(): one of the STEP_* statuses, and the number
+# of instructions executed.
+ZStepResult = collections.namedtuple('ZStepResult',
+                                     ['status', 'instructions'])
+
+def _dispatch_index(opcode_class, opcode_number):
+    """Return the index of the given opcode in the flat dispatch
+    table. The 0OP, 1OP, 2OP and VAR tables each get 32 slots, and are
+    followed by the 256 possible EXT opcodes."""
+    return (opcode_class << 5) + opcode_number
+
 class ZCpu(object):
     def __init__(self, zmem, zopdecoder, zstack, zobjects, zstring,
-                 zstreammanager, zui):
+                 zstreammanager, zui, zundo=None):
         self._memory = zmem
+        self._raw = zmem.raw
+        self._static_raw = zmem.static_raw
+        self._static_start = zmem.static_start
         self._opdecoder = zopdecoder
         self._stackmanager = zstack
         self._objects = zobjects
         self._string = zstring
+        # The ZLexer tokenising lines of input, made on the first one.
+        self._lexer = None
         self._streammanager = zstreammanager
         self._ui = zui
+        # The zundo.ZUndoBuffer of save_undo, or None without undo.
+        self._undo = zundo
+        self._dispatch = self._build_dispatch_table()
+
+        # The number of instructions executed by run() so far.
+        self.instruction_count = 0
+
+        # The (handler, operands) of an instruction which stopped
+        # because its input wasn't ready yet, to be retried by the
+        # next run(). The decoder still holds its store and branch
+        # details, since nothing else is decoded in between.
+        self._suspended = None
+        # The kind of input the suspended instruction is waiting for.
+        self._pending_input = None
+
+        # The input given to step() for the suspended instruction.
+        self._step_input = None
+
+        # STEP_QUIT or STEP_HALTED once execution has stopped for good.
+        self._stopped = None
+
+        # The per-turn budgets set by set_turn_budget(). A turn starts
+        # when the story starts, or receives input. The instructions
+        # and time it may use are counted in a budget window, which
+        # starts with the turn, and starts over each time execution
+        # resumes after running over budget.
+        self._budget_instructions = None
+        self._budget_seconds = None
+        self._new_turn = True
+        self._window_instructions = 0
+        self._window_seconds = 0.0
+        self._window_over = False
+        self._call_start = 0.0
+
+        # Budget accounting: the instructions executed and the seconds
+        # spent executing them in the current turn, the highest
+        # fraction of its budget any window has used, and the number
+        # of windows which ran over budget.
+        self.turn_instructions = 0
+        self.turn_seconds = 0.0
+        self.peak_budget_usage = 0.0
+        self.budget_overruns = 0
+
+        # True while instructions are being executed, rather than the
+        # story waiting for the next call to run() or step().
+        self.executing = False
+
+    def _build_dispatch_table(self):
+        """Resolve the opcode declarations once for the version of the
+        loaded story, and return a flat table indexed by
+        _dispatch_index(). Each entry is either None for illegal
+        opcodes, or an (implemented, bound_handler) tuple."""
+        table = [None] * _dispatch_index(zopdecoder.OPCODE_EXT, 256)
+        for opcode_class, opcode_decls in self.opcodes.items():
+            for opcode_number in range(len(opcode_decls)):
+                try:
+                    implemented, func = self._get_handler(opcode_class,
+                                                          opcode_number)
+                except ZCpuIllegalInstruction:
+                    continue
+                # Look the handler up by name, so that subclasses can
+                # override individual opcodes.
+                table[_dispatch_index(opcode_class, opcode_number)] = (
+                    implemented, getattr(self, func.__name__))
+        return table
 
     def _get_handler(self, opcode_class, opcode_number):
         try:
@@ -56,6 +164,7 @@ class ZCpu(object):
             # We have several different implementations for the
             # opcode, and we need to select the right one based on
             # version.
+            opcode_func = None
             if isinstance(opcode_decl[0], (list, tuple)):
                 for func,version in opcode_decl:
                     if version <= self._memory.version:
@@ -65,7 +174,7 @@ class ZCpu(object):
             # recent enough.
             elif opcode_decl[1] <= self._memory.version:
                 opcode_func = opcode_decl[0]
-            else:
+            if opcode_func is None:
                 raise ZCpuIllegalInstruction
 
         # The following is a hack, based on our policy of only
@@ -80,18 +189,14 @@ class ZCpu(object):
     def _make_signed(self, a):
         """Turn the given 16-bit value into a signed integer."""
         assert a < (1<<16)
-        # This is a little ugly.
-        bf = bitfield.BitField(a)
-        if bf[15]:
+        if a & 0x8000:
             a = a - (1<<16)
         return a
 
     def _unmake_signed(self, a):
         """Turn the given signed integer into a 16-bit value ready for
-        storage."""
-        if a < 0:
-            a = (1<<16) + a
-        return a
+        storage.  Results out of the 16-bit range wrap around."""
+        return a & 0xFFFF
 
     def _read_variable(self, addr):
         """Return the value of the given variable, which can come from
@@ -116,16 +221,11 @@ class ZCpu(object):
 
         if result_addr != None:
             if result_addr == 0x0:
-                log("Push %d to stack" % result_value)
                 self._stackmanager.push_stack(result_value)
             elif 0x0 < result_addr < 0x10:
-                log("Local variable %d = %d" % (
-                    result_addr - 1, result_value))
                 self._stackmanager.set_local_variable(result_addr - 1,
                                                       result_value)
             else:
-                log("Global variable %d = %d" % (result_addr,
-                                                 result_value))
                 self._memory.write_global(result_addr, result_value)
 
     def _call(self, routine_address, args, store_return_value):
@@ -149,35 +249,271 @@ class ZCpu(object):
 
         if test_result == branch_cond:
             if branch_offset == 0 or branch_offset == 1:
-                log("Return from routine with %d" % branch_offset)
                 addr = self._stackmanager.finish_routine(branch_offset)
                 self._opdecoder.program_counter = addr
             else:
-                log("Jump to offset %+d" % branch_offset)
                 self._opdecoder.program_counter += (branch_offset - 2)
 
+    def _read_input(self, kind):
+        """Return the input given to step() for the instruction being
+        executed: a line of text for INPUT_LINE, or a character code
+        for INPUT_CHAR. Without input, raise ZInputPending, so that
+        the instruction waits for it."""
+        if self._step_input is None:
+            raise zstream.ZInputPending(kind)
+        value = self._step_input
+        self._step_input = None
+        return value
+
+    def _read_line(self, text_buffer, parse_buffer):
+        """Read a line of input into the text buffer at address
+        TEXT_BUFFER, and unless PARSE_BUFFER is 0, tokenise it into
+        the parse buffer at that address (see the 'read' opcode in
+        section 15 of the spec)."""
+        line = self._read_input(zstream.INPUT_LINE)
+        mem = self._memory
+        zscii = self._string.zscii
+        codes = []
+        for char in line.lower():
+            try:
+                codes.append(zscii.utoz(char))
+            except IndexError:
+                pass
+
+        if mem.version <= 4:
+            # The letters go from byte 1 on, ending with a zero.
+            start = text_buffer + 1
+            codes = codes[:mem[text_buffer] - 1]
+            mem[start:start + len(codes) + 1] = codes + [0]
+        else:
+            # Byte 1 holds the number of letters, which carry on after
+            # any the story put there already.
+            start = text_buffer + 2
+            existing = mem[text_buffer + 1]
+            codes = codes[:max(mem[text_buffer] - existing, 0)]
+            if codes:
+                mem[start + existing:start + existing + len(codes)] = codes
+            mem[text_buffer + 1] = existing + len(codes)
+            codes = list(mem[start:start + existing]) + codes
+
+        if parse_buffer == 0:
+            return
+        if self._lexer is None:
+            self._lexer = ZLexer(mem)
+        words = self._lexer.tokenise_input(zscii.get(codes))
+        words = words[:mem[parse_buffer]]
+        mem[parse_buffer + 1] = len(words)
+        addr = parse_buffer + 2
+        for word, dict_addr, position in words:
+            mem.write_word(addr, dict_addr)
+            mem[addr + 2] = len(word)
+            mem[addr + 3] = start - text_buffer + position
+            addr += 4
+
+    def set_turn_budget(self, instructions=None, seconds=None):
+        """Limit each turn to INSTRUCTIONS instructions, and SECONDS
+        seconds spent executing it, where None is no limit. A turn
+        which goes over budget pauses with STEP_OVER_BUDGET; if
+        execution is resumed, the turn gets the same budget again."""
+        self._budget_instructions = instructions
+        self._budget_seconds = seconds
+
+    def budget_usage(self):
+        """Return the fraction of its budget the current budget window
+        has used so far, or None if there is no budget."""
+        usage = None
+        if self._budget_instructions is not None:
+            usage = (float(self._window_instructions)
+                     / max(self._budget_instructions, 1))
+        if self._budget_seconds is not None:
+            time_usage = self._window_seconds / self._budget_seconds
+            if usage is None or time_usage > usage:
+                usage = time_usage
+        return usage
+
+    def _begin_execute(self):
+        """Start accounting for a call to _execute()."""
+        if self._new_turn or self._step_input is not None:
+            self._new_turn = False
+            self.turn_instructions = 0
+            self.turn_seconds = 0.0
+            self._window_over = True
+        if self._window_over:
+            self._window_over = False
+            self._window_instructions = 0
+            self._window_seconds = 0.0
+        self._call_start = default_timer()
+        self.executing = True
+
+    def _end_execute(self, count):
+        """Account for the COUNT instructions executed by a call to
+        _execute()."""
+        self.executing = False
+        seconds = default_timer() - self._call_start
+        self.instruction_count += count
+        self.turn_instructions += count
+        self.turn_seconds += seconds
+        self._window_instructions += count
+        self._window_seconds += seconds
+        usage = self.budget_usage()
+        if usage is not None and usage > self.peak_budget_usage:
+            self.peak_budget_usage = usage
+
+    def _chunk_limit(self, count, max_instructions):
+        """Return the value of COUNT, the number of instructions
+        executed so far by _execute(), at which execution must stop to
+        honour MAX_INSTRUCTIONS or check the budget. None means no
+        limit."""
+        limit = max_instructions
+        if self._budget_instructions is not None:
+            budget_limit = (self._budget_instructions
+                            - self._window_instructions)
+            if limit is None or budget_limit < limit:
+                limit = budget_limit
+        if self._budget_seconds is not None:
+            check_limit = count + BUDGET_CHECK_INTERVAL
+            if limit is None or check_limit < limit:
+                limit = check_limit
+        if limit is not None and limit < count:
+            limit = count
+        return limit
+
+    def _over_budget(self, count):
+        """Return True, and end the budget window, if the window has
+        used up its budget, counting the COUNT instructions executed so
+        far by _execute()."""
+        over = False
+        if (self._budget_instructions is not None
+            and (self._window_instructions + count
+                 >= self._budget_instructions)):
+            over = True
+        if (self._budget_seconds is not None
+            and (self._window_seconds + default_timer() - self._call_start
+                 >= self._budget_seconds)):
+            over = True
+        if over:
+            self.budget_overruns += 1
+            self._window_over = True
+        return over
+
+    def _execute(self, max_instructions):
+        """Execute up to MAX_INSTRUCTIONS instructions, or without limit
+        if it is None, and return a STEP_* status. Raises
+        ZInputPending if an instruction has to wait for input."""
+        if self._stopped is not None:
+            return self._stopped
+        self._trace_event("Execution started")
+        self._begin_execute()
+        dispatch = self._dispatch
+        decoder = self._opdecoder
+        trace = self._trace_instruction
+        count = 0
+        try:
+            if self._suspended is not None:
+                func, operands = self._suspended
+                self._suspended = None
+                self._pending_input = None
+                self._trace_event("Resuming %s" % func.__name__)
+                count += 1
+                func(*operands)
+            while True:
+                limit = self._chunk_limit(count, max_instructions)
+                while count != limit:
+                    if trace is not None:
+                        pc = decoder.program_counter
+                    (opcode_class, opcode_number,
+                     operands) = decoder.get_next_instruction()
+                    handler = dispatch[(opcode_class << 5) + opcode_number]
+                    if handler is None:
+                        raise ZCpuIllegalInstruction
+                    implemented, func = handler
+                    if trace is not None:
+                        trace(pc, opcode_class, opcode_number, func, operands)
+                    if not implemented:
+                        self._trace_event("Unimplemented opcode %s, "
+                                          "halting execution" % func.__name__)
+                        self._stopped = STEP_HALTED
+                        return STEP_HALTED
+
+                    count += 1
+                    func(*operands)
+                if self._over_budget(count):
+                    self._trace_event("Turn over budget, pausing execution")
+                    return STEP_OVER_BUDGET
+                if count == max_instructions:
+                    self._trace_event("Instruction count reached, "
+                                      "pausing execution")
+                    return STEP_RUNNING
+        except zstream.ZInputPending as e:
+            # The operands were fetched already, and may have popped
+            # the stack, so the instruction is retried from its handler
+            # rather than decoded again.
+            self._trace_event("Input pending, suspending %s" % func.__name__)
+            self._suspended = (func, operands)
+            self._pending_input = e.kind
+            count -= 1
+            raise
+        except ZCpuQuit:
+            self._trace_event("Quit, halting execution")
+            self._stopped = STEP_QUIT
+            return STEP_QUIT
+        finally:
+            self._end_execute(count)
+
+    # Called by _execute() with the address, opcode class and number,
+    # handler and operands of every instruction before executing it,
+    # unless None. Subclasses tracing execution override it.
+    _trace_instruction = None
+
+    def _trace_event(self, message):
+        """Called by _execute() with a description of each change in
+        the state of execution (starting, suspending, stopping...)."""
+        pass
+
     def run(self):
         """The Magic Function that takes little bits and bytes, twirls
-        them around, and brings the magic to your screen!"""
-        log("Execution started")
+        them around, and brings the magic to your screen!
+
+        Returns when the story quits, and raises ZCpuOverBudget when a
+        turn runs over budget; calling run() again resumes the
+        story."""
+        keyboard = self._ui.keyboard_input
+        input = None
         while True:
-            current_pc = self._opdecoder.program_counter
-            log("Reading next opcode at address %x" % current_pc)
-            (opcode_class, opcode_number,
-             operands) = self._opdecoder.get_next_instruction()
-            implemented, func = self._get_handler(opcode_class,
-                                                  opcode_number)
-            log_disasm(current_pc, zopdecoder.OPCODE_STRINGS[opcode_class],
-                       opcode_number, func.__name__,
-                       ', '.join([str(x) for x in operands]))
-            if not implemented:
-                log("Unimplemented opcode %s, "
-                    "halting execution" % func.__name__)
-                break
-
-            # The returned function is unbound, so we must pass
-            # self to it ourselves.
-            func(self, *operands)
+            status = self.step(None, input).status
+            if status == STEP_NEEDS_CHAR:
+                input = keyboard.read_char()
+            elif status == STEP_NEEDS_LINE:
+                input = keyboard.read_line()
+            elif status == STEP_OVER_BUDGET:
+                raise ZCpuOverBudget
+            else:
+                return
+
+    def step(self, max_instructions=None, input=None):
+        """Execute up to MAX_INSTRUCTIONS instructions, or without limit
+        if it is None, stopping early when the story asks for input,
+        runs over its turn budget, or stops. Return a ZStepResult.
+
+        Input is never read from the keyboard: when the result is
+        STEP_NEEDS_LINE or STEP_NEEDS_CHAR, call step() again with
+        INPUT set to the line of text, or the character code, to
+        continue with. Calling step() without the input it needs
+        returns the same result again, having executed nothing."""
+        if input is not None and self._suspended is None:
+            raise ZCpuNoInputRequested
+        if input is None and self._pending_input is not None:
+            return ZStepResult(self._pending_input, 0)
+        start_count = self.instruction_count
+        self._step_input = input
+        try:
+            status = self._execute(max_instructions)
+        except zstream.ZInputPending as e:
+            status = e.kind or STEP_NEEDS_LINE
+            self._pending_input = status
+        finally:
+            self._step_input = None
+        return ZStepResult(status, self.instruction_count - start_count)
 
     ##
     ## Opcode implementation functions start here.
@@ -228,9 +564,9 @@ class ZCpu(object):
         self._write_result(val, store_addr=variable)
         self._branch(val > test_value)
 
-    def op_jin(self, *args):
-        """TODO: Write docstring here."""
-        raise ZCpuNotImplemented
+    def op_jin(self, object_num, parent_num):
+        """Branch if the first object is a child of the second."""
+        self._branch(self._objects.get_parent(object_num) == parent_num)
 
     def op_test(self, *args):
         """TODO: Write docstring here."""
@@ -275,8 +611,12 @@ class ZCpu(object):
     def op_loadb(self, base, offset):
         """Store in the given result register the byte value at
         (base+offset)."""
-        val = self._memory[base+offset]
-        self._write_result(val)
+        addr = base + offset
+        self._memory.check_range(addr)
+        if addr >= self._static_start:
+            self._write_result(self._static_raw[addr])
+        else:
+            self._write_result(self._raw[addr])
 
     def op_get_prop(self, objectnum, propnum):
         """Store in the given result an object's property value
@@ -284,13 +624,16 @@ class ZCpu(object):
         val = self._objects.get_prop(objectnum, propnum)
         self._write_result(val)
 
-    def op_get_prop_addr(self, *args):
-        """TODO: Write docstring here."""
-        raise ZCpuNotImplemented
+    def op_get_prop_addr(self, objectnum, propnum):
+        """Store in the given result the address of an object's
+        property value, or 0 if the object has no such property."""
+        self._write_result(self._objects.get_prop_addr(objectnum, propnum))
 
-    def op_get_next_prop(self, *args):
-        """TODO: Write docstring here."""
-        raise ZCpuNotImplemented
+    def op_get_next_prop(self, objectnum, propnum):
+        """Store in the given result the number of the object's
+        property after the given one, or its first property if the
+        given one is 0. Stores 0 after the last property."""
+        self._write_result(self._objects.get_next_prop(objectnum, propnum))
 
     def op_add(self, a, b):
         """Signed 16-bit addition."""
@@ -344,14 +687,19 @@ class ZCpu(object):
         """Branch if the val is zero."""
         self._branch(val == 0)
 
-    def op_get_sibling(self, *args):
-        """TODO: Write docstring here."""
-        raise ZCpuNotImplemented
+    def op_get_sibling(self, object_num):
+        """Get and store the next sibling of the given object, and
+        branch if it exists."""
+        sibling = self._objects.get_sibling(object_num)
+        self._write_result(sibling)
+        self._branch(sibling != 0)
 
     def op_get_child(self, object_num):
-        """Get and store the first child of the given object."""
-        self._write_result(
-            self._objects.get_child(object_num))
+        """Get and store the first child of the given object, and
+        branch if it exists."""
+        child = self._objects.get_child(object_num)
+        self._write_result(child)
+        self._branch(child != 0)
 
     def op_get_parent(self, object_num):
         """Get and store the parent of the given object."""
@@ -380,9 +728,9 @@ class ZCpu(object):
         """Call the given routine and store the return value."""
         self._call(routine_address, [], True)
 
-    def op_remove_obj(self, *args):
-        """TODO: Write docstring here."""
-        raise ZCpuNotImplemented
+    def op_remove_obj(self, object_num):
+        """Detach the given object from its parent."""
+        self._objects.remove_object(object_num)
 
     def op_print_obj(self, *args):
         """TODO: Write docstring here."""
@@ -397,14 +745,11 @@ class ZCpu(object):
         opcode does not follow the usual branch decision algorithm,
         and so we do not call the _branch method to dispatch the call."""
 
-        old_pc = self._opdecoder.program_counter
-
         # The offset to the jump instruction is known to be a 2-byte
         # signed integer. We need to make it signed before applying
         # the offset.
         if (offset >= (1<<15)):
             offset = - (1<<16) + offset
-        log("Jump unconditionally to relative offset %d" % offset)
 
         # Apparently reading the 2 bytes of operand *isn't* supposed
         # to increment the PC, thus we need to apply this offset to PC
@@ -412,7 +757,6 @@ class ZCpu(object):
         # modifier below.
         new_pc = self._opdecoder.program_counter + offset - 2
         self._opdecoder.program_counter = new_pc
-        log("PC has changed from from %x to %x" % (old_pc, new_pc))
 
 
     def op_print_paddr(self, string_paddr):
@@ -493,8 +837,8 @@ class ZCpu(object):
         raise ZCpuNotImplemented
 
     def op_quit(self, *args):
-        """TODO: Write docstring here."""
-        raise ZCpuNotImplemented
+        """Exit the game immediately."""
+        raise ZCpuQuit
 
     def op_new_line(self, *args):
         """TODO: Write docstring here."""
@@ -543,18 +887,32 @@ class ZCpu(object):
         """Set an object's property to the given value."""
         self._objects.set_property(object_number, property_number, value)
 
-    def op_sread(self, *args):
-        """Not implemented yet, but documented so that the detection
-        code will be foiled."""
-
-
-    def op_sread_v4(self, *args):
-        """TODO: Write docstring here."""
-        raise ZCpuNotImplemented
-
-    def op_aread(self, *args):
-        """TODO: Write docstring here."""
-        raise ZCpuNotImplemented
+    def op_sread(self, text_buffer, parse_buffer):
+        """Read a line of input from the keyboard into the given text
+        buffer, and tokenise it into the given parse buffer."""
+        # TODO: versions 1 to 3 should redisplay the status line
+        # first.
+        self._read_line(text_buffer, parse_buffer)
+
+    def op_sread_v4(self, text_buffer, parse_buffer, time=0,
+                    input_routine=0):
+        """Read a line of input from the keyboard into the given text
+        buffer, and tokenise it into the given parse buffer."""
+        # TODO: timed input is not implemented yet.
+        if time != 0 or input_routine != 0:
+            raise ZCpuNotImplemented
+        self._read_line(text_buffer, parse_buffer)
+
+    def op_aread(self, text_buffer, parse_buffer=0, time=0,
+                 input_routine=0):
+        """Read a line of input from the keyboard into the given text
+        buffer, and tokenise it into the given parse buffer unless it
+        is 0, then store the character which ended the input."""
+        # TODO: timed input is not implemented yet.
+        if time != 0 or input_routine != 0:
+            raise ZCpuNotImplemented
+        self._read_line(text_buffer, parse_buffer)
+        self._write_result(13)
 
     def op_print_char(self, char):
         """Output the given ZSCII character."""
@@ -574,13 +932,10 @@ class ZCpu(object):
         """
         result = 0
         if n > 0:
-            log("Generate random number in [1:%d]" % n)
             result = random.randint(1, n)
         elif n < 0:
-            log("Seed PRNG with %d" % n)
             random.seed(n)
         else:
-            log("Seed PRNG with time")
             random.seed(time.time())
         self._write_result(result)
 
@@ -684,7 +1039,7 @@ class ZCpu(object):
         if time != 0 or input_routine != 0:
             raise ZCpuNotImplemented
 
-        char = self._ui.keyboard_input.read_char()
+        char = self._read_input(zstream.INPUT_CHAR)
         self._write_result(char)
 
     def op_scan_table(self, *args):
@@ -745,13 +1100,29 @@ class ZCpu(object):
         """TODO: Write docstring here."""
         raise ZCpuNotImplemented
 
-    def op_save_undo(self, *args):
-        """TODO: Write docstring here."""
-        raise ZCpuNotImplemented
-
-    def op_restore_undo(self, *args):
-        """TODO: Write docstring here."""
-        raise ZCpuNotImplemented
+    def op_save_undo(self):
+        """Save the state of the game for restore_undo, and store 1,
+        or -1 if undo is not available. Once the state is restored,
+        execution continues as if this instruction had stored 2."""
+        if self._undo is None:
+            self._write_result(0xFFFF)
+            return
+        self._undo.save(self._opdecoder.program_counter,
+                        self._opdecoder.get_store_address())
+        self._write_result(1)
+
+    def op_restore_undo(self):
+        """Restore the state of the game saved by the latest
+        save_undo, or store 0 if there is none."""
+        saved = None
+        if self._undo is not None:
+            saved = self._undo.restore()
+        if saved is None:
+            self._write_result(0)
+            return
+        program_counter, store_var = saved
+        self._opdecoder.program_counter = program_counter
+        self._write_result(2, store_addr=store_var)
 
     def op_print_unicode(self, *args):
         """TODO: Write docstring here."""
@@ -915,3 +1286,62 @@ class ZCpu(object):
         (op_check_unicode, 5)
         ],
         }
+
+
+class ZTracingCpu(ZCpu):
+    """A ZCpu which logs every instruction it executes, and writes a
+    disassembly of the executed code, through the tracing hooks of
+    ZCpu._execute(). The ZMachine only uses it in debug mode, so that
+    the normal CPU never pays for formatting log messages."""
+
+    def _trace_instruction(self, pc, opcode_class, opcode_number, func,
+                           operands):
+        log_disasm(pc, zopdecoder.OPCODE_STRINGS[opcode_class],
+                   opcode_number, func.__name__,
+                   ', '.join([str(x) for x in operands]))
+
+    def _trace_event(self, message):
+        log(message)
+
+    def _write_result(self, result_value, store_addr=None):
+        if store_addr == None:
+            result_addr = self._opdecoder.get_store_address()
+        else:
+            result_addr = store_addr
+
+        if result_addr != None:
+            if result_addr == 0x0:
+                log("Push %d to stack" % result_value)
+            elif 0x0 < result_addr < 0x10:
+                log("Local variable %d = %d" % (
+                    result_addr - 1, result_value))
+            else:
+                log("Global variable %d = %d" % (result_addr,
+                                                 result_value))
+        ZCpu._write_result(self, result_value, store_addr)
+
+    def _branch(self, test_result):
+        branch_cond, branch_offset = self._opdecoder.get_branch_offset()
+        if test_result == branch_cond:
+            if branch_offset == 0 or branch_offset == 1:
+                log("Return from routine with %d" % branch_offset)
+            else:
+                log("Jump to offset %+d" % branch_offset)
+        ZCpu._branch(self, test_result)
+
+    def op_jump(self, offset):
+        """See ZCpu.op_jump."""
+        old_pc = self._opdecoder.program_counter
+        ZCpu.op_jump(self, offset)
+        log("PC has changed from from %x to %x" % (
+            old_pc, self._opdecoder.program_counter))
+
+    def op_random(self, n):
+        """See ZCpu.op_random."""
+        if n > 0:
+            log("Generate random number in [1:%d]" % n)
+        elif n < 0:
+            log("Seed PRNG with %d" % n)
+        else:
+            log("Seed PRNG with time")
+        ZCpu.op_random(self, n)
@@ -0,0 +1,124 @@
+#
+# A farm of worker processes which replays walkthroughs -- scripts of
+# commands -- through stories in parallel, for regression testing
+# story builds.
+#
+# For the license of this file, please consult the LICENSE file in the
+# root directory of this distribution.
+#
+
+import collections
+import hashlib
+import multiprocessing
+import random
+from timeit import default_timer
+
+from . import headlesszui
+from .zmachine import ZMachine
+from .zmemory import ZMemory
+
+# The outcome of replaying one walkthrough.  transcript_hash is the
+# SHA-1 of the story's output; transcript is the output itself, when
+# the farm was asked to keep it.  error describes the exception which
+# stopped the story, or is None if it played until the script ran out
+# (or the story ended).
+WalkthroughResult = collections.namedtuple(
+  'WalkthroughResult',
+  ['story', 'script', 'transcript_hash', 'turns', 'instructions',
+   'seconds', 'error', 'transcript'])
+
+
+def read_script(script_path):
+  """Return the lines of the file at SCRIPT_PATH as a list of
+  commands."""
+  with open(script_path) as script_file:
+    return script_file.read().splitlines()
+
+
+def play_walkthrough(pristine_mem, commands, seed=None):
+  """Play COMMANDS through a new machine started from the pristine
+  memory image PRISTINE_MEM.  Return a (transcript, turns,
+  instructions, seconds, error) tuple.
+
+  If SEED is not None, the random number generator is seeded with it
+  first, so that the run is repeatable."""
+  ui = headlesszui.create_zui(commands)
+  machine = ZMachine(pristine_mem, ui)
+  if seed is not None:
+    random.seed(seed)
+  error = None
+  start = default_timer()
+  try:
+    machine.run()
+  except headlesszui.HeadlessInputExhausted:
+    pass
+  except Exception as e:
+    error = "%s: %s" % (e.__class__.__name__, e)
+  seconds = default_timer() - start
+  return (ui.screen.get_output(), ui.keyboard_input.turns,
+          machine._cpu.instruction_count, seconds, error)
+
+
+# The pristine memory images of the stories a worker has loaded so
+# far, keyed by path, so that each story is only read and parsed once
+# per worker.
+_pristine_memories = {}
+
+def _get_pristine_memory(story_path):
+  pristine_mem = _pristine_memories.get(story_path)
+  if pristine_mem is None:
+    with open(story_path, "rb") as story_file:
+      pristine_mem = ZMemory(story_file.read())
+    _pristine_memories[story_path] = pristine_mem
+  return pristine_mem
+
+def _run_job(job):
+  """Replay one (story_path, script_path, seed, keep_transcript) job,
+  and return its WalkthroughResult."""
+  story_path, script_path, seed, keep_transcript = job
+  try:
+    pristine_mem = _get_pristine_memory(story_path)
+    commands = read_script(script_path)
+  except Exception as e:
+    return WalkthroughResult(story_path, script_path, None, 0, 0, 0.0,
+                             "%s: %s" % (e.__class__.__name__, e), None)
+  transcript, turns, instructions, seconds, error = \
+              play_walkthrough(pristine_mem, commands, seed)
+  transcript_hash = hashlib.sha1(transcript.encode('utf-8')).hexdigest()
+  if not keep_transcript:
+    transcript = None
+  return WalkthroughResult(story_path, script_path, transcript_hash,
+                           turns, instructions, seconds, error, transcript)
+
+
+class WalkthroughFarm(object):
+  """Replays walkthroughs across a pool of worker processes."""
+
+  def __init__(self, processes=None, seed=None, keep_transcripts=False):
+    """PROCESSES is the number of worker processes, by default one per
+    CPU; with a single process, walkthroughs are replayed in the
+    calling process.  SEED, if not None, seeds the random number
+    generator before each walkthrough.  KEEP_TRANSCRIPTS makes the
+    results carry the full output of the stories, not just its
+    hash."""
+    self._processes = processes or multiprocessing.cpu_count()
+    self._seed = seed
+    self._keep_transcripts = keep_transcripts
+
+  def run(self, jobs):
+    """Replay each (story_path, script_path) pair in JOBS, and yield
+    their WalkthroughResults in the order they finish."""
+    jobs = [(story_path, script_path, self._seed, self._keep_transcripts)
+            for story_path, script_path in jobs]
+    if self._processes == 1:
+      for job in jobs:
+        yield _run_job(job)
+      return
+
+    pool = multiprocessing.Pool(self._processes)
+    try:
+      for result in pool.imap_unordered(_run_job, jobs):
+        yield result
+    finally:
+      pool.terminate()
+      pool.join()
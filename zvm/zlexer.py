@@ -21,8 +21,8 @@ class ZLexerError(Exception):
 # O(1) lookups of unicode words, rather than O(N) lookups of
 # zscii-encoded words.
 
-# Note that the main API here (tokenise_input()) can work with any
-# dictionary, not just the standard one.
+# Note that the main APIs here (parse_input() and tokenise_input())
+# can work with any dictionary, not just the standard one.
 
 class ZLexer(object):
 
@@ -138,3 +138,33 @@ class ZLexer(object):
       final_list.append([word, byte_addr])
 
     return final_list
+
+
+  def tokenise_input(self, string, dict_addr=None):
+    """Like parse_input(), but return a list of (word,
+    byte_address_of_word_in_dictionary, position) tuples, where
+    position is the index of the start of the word in STRING, as the
+    'read' opcodes need to fill in a parse buffer.
+
+    Words are looked up with only as many letters as the dictionary
+    keeps: 6 in versions 1 to 3, and 9 afterwards."""
+
+    if dict_addr is None:
+      zseparators = self._separators
+      dict = self._dict
+    else:
+      num_entries, entry_length, zseparators, addr = \
+                   self._parse_dict_header(dict_addr)
+      dict = self.get_dictionary(dict_addr)
+
+    separators = ''.join([re.escape(self._zsciitranslator.ztou(code))
+                          for code in zseparators])
+    if separators:
+      regex = r"[%s]|[^\s%s]+" % (separators, separators)
+    else:
+      regex = r"\S+"
+    resolution = 6 if self._memory.version <= 3 else 9
+
+    return [(match.group(), dict.get(match.group()[:resolution], 0),
+             match.start())
+            for match in re.finditer(regex, string)]
@@ -4,37 +4,72 @@
 # dumping is no longer adequate. This logging facility, based on
 # python's logging module, provides file logging.
 #
+# Importing this module performs no I/O.  The log files are only
+# opened once debugging is switched on with set_debug(), so processes
+# which never debug don't pay for (or contend over) them.
+#
 
 import logging
+import os
 
-# Top-level initialization
-logging.getLogger().setLevel(logging.DEBUG)
-
-# Create the logging objects regardless.  If debugmode is False, then
-# they won't actually do anything when used.
-mainlog = logging.FileHandler('debug.log', 'a')
-mainlog.setLevel(logging.DEBUG)
-mainlog.setFormatter(logging.Formatter('%(asctime)s: %(message)s'))
-logging.getLogger('mainlog').addHandler(mainlog)
-
-# We'll store the disassembly in a separate file, for better
-# readability.
-disasm = logging.FileHandler('disasm.log', 'a')
-disasm.setLevel(logging.DEBUG)
-disasm.setFormatter(logging.Formatter('%(message)s'))
-logging.getLogger('disasm').addHandler(disasm)
+# Default locations of the log files, relative to the current
+# directory.
+DEFAULT_MAINLOG_PATH = 'debug.log'
+DEFAULT_DISASM_PATH = 'disasm.log'
 
 mainlog = logging.getLogger('mainlog')
-mainlog.info('*** Log reopened ***')
 disasm = logging.getLogger('disasm')
-disasm.info('*** Log reopened ***')
+
+# The disassembly goes to a separate file, for better readability.
+_FORMATS = {
+  mainlog: '%(asctime)s: %(message)s',
+  disasm: '%(message)s',
+  }
+
+# Until debugging is turned on, the loggers drop everything without
+# formatting it, and never hand records to the application's root
+# logger.
+for _logger in _FORMATS:
+  _logger.setLevel(logging.CRITICAL)
+  _logger.propagate = False
+
+def _close_handlers(logger):
+  for handler in list(logger.handlers):
+    logger.removeHandler(handler)
+    handler.close()
+
+def _open_handler(logger, path):
+  """Make sure LOGGER writes to the file at PATH, (re)opening its
+  handler if it isn't already doing so."""
+
+  for handler in logger.handlers:
+    if handler.baseFilename == os.path.abspath(path):
+      return
+  _close_handlers(logger)
+  handler = logging.FileHandler(path, 'a')
+  handler.setLevel(logging.DEBUG)
+  handler.setFormatter(logging.Formatter(_FORMATS[logger]))
+  logger.addHandler(handler)
+  logger.setLevel(logging.DEBUG)
+  logger.info('*** Log reopened ***')
 
 # Pubilc routines used by other modules
-def set_debug(state):
+def set_debug(state, mainlog_path=None, disasm_path=None):
+  """Turn debug logging on or off.
+
+  When STATE is true the main log and the disassembly are appended to
+  MAINLOG_PATH and DISASM_PATH (by default 'debug.log' and
+  'disasm.log' in the current directory); the files are opened the
+  first time they are needed, and reopened if the paths change.  When
+  STATE is false any open log files are closed."""
+
   if state:
-    logging.getLogger().setLevel(logging.DEBUG)
+    _open_handler(mainlog, mainlog_path or DEFAULT_MAINLOG_PATH)
+    _open_handler(disasm, disasm_path or DEFAULT_DISASM_PATH)
   else:
-    logging.getLogger().setLevel(logging.CRITICAL)
+    for logger in _FORMATS:
+      _close_handlers(logger)
+      logger.setLevel(logging.CRITICAL)
 
 def log(msg):
   mainlog.debug(msg)
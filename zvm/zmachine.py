@@ -7,11 +7,14 @@
 
 from .zstring import ZStringFactory
 from .zmemory import ZMemory
-from .zopdecoder import ZOpDecoder
+from .zopdecoder import ZOpDecoder, ZTracingOpDecoder
 from .zstackmanager import ZStackManager
 from .zobjectparser import ZObjectParser
-from .zcpu import ZCpu
+from .zcpu import ZCpu, ZTracingCpu
+from .zundo import ZUndoBuffer, DEFAULT_UNDO_DEPTH
 from .zstreammanager import ZStreamManager
+from .zstringindex import (ZStringIndex, PRECOMPILE_EAGER,
+                           PRECOMPILE_BACKGROUND)
 from . import zlogging
 
 class ZMachineError(Exception):
@@ -20,22 +23,81 @@ class ZMachineError(Exception):
 class ZMachine(object):
   """The Z-Machine black box."""
 
-  def __init__(self, story, ui, debugmode=False):
-    zlogging.set_debug(debugmode)
-    self._pristine_mem = ZMemory(story) # the original memory image
-    self._mem = ZMemory(story) # the memory image which changes during play
+  def __init__(self, story, ui, debugmode=False, debug_log=None,
+               disasm_log=None, precompile_strings=None, zmem=None,
+               mirror_objects=False, undo_depth=DEFAULT_UNDO_DEPTH,
+               undo_max_bytes=None):
+    # In debug mode the logs go to DEBUG_LOG and DISASM_LOG, or to
+    # zlogging's default files when those aren't given.  The logs are
+    # shared by all the machines, so a machine which isn't in debug
+    # mode leaves them alone rather than closing another's.
+    if debugmode:
+      zlogging.set_debug(True, debug_log, disasm_log)
+    # Instruction tracing is only built into the machine in debug
+    # mode, so that normal play never pays for logging.
+    if debugmode:
+      opdecoder_class, cpu_class = ZTracingOpDecoder, ZTracingCpu
+    else:
+      opdecoder_class, cpu_class = ZOpDecoder, ZCpu
+    # STORY is either the bytes of a story file, or a ZMemory holding
+    # its pristine image, which may be shared by many machines as it
+    # is never modified.
+    if isinstance(story, ZMemory):
+      self._pristine_mem = story # the original memory image
+    else:
+      self._pristine_mem = ZMemory(story)
+    # the memory image which changes during play: ZMEM if given,
+    # which must start out identical to the pristine image, or else a
+    # private copy of it
+    if zmem is None:
+      zmem = self._pristine_mem.copy()
+    self._mem = zmem
     self._stringfactory = ZStringFactory(self._mem)
-    self._objectparser = ZObjectParser(self._mem)
+    # Optionally mirror the object tree in flat arrays, for faster
+    # tree traversal (see ZObjectTreeMirror).
+    self._objectparser = ZObjectParser(self._mem, self._stringfactory,
+                                       mirror_tree=mirror_objects)
+    # Optionally pre-decode the story's strings, either right now
+    # (PRECOMPILE_EAGER) or in a background thread
+    # (PRECOMPILE_BACKGROUND).
+    self._stringindex = None
+    if precompile_strings is not None:
+      self._stringindex = ZStringIndex(self._mem, self._stringfactory)
+      if precompile_strings == PRECOMPILE_EAGER:
+        self._stringindex.build()
+      elif precompile_strings == PRECOMPILE_BACKGROUND:
+        self._stringindex.build_in_background()
+      else:
+        raise ZMachineError("Unknown string precompilation mode %r"
+                            % precompile_strings)
     self._stackmanager = ZStackManager(self._mem)
-    self._opdecoder = ZOpDecoder(self._mem, self._stackmanager)
+    self._opdecoder = opdecoder_class(self._mem, self._stackmanager)
     self._opdecoder.program_counter = self._mem.read_word(0x06)
     self._ui = ui
     self._stream_manager = ZStreamManager(self._mem, self._ui)
-    self._cpu = ZCpu(self._mem, self._opdecoder, self._stackmanager,
-                     self._objectparser, self._stringfactory,
-                     self._stream_manager, self._ui)
+    # Keep up to UNDO_DEPTH snapshots for save_undo, taking at most
+    # UNDO_MAX_BYTES if not None; with a depth of 0, undo is not
+    # available to the story.
+    self._undo = None
+    if undo_depth:
+      self._undo = ZUndoBuffer(self._mem, self._stackmanager, undo_depth,
+                               undo_max_bytes)
+    self._cpu = cpu_class(self._mem, self._opdecoder, self._stackmanager,
+                          self._objectparser, self._stringfactory,
+                          self._stream_manager, self._ui, self._undo)
 
   #--------- Public APIs -----------
 
   def run(self):
     return self._cpu.run()
+
+  def step(self, max_instructions=None, input=None):
+    """Run the story until it asks for input or stops, or for at most
+    MAX_INSTRUCTIONS instructions, and return a zcpu.ZStepResult.  See
+    ZCpu.step()."""
+    return self._cpu.step(max_instructions, input)
+
+  def set_turn_budget(self, instructions=None, seconds=None):
+    """Limit the instructions each turn may execute, and the seconds
+    it may spend executing them.  See ZCpu.set_turn_budget()."""
+    self._cpu.set_turn_budget(instructions, seconds)
@@ -5,7 +5,9 @@
 # root directory of this distribution.
 #
 
-from . import bitfield
+import copy
+from array import array
+
 from .zlogging import log
 
 # This class that represents the "main memory" of the z-machine.  It's
@@ -47,6 +49,26 @@ class ZMemoryUnsupportedVersion(ZMemoryError):
   pass
 
 
+# Writes are tracked by pages of PAGE_SIZE bytes: every write marks
+# its pages dirty, and only looks for the watches it lands in if its
+# page is covered by a watch.
+PAGE_SHIFT = 8
+PAGE_SIZE = 1 << PAGE_SHIFT
+
+
+class ZMemoryWatch(object):
+  """A watch on the addresses from START up to END of a ZMemory,
+  returned by ZMemory.watch().  A write landing in the watched range
+  sets DIRTY, which the owner of the watch may clear again, and calls
+  CALLBACK, if not None, with the address and length of the write."""
+
+  def __init__(self, start, end, callback=None):
+    self.start = start
+    self.end = end
+    self.callback = callback
+    self.dirty = False
+
+
 class ZMemory(object):
 
   # A list of 64 tuples describing who's allowed to tweak header-bytes.
@@ -85,8 +107,11 @@ class ZMemory(object):
     # Copy string into a _memory sequence that represents main memory.
     self._total_size = len(initial_string)
     self._memory = bytearray(initial_string)
+    self._static = self._memory
 
-    # Figure out the different sections of memory
+    # Figure out the different sections of memory.  The header is read
+    # as a whole, before the start of static memory is known.
+    self._static_start = self._total_size
     self._static_start = self.read_word(0x0e)
     self._static_end = min(0x0ffff, self._total_size)
     self._dynamic_start = 0
@@ -114,6 +139,27 @@ class ZMemory(object):
     else:
       raise ZMemoryUnsupportedVersion
 
+    # The interpreter's own components (the decoder, CPU, object
+    # parser and string decoder) read memory through this trusted
+    # surface rather than the checked sequence API: 'raw' is the
+    # bytearray holding main memory, and the region limits are plain
+    # integers.  Readers validate their address range once per
+    # operation, with check_range() or by catching IndexError, instead
+    # of once per byte.  Nothing may write through 'raw', as that
+    # would bypass the static memory and header protections.
+    #
+    # Static and high memory are read from 'static_raw' instead, which
+    # is 'raw' itself unless this memory is a copy made with
+    # copy(share_static=True).  Such a copy only holds dynamic memory
+    # in 'raw', and reads the rest from the memory it was copied from.
+    self.raw = self._memory
+    self.static_raw = self._memory
+    self.size = self._total_size
+    self.static_start = self._static_start
+    self.high_start = self._high_start
+
+    self._init_write_tracking()
+
     log("Memory system initialized, map follows")
     log("  Dynamic memory: %x - %x" % (self._dynamic_start, self._dynamic_end))
     log("  Static memory: %x - %x" % (self._static_start, self._static_end))
@@ -129,16 +175,111 @@ class ZMemory(object):
       raise ZMemoryOutOfBounds
 
   def _check_static(self, index):
-    """Throw error if INDEX is within the static-memory area."""
+    """Throw error if INDEX, or any part of it if it is a slice, is
+    beyond dynamic memory."""
     if isinstance(index, slice):
-      start, stop = index.start, index.stop
+      # A slice starting in dynamic memory may still run into static
+      # memory.
+      start, last = index.start, index.stop - 1
     else:
-      start, stop = index, index
-    if (
-      self._static_start <= start <= self._static_end
-      and self._static_start <= stop <= self._static_end
-    ):
-      raise ZMemoryIllegalWrite(index)
+      start = last = index
+    if last >= self._static_start:
+      raise ZMemoryIllegalWrite(max(start, self._static_start))
+
+  def copy(self, share_static=False):
+    """Return a new ZMemory holding a private copy of this memory
+    image, without parsing and validating its header again.
+
+    If SHARE_STATIC is true, only dynamic memory is copied, and the
+    copy reads static and high memory from this memory's buffer, which
+    must then never be written to."""
+    new_mem = copy.copy(self)
+    if share_static or self._static is not self._memory:
+      buffer = bytearray(self._memory[:self._static_start])
+    else:
+      buffer = bytearray(self._memory)
+      new_mem._static = buffer
+      new_mem.static_raw = buffer
+    new_mem._memory = buffer
+    new_mem.raw = buffer
+    # Watches and dirty pages are of this memory only, not of its
+    # copies.
+    new_mem._init_write_tracking()
+    return new_mem
+
+  def _init_write_tracking(self):
+    num_pages = (self._total_size >> PAGE_SHIFT) + 1
+    self._watches = []
+    # The number of watches covering each page of memory.
+    self._watched_pages = array('H', [0] * num_pages)
+    # 1 for each page of memory written since the dirty pages were
+    # last cleared.
+    self._dirty_pages = bytearray(num_pages)
+
+  def get_dirty_pages(self):
+    """Return a list of the numbers of the pages written since the
+    dirty pages were last cleared, or since this memory was created.
+    Page N holds the PAGE_SIZE bytes starting at address N*PAGE_SIZE.
+
+    All writes through this class are seen, but writes to 'raw' are
+    not.  Only dynamic memory and the header can be written, so the
+    dirty pages all end before static memory starts."""
+    dirty = self._dirty_pages
+    pages = []
+    page = dirty.find(1)
+    while page != -1:
+      pages.append(page)
+      page = dirty.find(1, page + 1)
+    return pages
+
+  def clear_dirty_pages(self):
+    """Mark all pages of memory clean."""
+    for page in self.get_dirty_pages():
+      self._dirty_pages[page] = 0
+
+  def _mark_dirty(self, address, length):
+    """Mark dirty the pages of a write of LENGTH bytes at ADDRESS."""
+    for page in range(address >> PAGE_SHIFT,
+                      ((address + length - 1) >> PAGE_SHIFT) + 1):
+      self._dirty_pages[page] = 1
+
+  def watch(self, start, end, callback=None):
+    """Watch the addresses from START up to END for writes, and return
+    a ZMemoryWatch.  Writes landing in the range set the watch's dirty
+    flag, and call CALLBACK(address, length) if it isn't None.
+
+    All writes through this class are seen, but writes to 'raw' are
+    not.  While any watch is set, writes to pages without watches cost
+    one lookup in a table of pages."""
+    if not (0 <= start < end <= self._total_size):
+      raise ZMemoryOutOfBounds
+    watch = ZMemoryWatch(start, end, callback)
+    self._watches.append(watch)
+    for page in range(start >> PAGE_SHIFT, ((end - 1) >> PAGE_SHIFT) + 1):
+      self._watched_pages[page] += 1
+    return watch
+
+  def unwatch(self, watch):
+    """Stop watching for writes with the ZMemoryWatch WATCH."""
+    self._watches.remove(watch)
+    for page in range(watch.start >> PAGE_SHIFT,
+                      ((watch.end - 1) >> PAGE_SHIFT) + 1):
+      self._watched_pages[page] -= 1
+
+  def _written(self, address, length):
+    """Notify the watches of a write of LENGTH bytes at ADDRESS."""
+    end = address + length
+    for watch in self._watches:
+      if address < watch.end and watch.start < end:
+        watch.dirty = True
+        if watch.callback is not None:
+          watch.callback(address, length)
+
+  def check_range(self, address, length=1):
+    """Raise ZMemoryOutOfBounds unless the LENGTH bytes starting at
+    ADDRESS are all within memory."""
+    if address < 0 or address + length > self._total_size:
+      raise ZMemoryOutOfBounds
 
   def print_map(self):
     """Pretty-print a description of the memory map."""
@@ -149,27 +290,53 @@ class ZMemory(object):
   def __getitem__(self, index):
     """Return the byte value stored at address INDEX.."""
     self._check_bounds(index)
-    return self._memory[index]
+    if isinstance(index, slice):
+      return self._read_bytes(index.start, index.stop)
+    if index < self._static_start:
+      return self._memory[index]
+    return self._static[index]
+
+  def _read_bytes(self, start, stop):
+    """Return the bytes from START up to STOP."""
+    static_start = self._static_start
+    if stop <= static_start:
+      return self._memory[start:stop]
+    if start >= static_start:
+      return self._static[start:stop]
+    return (bytes(self._memory[start:static_start])
+            + bytes(self._static[static_start:stop]))
 
   def __setitem__(self, index, value):
     """Set VALUE in memory address INDEX."""
     self._check_bounds(index)
     self._check_static(index)
-    self._memory[index] = value
+    if isinstance(index, slice):
+      value = bytes(value)
+      self._memory[index] = value
+      self._mark_dirty(index.start, len(value))
+      if self._watches:
+        self._written(index.start, len(value))
+    else:
+      self._memory[index] = value
+      self._dirty_pages[index >> PAGE_SHIFT] = 1
+      if self._watches and self._watched_pages[index >> PAGE_SHIFT]:
+        self._written(index, 1)
 
   def __getslice__(self, start, end):
     """Return a sequence of bytes from memory."""
     self._check_bounds(start)
     self._check_bounds(end)
-    return self._memory[start:end]
+    return self._read_bytes(start, end)
 
   def __setslice__(self, start, end, sequence):
     """Set a range of memory addresses to SEQUENCE."""
     self._check_bounds(start)
     self._check_bounds(end - 1)
-    self._check_static(start)
-    self._check_static(end - 1)
+    self._check_static(slice(start, end))
     self._memory[start:end] = sequence
+    self._mark_dirty(start, end - start)
+    if self._watches:
+      self._written(start, end - start)
 
   def word_address(self, address):
     """Return the 'actual' address of word address ADDRESS."""
@@ -194,7 +361,13 @@ class ZMemory(object):
     """Return the 16-bit value stored at ADDRESS, ADDRESS+1."""
     if address < 0 or address >= (self._total_size - 1):
       raise ZMemoryOutOfBounds
-    return (self._memory[address] << 8) + self._memory[(address + 1)]
+    if address + 1 < self._static_start:
+      memory = self._memory
+      return (memory[address] << 8) + memory[address + 1]
+    if address >= self._static_start:
+      memory = self._static
+      return (memory[address] << 8) + memory[address + 1]
+    return (self._memory[address] << 8) + self._static[address + 1]
 
   def write_word(self, address, value):
     """Write the given 16-bit value at ADDRESS, ADDRESS+1."""
@@ -209,8 +382,18 @@ class ZMemory(object):
       self.game_set_header(address, value_msb)
       self.game_set_header(address+1, value_lsb)
     else:
+      if address + 1 >= self._static_start:
+        raise ZMemoryIllegalWrite(address)
       self._memory[address] = value_msb
       self._memory[address+1] = value_lsb
+      dirty = self._dirty_pages
+      dirty[address >> PAGE_SHIFT] = 1
+      dirty[(address + 1) >> PAGE_SHIFT] = 1
+      if self._watches:
+        pages = self._watched_pages
+        if (pages[address >> PAGE_SHIFT]
+            or pages[(address + 1) >> PAGE_SHIFT]):
+          self._written(address, 2)
 
   # Normal sequence syntax cannot be used to set bytes in the 64-byte
   # header.  Instead, the interpreter or game must call one of the
@@ -225,6 +408,9 @@ class ZMemory(object):
       raise ZMemoryIllegalWrite(address)
     if self.version >= perm_tuple[0] and perm_tuple[2]:
       self._memory[address] = value
+      self._dirty_pages[0] = 1
+      if self._watches and self._watched_pages[0]:
+        self._written(address, 1)
     else:
       raise ZMemoryIllegalWrite(address)
 
@@ -237,6 +423,9 @@ class ZMemory(object):
       raise ZMemoryIllegalWrite(address)
     if self.version >= perm_tuple[0] and perm_tuple[1]:
       self._memory[address] = value
+      self._dirty_pages[0] = 1
+      if self._watches and self._watched_pages[0]:
+        self._written(address, 1)
     else:
       raise ZMemoryIllegalWrite(address)
 
@@ -258,11 +447,17 @@ class ZMemory(object):
       raise ZMemoryOutOfBounds
     if not (0x00 <= value <= 0xFFFF):
       raise ZMemoryIllegalWrite(value)
-    log("Write %d to global variable %d" % (value, varnum))
     actual_address = self._global_variable_start + ((varnum - 0x10) * 2)
-    bf = bitfield.BitField(value)
-    self._memory[actual_address] = bf[8:15]
-    self._memory[actual_address + 1] = bf[0:7]
+    self._memory[actual_address] = value >> 8
+    self._memory[actual_address + 1] = value & 0xFF
+    dirty = self._dirty_pages
+    dirty[actual_address >> PAGE_SHIFT] = 1
+    dirty[(actual_address + 1) >> PAGE_SHIFT] = 1
+    if self._watches:
+      pages = self._watched_pages
+      if (pages[actual_address >> PAGE_SHIFT]
+          or pages[(actual_address + 1) >> PAGE_SHIFT]):
+        self._written(actual_address, 2)
 
   # The 'verify' opcode and the QueztalWriter class both need to have
   # a checksum of memory generated.
@@ -270,9 +465,4 @@ class ZMemory(object):
   def generate_checksum(self):
     """Return a checksum value which represents all the bytes of
     memory added from $0040 upwards, modulo $10000."""
-    count = 0x40
-    total = 0
-    while count < self._total_size:
-      total += self._memory[count]
-      count += 1
-    return (total % 0x10000)
+    return sum(self._read_bytes(0x40, self._total_size)) % 0x10000
@@ -13,10 +13,13 @@
 # a pointer to its "next sibling" in the list, and a pointer to the
 # head of its own children-list.
 
-from .bitfield import BitField
+from array import array
+
 from .zmemory import ZMemory
 from .zstring import ZStringFactory
 from .zlogging import log
+from .ztables import (PROPERTY_HEADERS_V3, PROPERTY_HEADERS_V4,
+                      PROPERTY_SIZES_V4)
 
 
 class ZObjectError(Exception):
@@ -52,23 +55,128 @@ class ZObjectMalformedTree(ZObjectError):
   pass
 
 
+class ZObjectTreeMirror(object):
+  """A copy of the parent, sibling and child pointers and the
+  attributes of every object, in one flat array per field, indexed by
+  object number.  Reading these from the mirror costs a single
+  lookup, instead of locating the object entry in memory and decoding
+  its fields.
+
+  The mirror watches the object entries in memory (see
+  ZMemory.watch()), and copies each entry again when it is written, so
+  that it stays in sync with memory."""
+
+  def __init__(self, zmem, objecttree_addr, object_size):
+    self._raw = zmem.raw
+    self._objecttree_addr = objecttree_addr
+    self._object_size = object_size
+    if object_size == 9:
+      self._pointer_offset = 4
+      self.attribute_bits = 32
+    else:
+      self._pointer_offset = 6
+      self.attribute_bits = 48
+
+    # The object table has no count of its objects, but the property
+    # tables follow the object entries, so the entries end where the
+    # first property table starts.
+    self.count = 0
+    table_end = zmem.static_start
+    addr = objecttree_addr
+    while addr + object_size <= table_end:
+      proptable_addr = ((self._raw[addr + object_size - 2] << 8)
+                        + self._raw[addr + object_size - 1])
+      if proptable_addr < addr + object_size:
+        break
+      table_end = min(table_end, proptable_addr)
+      self.count += 1
+      addr += object_size
+    self._table_end = objecttree_addr + self.count * object_size
+
+    # Slot 0 is the absent object 'nothing'.
+    size = self.count + 1
+    self.parent = array('H', [0] * size)
+    self.sibling = array('H', [0] * size)
+    self.child = array('H', [0] * size)
+    self.attributes = array('Q', [0] * size)
+    for objectnum in range(1, size):
+      self._load(objectnum)
+    self._watch = None
+    if self.count:
+      self._watch = zmem.watch(objecttree_addr, self._table_end,
+                               self.written)
+
+  def _load(self, objectnum):
+    """Copy the entry of object OBJECTNUM from memory."""
+    raw = self._raw
+    addr = self._objecttree_addr + (objectnum - 1) * self._object_size
+    attributes = 0
+    pointers = addr + self._pointer_offset
+    for i in range(addr, pointers):
+      attributes = (attributes << 8) + raw[i]
+    self.attributes[objectnum] = attributes
+    if self._object_size == 9:
+      self.parent[objectnum] = raw[pointers]
+      self.sibling[objectnum] = raw[pointers + 1]
+      self.child[objectnum] = raw[pointers + 2]
+    else:
+      self.parent[objectnum] = (raw[pointers] << 8) + raw[pointers + 1]
+      self.sibling[objectnum] = ((raw[pointers + 2] << 8)
+                                 + raw[pointers + 3])
+      self.child[objectnum] = ((raw[pointers + 4] << 8)
+                               + raw[pointers + 5])
+
+  def written(self, address, length=1):
+    """Bring the mirror up to date with a write of LENGTH bytes to
+    memory at ADDRESS."""
+    start = max(address, self._objecttree_addr)
+    end = min(address + length, self._table_end)
+    if start >= end:
+      return
+    first = (start - self._objecttree_addr) // self._object_size + 1
+    last = (end - 1 - self._objecttree_addr) // self._object_size + 1
+    for objectnum in range(first, last + 1):
+      self._load(objectnum)
+
+
 # The interpreter should only need exactly one instance of this class.
 
 class ZObjectParser(object):
 
-  def __init__(self, zmem):
+  def __init__(self, zmem, stringfactory=None, mirror_tree=False):
+    """If MIRROR_TREE is true, keep a ZObjectTreeMirror of the object
+    tree, and read the objects' relatives and attributes from it."""
 
     self._memory = zmem
+    self._raw = zmem.raw
     self._propdefaults_addr = zmem.read_word(0x0a)
-    self._stringfactory = ZStringFactory(self._memory)
+    if stringfactory is None:
+      stringfactory = ZStringFactory(self._memory)
+    self._stringfactory = stringfactory
 
     if 1 <= self._memory.version <= 3:
       self._objecttree_addr = self._propdefaults_addr + 62
+      self._object_size = 9
     elif 4 <= self._memory.version <= 5:
       self._objecttree_addr = self._propdefaults_addr + 126
+      self._object_size = 14
     else:
       raise ZObjectIllegalVersion
 
+    # The layout of each object's property table, built the first time
+    # one of its properties is looked up.  Maps an object number to a
+    # dictionary of its property numbers to (addr, len) tuples of
+    # their values, and to a tuple of its property numbers, in the
+    # order of the table.  Only the values of properties can change,
+    # never the table's layout.
+    self._property_index = {}
+    self._property_order = {}
+
+    self._mirror = None
+    if mirror_tree:
+      self._mirror = ZObjectTreeMirror(zmem, self._objecttree_addr,
+                                       self._object_size)
+
 
   def _get_object_addr(self, objectnum):
     """Return address of object number OBJECTNUM."""
@@ -86,7 +194,9 @@ class ZObjectParser(object):
     else:
       raise ZObjectIllegalVersion
 
-    log("address of object %d is %d" % (objectnum, result))
+    # Range check the whole entry once, so that its fields can be
+    # read straight from raw memory.
+    self._memory.check_range(result, self._object_size)
     return result
 
 
@@ -98,18 +208,17 @@ class ZObjectParser(object):
     result = 0
     if 1 <= self._memory.version <= 3:
       addr += 4  # skip past attributes
-      result = self._memory[addr:addr+3]
+      result = self._raw[addr:addr+3]
 
     elif 4 <= self._memory.version <= 5:
       addr += 6  # skip past attributes
-      result = [self._memory.read_word(addr),
-                self._memory.read_word(addr + 2),
-                self._memory.read_word(addr + 4)]
+      raw = self._raw
+      result = [(raw[addr] << 8) + raw[addr + 1],
+                (raw[addr + 2] << 8) + raw[addr + 3],
+                (raw[addr + 4] << 8) + raw[addr + 5]]
     else:
       raise ZObjectIllegalVersion
 
-    log ("parent/sibling/child of object %d is %d, %d, %d" %
-         (objectnum, result[0], result[1], result[2]))
     return result
     
 
@@ -126,7 +235,9 @@ class ZObjectParser(object):
     else:
       raise ZObjectIllegalVersion
 
-    return self._memory.read_word(addr)
+    proptable_addr = (self._raw[addr] << 8) + self._raw[addr + 1]
+    self._memory.check_range(proptable_addr)
+    return proptable_addr
 
   def _get_default_property_addr(self, propnum):
     """Return address of default value for property PROPNUM."""
@@ -145,6 +256,51 @@ class ZObjectParser(object):
     return (addr + (2 * (propnum - 1)))
 
 
+  def _read_property_header(self, addr):
+    """Decode the property header at address ADDR, and return a
+    (propnum, size, value_addr) tuple for the property."""
+
+    if 1 <= self._memory.version <= 3:
+      pnum, size = PROPERTY_HEADERS_V3[self._raw[addr]]
+      return (pnum, size, addr + 1)
+
+    elif 4 <= self._memory.version <= 5:
+      pnum, size = PROPERTY_HEADERS_V4[self._raw[addr]]
+      if size is None:
+        size = PROPERTY_SIZES_V4[self._raw[addr + 1]]
+        return (pnum, size, addr + 2)
+      return (pnum, size, addr + 1)
+
+    else:
+      raise ZObjectIllegalVersion
+
+
+  def _index_properties(self, objectnum):
+    """Parse the property table of object OBJECTNUM into the property
+    index, and return its dictionary of property numbers to (addr,
+    len) tuples."""
+
+    proplist = {}
+    order = []
+
+    # start at the beginning of the object's proptable
+    addr = self._get_proptable_addr(objectnum)
+    # skip past the shortname of the object
+    shortname_length = self._raw[addr]
+    addr += 1
+    addr += (2*shortname_length)
+
+    while self._raw[addr] != 0:
+      pnum, size, addr = self._read_property_header(addr)
+      proplist[pnum] = (addr, size)
+      order.append(pnum)
+      addr += size
+
+    self._property_index[objectnum] = proplist
+    self._property_order[objectnum] = tuple(order)
+    return proplist
+
+
   #--------- Public APIs -----------
 
   def get_attribute(self, objectnum, attrnum):
@@ -156,17 +312,21 @@ class ZObjectParser(object):
     if 1 <= self._memory.version <= 3:
       if not (0 <= attrnum <= 31):
         raise ZObjectIllegalAttributeNumber
-      bf = BitField(self._memory[object_addr + (attrnum / 8)])
 
     elif 4 <= self._memory.version <= 5:
       if not (0 <= attrnum <= 47):
         raise ZObjectIllegalAttributeNumber
-      bf = BitField(self._memory[object_addr + (attrnum / 8)])
 
     else:
       raise ZObjectIllegalVersion
 
-    return bf[7 - (attrnum % 8)]
+    mirror = self._mirror
+    if mirror is not None and objectnum <= mirror.count:
+      return (mirror.attributes[objectnum]
+              >> (mirror.attribute_bits - 1 - attrnum)) & 1
+
+    attr_byte = self._raw[object_addr + (attrnum // 8)]
+    return (attr_byte >> (7 - (attrnum % 8))) & 1
 
 
   def get_all_attributes(self, objectnum):
@@ -191,6 +351,9 @@ class ZObjectParser(object):
   def get_parent(self, objectnum):
     """Return object number of parent of object number OBJECTNUM."""
 
+    mirror = self._mirror
+    if mirror is not None and 0 < objectnum <= mirror.count:
+      return mirror.parent[objectnum]
     [parent, sibling, child] = self._get_parent_sibling_child(objectnum)
     return parent
 
@@ -198,6 +361,9 @@ class ZObjectParser(object):
   def get_child(self, objectnum):
     """Return object number of child of object number OBJECTNUM."""
 
+    mirror = self._mirror
+    if mirror is not None and 0 < objectnum <= mirror.count:
+      return mirror.child[objectnum]
     [parent, sibling, child] = self._get_parent_sibling_child(objectnum)
     return child
 
@@ -205,6 +371,9 @@ class ZObjectParser(object):
   def get_sibling(self, objectnum):
     """Return object number of sibling of object number OBJECTNUM."""
 
+    mirror = self._mirror
+    if mirror is not None and 0 < objectnum <= mirror.count:
+      return mirror.sibling[objectnum]
     [parent, sibling, child] = self._get_parent_sibling_child(objectnum)
     return sibling
 
@@ -245,39 +414,51 @@ class ZObjectParser(object):
       raise ZObjectIllegalVersion
 
 
-  def insert_object(self, parent_object, new_child):
-    """Prepend object NEW_CHILD to the list of PARENT_OBJECT's children."""
-
-    # Remember all the original pointers within the new_child
-    [p, s, c] = self._get_parent_sibling_child(new_child)
-
-    # First insert new_child intto the parent_object
-    original_child = self.get_child(parent_object)
-    self.set_sibling(new_child, original_child)
-    self.set_parent(new_child, parent_object)
-    self.set_child(parent_object, new_child)
+  def remove_object(self, objectnum):
+    """Detach object OBJECTNUM from its parent, along with its
+    children."""
 
-    if p == 0:  # no need to 'remove' new_child, since it wasn't in a tree
+    [p, s, c] = self._get_parent_sibling_child(objectnum)
+    if p == 0:  # no need to 'remove' the object, since it isn't in a tree
       return
 
-    # Hunt down and remove the new_child from its old location
+    # Hunt down and remove the object from its parent's children
     item = self.get_child(p)
     if item == 0:
-      # new_object claimed to have parent p, but p has no children!?
+      # the object claimed to have parent p, but p has no children!?
       raise ZObjectMalformedTree
-    elif item == new_child:  # done!  new_object was head of list
+    elif item == objectnum:  # done!  the object was head of list
       self.set_child(p, s) # note that s might be 0, that's fine.
     else: # walk across list of sibling links
       prev = item
       current = self.get_sibling(item)
       while current != 0:
-        if current == new_child:
+        if current == objectnum:
           self.set_sibling(prev, s) # s might be 0, that's fine.
           break
+        prev = current
+        current = self.get_sibling(current)
       else:
         # we reached the end of the list, never got a match
         raise ZObjectMalformedTree
 
+    self.set_parent(objectnum, 0)
+    self.set_sibling(objectnum, 0)
+
+
+  def insert_object(self, parent_object, new_child):
+    """Prepend object NEW_CHILD to the list of PARENT_OBJECT's children."""
+
+    # Take new_child out of its old location first, as that may be
+    # the list of parent_object itself.
+    self.remove_object(new_child)
+
+    # Then insert new_child into the parent_object
+    original_child = self.get_child(parent_object)
+    self.set_sibling(new_child, original_child)
+    self.set_parent(new_child, parent_object)
+    self.set_child(parent_object, new_child)
+
 
   def get_shortname(self, objectnum):
     """Return 'short name' of object number OBJECTNUM as ascii string."""
@@ -303,102 +484,69 @@ class ZObjectParser(object):
     object number OBJECTNUM.  If object has no such property, then
     return the address & length of the 'default' value for the property."""
 
-    # start at the beginning of the object's proptable
-    addr = self._get_proptable_addr(objectnum)
-    # skip past the shortname of the object
-    addr += (2 * self._memory[addr])
-    pnum = 0
-
-    if 1 <= self._memory.version <= 3:
-
-      while self._memory[addr] != 0:
-        bf = BitField(self._memory[addr])
-        addr += 1
-        pnum = bf[4:0]
-        size = bf[7:5] + 1
-        if pnum == propnum:
-          return (addr, size)
-        addr += size
-
-    elif 4 <= self._memory.version <= 5:
-
-      while self._memory[addr] != 0:
-        bf = BitField(self._memory[addr])
-        addr += 1
-        pnum = bf[5:0]
-        if bf[7]:
-          bf2 = BitField(self._memory[addr])
-          addr += 1
-          size = bf2[5:0]
-        else:
-          if bf[6]:
-            size = 2
-          else:
-            size = 1
-        if pnum == propnum:
-          return (addr, size)
-        addr += size
-
-    else:
-      raise ZObjectIllegalVersion
+    proplist = self._property_index.get(objectnum)
+    if proplist is None:
+      proplist = self._index_properties(objectnum)
+    prop = proplist.get(propnum)
+    if prop is not None:
+      return prop
 
     # property list ran out, so return default propval instead.
     default_value_addr = self._get_default_property_addr(propnum)
     return (default_value_addr, 2)
 
 
+  def get_prop_addr(self, objectnum, propnum):
+    """Return the address of the value of property PROPNUM of object
+    OBJECTNUM, or 0 if the object has no such property."""
+
+    proplist = self._property_index.get(objectnum)
+    if proplist is None:
+      proplist = self._index_properties(objectnum)
+    prop = proplist.get(propnum)
+    if prop is None:
+      return 0
+    return prop[0]
+
+
+  def get_next_prop(self, objectnum, propnum):
+    """Return the number of the property which follows property
+    PROPNUM in the property table of object OBJECTNUM, or 0 if PROPNUM
+    is the last one.  If PROPNUM is 0, return the number of the first
+    property of the object."""
+
+    order = self._property_order.get(objectnum)
+    if order is None:
+      self._index_properties(objectnum)
+      order = self._property_order[objectnum]
+    if propnum == 0:
+      index = 0
+    elif propnum in self._property_index[objectnum]:
+      index = order.index(propnum) + 1
+    else:
+      raise ZObjectIllegalPropertyNumber
+    if index < len(order):
+      return order[index]
+    return 0
+
+
   def get_all_properties(self, objectnum):
     """Return a dictionary of all properties listed in the property
     table of object OBJECTNUM.  (Obviously, this discounts 'default'
     property values.).  The dictionary maps property numbers to (addr,
     len) propval tuples."""
 
-    proplist = {}
-
-    # start at the beginning of the object's proptable
-    addr = self._get_proptable_addr(objectnum)
-    # skip past the shortname of the object
-    shortname_length = self._memory[addr]
-    addr += 1
-    addr += (2*shortname_length)
-
-    if 1 <= self._memory.version <= 3:
-      while self._memory[addr] != 0:
-        bf = BitField(self._memory[addr])
-        addr += 1
-        pnum = bf[4:0]
-        size = bf[7:5] + 1
-        proplist[pnum] = (addr, size)
-        addr += size
-
-    elif 4 <= self._memory.version <= 5:
-      while self._memory[addr] != 0:
-        bf = BitField(self._memory[addr])
-        addr += 1
-        pnum = bf[0:6]
-        if bf[7]:
-          bf2 = BitField(self._memory[addr])
-          addr += 1
-          size = bf2[0:6]
-          if size == 0:
-            size = 64
-        else:
-          if bf[6]:
-            size = 2
-          else:
-            size = 1
-        proplist[pnum] = (addr, size)
-        addr += size
-
-    else:
-      raise ZObjectIllegalVersion
-
-    return proplist
+    proplist = self._property_index.get(objectnum)
+    if proplist is None:
+      proplist = self._index_properties(objectnum)
+    return dict(proplist)
 
 
   def set_property(self, objectnum, propnum, value):
     """Set a property on an object."""
-    proplist = self.get_all_properties(objectnum)
+    proplist = self._property_index.get(objectnum)
+    if proplist is None:
+      proplist = self._index_properties(objectnum)
     if propnum not in proplist:
       raise ZObjectIllegalPropertyNumber
 
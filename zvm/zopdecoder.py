@@ -6,23 +6,19 @@
 # root directory of this distribution.
 #
 
-from .bitfield import BitField
-from .zmemory import ZMemory
+from .zmemory import ZMemory, ZMemoryOutOfBounds
 from .zlogging import log
+from .ztables import (OPCODE_0OP, OPCODE_1OP, OPCODE_2OP, OPCODE_VAR,
+                      OPCODE_EXT, LARGE_CONSTANT, SMALL_CONSTANT, VARIABLE,
+                      ABSENT, OPCODE_FORMS, OPERAND_TYPES, BRANCH_BYTES)
 
 class ZOperationError(Exception):
   "General exception for ZOperation class"
   pass
 
-# Constants defining the known instruction types. These types are
-# related to the number of operands the opcode has: for each operand
-# count, there is a separate opcode table, and the actual opcode
-# number is an index into that table.
-OPCODE_0OP = 0
-OPCODE_1OP = 1
-OPCODE_2OP = 2
-OPCODE_VAR = 3
-OPCODE_EXT = 4
+# The opcode classes (OPCODE_0OP, ...) and operand types
+# (LARGE_CONSTANT, ...) are defined in ztables along with the tables
+# that decode them.
 
 # Mapping of those constants to strings describing the opcode
 # classes. Used for pretty-printing only.
@@ -34,25 +30,134 @@ OPCODE_STRINGS = {
   OPCODE_EXT: 'EXT',
   }
 
-# Constants defining the possible operand types.
-LARGE_CONSTANT = 0x0
-SMALL_CONSTANT = 0x1
-VARIABLE = 0x2
-ABSENT = 0x3
+# Constants defining where the value of a predecoded operand comes
+# from. Constants are resolved once at decode time; the other kinds
+# must be fetched again every time the instruction is executed.
+OPERAND_CONSTANT = 0
+OPERAND_STACK = 1
+OPERAND_LOCAL = 2
+OPERAND_GLOBAL = 3
+
+# Mapping of those constants to strings describing where operand
+# values come from. Used for debug logging only.
+OPERAND_STRINGS = {
+  OPERAND_CONSTANT: 'constant',
+  OPERAND_STACK: 'stack',
+  OPERAND_LOCAL: 'local variable',
+  OPERAND_GLOBAL: 'global variable',
+  }
+
+# Opcodes which are followed by a store variable, a branch offset or
+# an inline z-string (section 14 of the spec). Each table maps an
+# opcode class to the opcode numbers carrying that trailer in all
+# versions; the few opcodes whose trailers change with the version
+# are sorted out in _get_trailer_tables().
+STORE_OPCODES = {
+  OPCODE_0OP: (),
+  OPCODE_1OP: (1, 2, 3, 4, 8, 14),
+  OPCODE_2OP: (8, 9, 15, 16, 17, 18, 19, 20, 21, 22, 23, 24, 25),
+  OPCODE_VAR: (0, 7, 12, 22, 23, 24),
+  OPCODE_EXT: (0, 1, 2, 3, 4, 9, 10, 12),
+  }
+
+BRANCH_OPCODES = {
+  OPCODE_0OP: (13, 15),
+  OPCODE_1OP: (0, 1, 2),
+  OPCODE_2OP: (1, 2, 3, 4, 5, 6, 7, 10),
+  OPCODE_VAR: (23, 31),
+  OPCODE_EXT: (),
+  }
+
+# The most bytes an instruction can take, not counting an inline
+# z-string: an 0xBE marker, an opcode number, two bytes of operand
+# types, eight word operands, a store variable and two bytes of branch
+# offset.
+MAX_INSTRUCTION_LENGTH = 23
+
+ZSTRING_OPCODES = {
+  OPCODE_0OP: (2, 3),
+  OPCODE_1OP: (),
+  OPCODE_2OP: (),
+  OPCODE_VAR: (),
+  OPCODE_EXT: (),
+  }
+
+
+def _get_trailer_tables(version):
+  """Return a dictionary mapping each opcode class to a list, indexed
+  by opcode number, of (store, branch, zstring) booleans describing
+  which trailers follow the operands of that opcode in the given
+  version of the Z-machine."""
+  store = dict((k, set(v)) for k, v in STORE_OPCODES.items())
+  branch = dict((k, set(v)) for k, v in BRANCH_OPCODES.items())
+
+  # save and restore branch up to v3, store in v4, and moved to EXT
+  # in v5.
+  if version <= 3:
+    branch[OPCODE_0OP].update((5, 6))
+  elif version == 4:
+    store[OPCODE_0OP].update((5, 6))
+  # 0OP:9 is pop before v5, and catch afterwards.
+  if version >= 5:
+    store[OPCODE_0OP].add(9)
+  # 1OP:15 is not before v5, and call_1n afterwards.
+  if version <= 4:
+    store[OPCODE_1OP].add(15)
+  # VAR:4 (read) only stores its terminating character from v5.
+  if version >= 5:
+    store[OPCODE_VAR].add(4)
+
+  tables = {}
+  for opcode_class in OPCODE_STRINGS:
+    size = 256 if opcode_class == OPCODE_EXT else 32
+    tables[opcode_class] = [(n in store[opcode_class],
+                             n in branch[opcode_class],
+                             n in ZSTRING_OPCODES[opcode_class])
+                            for n in range(size)]
+  return tables
+
 
 class ZOpDecoder(object):
   def __init__(self, zmem, zstack):
     ""
     self._memory = zmem
+    # The buffer the instruction being decoded is read from: static
+    # and high memory may be kept apart from dynamic memory (see
+    # ZMemory.static_raw).
+    self._raw = zmem.raw
+    self._dynamic_raw = zmem.raw
+    self._static_raw = zmem.static_raw
     self._stack = zstack
     self._parse_map = {}
     self.program_counter = self._memory.read_word(0x6)
 
+    # Decoded instructions, keyed by the address of their opcode
+    # byte. Only instructions that start in static or high memory
+    # are cached, as those can never be modified by the story.
+    self._instruction_cache = {}
+    self._cache_start = self._memory.static_start
+    self._trailers = _get_trailer_tables(self._memory.version)
+
+    # The trailers of the instruction currently being executed.
+    self._store_address = None
+    self._branch = None
+    self._zstring = None
+
   def _get_pc(self):
-    byte = self._memory[self.program_counter]
+    byte = self._raw[self.program_counter]
     self.program_counter += 1
     return byte
 
+  def _get_instruction(self, pc):
+    """Return the decoded form of the instruction at address PC,
+    from the instruction cache if possible."""
+    instruction = self._instruction_cache.get(pc)
+    if instruction is None:
+      instruction = self._decode_instruction(pc)
+      if pc >= self._cache_start:
+        self._instruction_cache[pc] = instruction
+    return instruction
+
   def get_next_instruction(self):
     """Decode the opcode & operands currently pointed to by the
     program counter, and appropriately increment the program counter
@@ -60,175 +165,199 @@ class ZOpDecoder(object):
 
        [opcode-class, opcode-number, [operand, operand, operand, ...]]
 
-    If the opcode has no operands, the operand list is present but empty."""
-
-    opcode = self._get_pc()
+    If the opcode has no operands, the operand list is present but
+    empty.
 
-    log("Decode opcode %x" % opcode)
+    The program counter is left pointing at the next instruction; the
+    store variable, branch offset and inline z-string of the current
+    instruction are available through get_store_address(),
+    get_branch_offset() and get_zstring()."""
 
-    # Determine the opcode type, and hand off further parsing.
-    if self._memory.version == 5 and opcode == 0xBE:
-      # Extended opcode
-      return self._parse_opcode_extended()
+    (opcode_class, opcode_number, operand_specs, self._store_address,
+     self._branch, self._zstring, self.program_counter) = \
+     self._get_instruction(self.program_counter)
 
-    opcode = BitField(opcode)
-    if opcode[7] == 0:
-      # Long opcode
-      return self._parse_opcode_long(opcode)
-    elif opcode[6] == 0:
-      # Short opcode
-      return self._parse_opcode_short(opcode)
-    else:
-      # Variable opcode
-      return self._parse_opcode_variable(opcode)
-
-  def _parse_opcode_long(self, opcode):
-    """Parse an opcode of the long form."""
-    # Long opcodes are always 2OP. The types of the two operands are
-    # encoded in bits 5 and 6 of the opcode.
-    log("Opcode is long")
-    LONG_OPERAND_TYPES = [SMALL_CONSTANT, VARIABLE]
-    operands = [self._parse_operand(LONG_OPERAND_TYPES[opcode[6]]),
-                self._parse_operand(LONG_OPERAND_TYPES[opcode[5]])]
-    return (OPCODE_2OP, opcode[0:5], operands)
-
-  def _parse_opcode_short(self, opcode):
-    """Parse an opcode of the short form."""
-    # Short opcodes can have either 1 operand, or no operand.
-    log("Opcode is short")
-    operand_type = opcode[4:6]
-    operand = self._parse_operand(operand_type)
-    if operand is None: # 0OP variant
-      log("Opcode is 0OP variant")
-      return (OPCODE_0OP, opcode[0:4], [])
-    else:
-      log("Opcode is 1OP variant")
-      return (OPCODE_1OP, opcode[0:4], [operand])
-
-  def _parse_opcode_variable(self, opcode):
-    """Parse an opcode of the variable form."""
-    log("Opcode is variable")
-    if opcode[5]:
-      log("Variable opcode of VAR kind")
-      opcode_type = OPCODE_VAR
+    # Only the values of variable operands need fetching again.
+    operands = []
+    for kind, value in operand_specs:
+      if kind == OPERAND_CONSTANT:
+        operands.append(value)
+      elif kind == OPERAND_STACK:
+        operands.append(self._stack.pop_stack())
+      elif kind == OPERAND_LOCAL:
+        operands.append(self._stack.get_local_variable(value))
+      else:
+        operands.append(self._memory.read_global(value))
+
+    return (opcode_class, opcode_number, operands)
+
+  def _decode_instruction(self, pc):
+    """Decode the instruction at address PC without evaluating any of
+    its operands, and return a tuple of the form:
+
+       (opcode-class, opcode-number, operand-specs, store-variable,
+        branch, zstring-address, next-pc)
+
+    operand-specs is a tuple of (kind, value) pairs, where kind is one
+    of the OPERAND_* constants. Trailers the opcode does not have are
+    None. The program counter is left unchanged."""
+
+    # The opcode byte is range checked here; an instruction running
+    # off the end of memory shows up as an IndexError from the raw
+    # memory reads below.
+    self._memory.check_range(pc)
+    if pc >= self._cache_start:
+      self._raw = self._static_raw
+    elif (pc + MAX_INSTRUCTION_LENGTH <= self._cache_start
+          or self._dynamic_raw is self._static_raw):
+      self._raw = self._dynamic_raw
     else:
-      log("Variable opcode of 2OP kind")
-      opcode_type = OPCODE_2OP
-
-    opcode_num = opcode[0:5]
-
-    # Parse the types byte to retrieve the operands.
-    operands = self._parse_operands_byte()
-
-    # Special case: opcodes 12 and 26 have a second operands byte.
-    if opcode[0:7] == 0xC or opcode[0:7] == 0x1A:
-      log("Opcode has second operand byte")
-      operands += self._parse_operands_byte()
-
-    return (opcode_type, opcode_num, operands)
+      # The instruction may run from dynamic memory, kept apart, into
+      # static memory: read it through ZMemory, which joins both.
+      self._raw = self._memory
+    saved_pc = self.program_counter
+    self.program_counter = pc
+    try:
+      opcode = self._get_pc()
+
+      # Determine the opcode type and the types of its operands.
+      if self._memory.version >= 5 and opcode == 0xBE:
+        # Extended opcode: the opcode number is in the byte following
+        # the 0xBE marker, and the operands are given by a types byte.
+        opcode_class = OPCODE_EXT
+        opcode_number = self._get_pc()
+        operand_types = OPERAND_TYPES[self._get_pc()]
+      else:
+        opcode_class, opcode_number, operand_types = OPCODE_FORMS[opcode]
+        if operand_types is None:
+          # Variable form: the operand types are in the next byte.
+          operand_types = OPERAND_TYPES[self._get_pc()]
+          # Special case: call_vs2 and call_vn2 (VAR:12 and VAR:26) have
+          # a second types byte, before any of the operands.
+          if opcode_class == OPCODE_VAR and opcode_number in (0xC, 0x1A):
+            operand_types += OPERAND_TYPES[self._get_pc()]
+      operands = [self._parse_operand(t) for t in operand_types]
+
+      has_store, has_branch, has_zstring = \
+                 self._trailers[opcode_class][opcode_number]
+      store = branch = zstring = None
+      if has_store:
+        store = self._get_pc()
+      if has_branch:
+        branch = self._parse_branch_offset()
+      if has_zstring:
+        zstring = self._parse_zstring()
+    except IndexError:
+      raise ZMemoryOutOfBounds
+    finally:
+      next_pc = self.program_counter
+      self.program_counter = saved_pc
+
+    return (opcode_class, opcode_number, tuple(operands),
+            store, branch, zstring, next_pc)
 
   def _parse_operand(self, operand_type):
-    """Read and return an operand of the given type.
+    """Read and return the (kind, value) description of an operand of
+    the given type, or None if the operand is absent.
 
     This assumes that the operand is in memory, at the address pointed
     by the Program Counter."""
     assert operand_type <= 0x3
 
     if operand_type == LARGE_CONSTANT:
-      log("Operand is large constant")
-      operand = self._memory.read_word(self.program_counter)
+      pc = self.program_counter
+      operand = (OPERAND_CONSTANT, (self._raw[pc] << 8) + self._raw[pc + 1])
       self.program_counter += 2
     elif operand_type == SMALL_CONSTANT:
-      log("Operand is small constant")
-      operand = self._get_pc()
+      operand = (OPERAND_CONSTANT, self._get_pc())
     elif operand_type == VARIABLE:
       variable_number = self._get_pc()
-      log("Operand is variable %d" % variable_number)
       if variable_number == 0:
-        log("Operand value comes from stack")
-        operand = self._stack.pop_stack() # TODO: make sure this is right.
+        operand = (OPERAND_STACK, 0) # TODO: make sure this is right.
       elif variable_number < 16:
-        log("Operand value comes from local variable")
-        operand = self._stack.get_local_variable(variable_number - 1)
+        operand = (OPERAND_LOCAL, variable_number - 1)
       else:
-        log("Operand value comes from global variable")
-        operand = self._memory.read_global(variable_number)
+        operand = (OPERAND_GLOBAL, variable_number)
     elif operand_type == ABSENT:
-      log("Operand is absent")
       operand = None
-    if operand is not None:
-      log("Operand value: %d" % operand)
 
     return operand
 
-  def _parse_operands_byte(self):
-    """Parse operands given by the operand byte and return a list of
-    values.
-    """
-    operand_byte = BitField(self._get_pc())
-    operands = []
-    for operand_type in [operand_byte[6:8], operand_byte[4:6],
-                         operand_byte[2:4], operand_byte[0:2]]:
-      operand = self._parse_operand(operand_type)
-      if operand is None:
-        break
-      operands.append(operand)
+  def _parse_zstring(self):
+    """Return the address of the zstring pointed to by the PC, and
+    increment the PC just past the text."""
+
+    start_addr = self.program_counter
+    raw = self._raw
+    if raw is self._dynamic_raw and raw is not self._static_raw:
+      # The string may run from dynamic memory into static memory.
+      raw = self._memory
+    # The top bit of the last word of the string is set.
+    while not raw[self.program_counter] & 0x80:
+      self.program_counter += 2
+    self.program_counter += 2
 
-    return operands
+    return start_addr
+
+  def _parse_branch_offset(self):
+    """Decode the branch data pointed to by the PC, and return a
+    (branch_if_true, branch_offset) tuple. Increment the PC as
+    necessary."""
+
+    branch_if_true, is_short, branch_offset = BRANCH_BYTES[self._get_pc()]
+    if not is_short:
+      # The offset is a signed 14-bit number, whose low 8 bits are in
+      # the second byte.
+      branch_offset += self._get_pc()
+
+    return branch_if_true, branch_offset
 
 
   # Public funcs that the ZPU may also need to call, depending on the
   # opcode being executed:
 
   def get_zstring(self):
-    """For string opcodes, return the address of the zstring pointed
-    to by the PC.  Increment PC just past the text."""
+    """For string opcodes, return the address of the zstring embedded
+    in the current instruction."""
+    return self._zstring
 
-    start_addr = self.program_counter
-    bf = BitField(0)
 
-    while True:
-      bf.__init__(self._memory[self.program_counter])
-      self.program_counter += 2
-      if bf[7] == 1:
-        break
+  def get_store_address(self):
+    """For store opcodes, return the variable number in which the
+    operation result should be stored."""
+    return self._store_address
 
-    return start_addr
 
+  def get_branch_offset(self):
+    """For branching opcodes, return two values: first, either True
+    or False (indicating whether to branch if true or branch if
+    false), and second, the offset to jump to, relative to the
+    current program counter."""
+    return self._branch
 
-  def get_store_address(self):
-    """For store opcodes, read byte pointed to by PC and return the
-    variable number in which the operation result should be stored.
-    Increment the PC as necessary."""
-    return self._get_pc()
 
+class ZTracingOpDecoder(ZOpDecoder):
+  """A ZOpDecoder which logs every instruction it decodes. The
+  ZMachine only uses it in debug mode, so that the normal decoder
+  never pays for formatting log messages."""
 
-  def get_branch_offset(self):
-    """For branching opcodes, examine address pointed to by PC, and
-    return two values: first, either True or False (indicating whether
-    to branch if true or branch if false), and second, the address to
-    jump to.  Increment the PC as necessary."""
-
-    bf = BitField(self._get_pc())
-    branch_if_true = bool(bf[7])
-    if bf[6]:
-      branch_offset = bf[0:6]
-    else:
-      # We need to do a little magic here. The branch offset is
-      # written as a signed 14-bit number, with signed meaning '-n' is
-      # written as '65536-n'. Or in this case, as we have 14 bits,
-      # '16384-n'.
-      #
-      # So, if the MSB (ie. bit 13) is set, we have a negative
-      # number. We take the value, and substract 16384 to get the
-      # actual offset as a negative integer.
-      #
-      # If the MSB is not set, we just extract the value and return it.
-      #
-      # Can you spell "Weird" ?
-      branch_offset = self._get_pc() + (bf[0:5] << 8)
-      if bf[5]:
-        branch_offset -= 8192
-
-    log('Branch if %s to offset %+d' % (branch_if_true, branch_offset))
-    return branch_if_true, branch_offset
+  def get_next_instruction(self):
+    pc = self.program_counter
+    log("Reading next opcode at address %x" % pc)
+    (opcode_class, opcode_number, operand_specs,
+     store, branch, zstring, next_pc) = self._get_instruction(pc)
+    log("Decode opcode %x" % self._memory[pc])
+    log("Opcode is %s:%02x" % (OPCODE_STRINGS[opcode_class],
+                               opcode_number))
+
+    result = ZOpDecoder.get_next_instruction(self)
+
+    for (kind, value), operand in zip(operand_specs, result[2]):
+      log("Operand from %s: %d" % (OPERAND_STRINGS[kind], operand))
+    if store is not None:
+      log("Store result to variable %d" % store)
+    if branch is not None:
+      log('Branch if %s to offset %+d' % branch)
+    if zstring is not None:
+      log("Inline string at address %x" % zstring)
+    return result
@@ -0,0 +1,437 @@
+#
+# Profilers for stories running on the ZCpu.  ZProfiler counts and
+# times the executed instructions per opcode handler, and attributes
+# them to the stack of Z-routines that executed them.
+# ZSamplingProfiler samples the program counter and the stack of
+# routines from a background thread instead, at a much lower cost.
+#
+# For the license of this file, please consult the LICENSE file in the
+# root directory of this distribution.
+#
+
+import collections
+import functools
+import json
+import signal
+import threading
+import xml.etree.ElementTree
+from timeit import default_timer
+
+from . import zstream
+from .zmemory import ZMemoryOutOfBounds
+
+# The name of the code run outside of any routine, at the bottom of
+# the call stack.
+MAIN_NAME = '(main)'
+
+# Weights of the samples in a collapsed-stack file.
+WEIGHT_TIME = 'time'
+WEIGHT_INSTRUCTIONS = 'instructions'
+
+
+class ZProfilerError(Exception):
+  "General exception for the profiler."
+  pass
+
+
+def load_routine_names(debug_file, zmem):
+  """Return a dictionary mapping the header addresses of the routines
+  of a story to their names, read from the Inform 6 debug information
+  file DEBUG_FILE (in the XML format written by Inform 6.33 and
+  later).  ZMEM is the story's memory, used to unpack the addresses of
+  routines which only give their packed address."""
+  try:
+    tree = xml.etree.ElementTree.parse(debug_file)
+  except xml.etree.ElementTree.ParseError as e:
+    raise ZProfilerError("Cannot parse debug file %s: %s"
+                         % (debug_file, e))
+  names = {}
+  for routine in tree.iter('routine'):
+    name = routine.findtext('identifier')
+    address = routine.findtext('address')
+    if name is None:
+      continue
+    if address is not None:
+      names[int(address)] = name.strip()
+      continue
+    value = routine.findtext('value')
+    if value is None:
+      continue
+    try:
+      names[zmem.packed_address(int(value))] = name.strip()
+    except ZMemoryOutOfBounds:
+      pass
+  return names
+
+
+def routine_name(address, routine_names):
+  """Return the name of the routine whose header is at ADDRESS, from
+  the dictionary ROUTINE_NAMES if it is there."""
+  name = routine_names.get(address)
+  if name is None:
+    name = 'routine_%05x' % address
+  return name
+
+
+def write_collapsed_stacks(output, weights, routine_names):
+  """Write WEIGHTS, a dictionary mapping tuples of routine header
+  addresses to integers, to the file OUTPUT in the collapsed-stack
+  format read by flamegraph.pl and compatible tools: one line per
+  stack, its frames separated by semicolons, followed by its weight."""
+  lines = []
+  for stack, value in weights.items():
+    if value == 0:
+      continue
+    frames = [MAIN_NAME] + [routine_name(address, routine_names)
+                            for address in stack]
+    lines.append("%s %d\n" % (';'.join(frames), value))
+  lines.sort()
+  output.writelines(lines)
+
+
+class ZProfiler(object):
+  """Profiles the instructions a ZMachine executes while the profiler
+  is started.
+
+  Each handler in the CPU's dispatch table is wrapped so as to count
+  its calls and the time spent in it, which is collected per handler
+  in opcodes.  Each instruction is also attributed to the stack of
+  routines executing it, collected in stacks: a dictionary mapping
+  tuples of routine header addresses, outermost first, to the
+  [instructions, seconds] executed with that call stack.  The seconds
+  of a stack run from the start of each instruction to the start of
+  the next, so they include decoding, and add up to the time spent
+  running the story."""
+
+  def __init__(self, machine, routine_names=None):
+    """ROUTINE_NAMES optionally maps routine header addresses to
+    names, as returned by load_routine_names()."""
+    self._cpu = machine._cpu
+    self._stackmanager = machine._stackmanager
+    self._routine_names = routine_names or {}
+    self.opcodes = {}
+    self.stacks = {}
+    self._original_dispatch = None
+    # The stacks entry of the last instruction executed, and the time
+    # it started, until its time is accounted for.
+    self._last_entry = None
+    self._last_start = 0.0
+
+  def __enter__(self):
+    self.start()
+    return self
+
+  def __exit__(self, *exc_info):
+    self.stop()
+
+  def start(self):
+    """Start profiling."""
+    if self._original_dispatch is not None:
+      raise ZProfilerError("Profiler already started")
+    dispatch = self._cpu._dispatch
+    self._original_dispatch = list(dispatch)
+    # Replace the entries in place, so that a run already in progress
+    # picks them up too.
+    for index, handler in enumerate(dispatch):
+      if handler is None:
+        continue
+      implemented, func = handler
+      stats = self.opcodes.setdefault(func.__name__, [0, 0.0])
+      dispatch[index] = (implemented, self._wrap(func, stats))
+
+  def stop(self):
+    """Stop profiling, and restore the CPU's dispatch table."""
+    if self._original_dispatch is None:
+      raise ZProfilerError("Profiler not started")
+    self._account(default_timer())
+    self._cpu._dispatch[:] = self._original_dispatch
+    self._original_dispatch = None
+
+  def _account(self, now):
+    """Add the time up to NOW to the last instruction's stack."""
+    if self._last_entry is not None:
+      self._last_entry[1] += now - self._last_start
+      self._last_entry = None
+
+  def _wrap(self, func, stats):
+    profiler = self
+    stacks = self.stacks
+    get_routine_addresses = self._stackmanager.get_routine_addresses
+
+    @functools.wraps(func)
+    def profiled_handler(*operands):
+      start = default_timer()
+      profiler._account(start)
+      stack = get_routine_addresses()
+      pending = False
+      try:
+        return func(*operands)
+      except zstream.ZInputPending:
+        # The instruction is retried once input arrives, and the wait
+        # isn't execution time.
+        pending = True
+        raise
+      finally:
+        if not pending:
+          stats[0] += 1
+          stats[1] += default_timer() - start
+          entry = stacks.get(stack)
+          if entry is None:
+            entry = stacks[stack] = [0, 0.0]
+          entry[0] += 1
+          profiler._last_entry = entry
+          profiler._last_start = start
+    return profiled_handler
+
+  def routine_name(self, address):
+    """Return the name of the routine whose header is at ADDRESS."""
+    return routine_name(address, self._routine_names)
+
+  def get_routines(self):
+    """Return a list of (name, instructions, self_seconds,
+    total_seconds) for each routine seen, where the total includes the
+    routines it called, sorted by decreasing self time."""
+    # Keyed by routine address, or None for the main code, which all
+    # the stacks start from.
+    routines = {}
+    for stack, (instructions, seconds) in self.stacks.items():
+      top = stack[-1] if stack else None
+      stats = routines.setdefault(top, [0, 0.0, 0.0])
+      stats[0] += instructions
+      stats[1] += seconds
+      # Count recursive routines once per stack.
+      for address in set(stack + (None,)):
+        routines.setdefault(address, [0, 0.0, 0.0])[2] += seconds
+    result = []
+    for address, (instructions, self_seconds,
+                  total_seconds) in routines.items():
+      if address is None:
+        name = MAIN_NAME
+      else:
+        name = self.routine_name(address)
+      result.append((name, instructions, self_seconds, total_seconds))
+    result.sort(key=lambda routine: routine[2], reverse=True)
+    return result
+
+  def report(self, limit=30):
+    """Return a report of the LIMIT most expensive opcode handlers and
+    routines, as a string."""
+    lines = []
+    total_calls = sum(calls for calls, seconds in self.opcodes.values())
+    total_seconds = sum(seconds for calls, seconds
+                        in self.opcodes.values()) or 1.0
+    opcodes = sorted([(seconds, calls, name) for name, (calls, seconds)
+                      in self.opcodes.items() if calls], reverse=True)
+    lines.append("%d instructions executed" % total_calls)
+    lines.append("")
+    lines.append("%-24s %10s %10s %7s %10s"
+                 % ("opcode handler", "calls", "seconds", "%time",
+                    "usec/call"))
+    for seconds, calls, name in opcodes[:limit]:
+      lines.append("%-24s %10d %10.4f %6.1f%% %10.2f"
+                   % (name, calls, seconds, 100 * seconds / total_seconds,
+                      1e6 * seconds / calls))
+
+    routines = self.get_routines()
+    total_seconds = sum(routine[2] for routine in routines) or 1.0
+    lines.append("")
+    lines.append("%-24s %10s %10s %7s %10s"
+                 % ("routine", "instrs", "self sec", "%self", "total sec"))
+    for name, instructions, self_seconds, seconds in routines[:limit]:
+      lines.append("%-24s %10d %10.4f %6.1f%% %10.4f"
+                   % (name, instructions, self_seconds,
+                      100 * self_seconds / total_seconds, seconds))
+    return '\n'.join(lines) + '\n'
+
+  def write_collapsed(self, output, weight=WEIGHT_TIME):
+    """Write the call stacks to the file OUTPUT in the collapsed-stack
+    format (see write_collapsed_stacks()).  WEIGHT is WEIGHT_TIME to
+    weigh stacks in microseconds, or WEIGHT_INSTRUCTIONS to weigh them
+    in instructions executed."""
+    if weight == WEIGHT_TIME:
+      weights = dict((stack, int(round(seconds * 1e6)))
+                     for stack, (instructions, seconds)
+                     in self.stacks.items())
+    elif weight == WEIGHT_INSTRUCTIONS:
+      weights = dict((stack, instructions)
+                     for stack, (instructions, seconds)
+                     in self.stacks.items())
+    else:
+      raise ZProfilerError("Unknown weight %r" % weight)
+    write_collapsed_stacks(output, weights, self._routine_names)
+
+
+class ZSampleHistogram(object):
+  """The samples a ZSamplingProfiler took of one or more machines:
+  counters of the program counters, the innermost routines, the call
+  stack depths and the call stacks seen."""
+
+  def __init__(self):
+    self.samples = 0
+    self.pcs = collections.Counter()
+    self.routines = collections.Counter()
+    self.depths = collections.Counter()
+    self.stacks = collections.Counter()
+
+  def add_sample(self, pc, stack):
+    self.samples += 1
+    self.pcs[pc] += 1
+    self.routines[stack[-1] if stack else None] += 1
+    self.depths[len(stack)] += 1
+    self.stacks[stack] += 1
+
+  def copy(self):
+    """Return a copy of the histograms, which further samples don't
+    change."""
+    result = ZSampleHistogram()
+    result.samples = self.samples
+    result.pcs = self.pcs.copy()
+    result.routines = self.routines.copy()
+    result.depths = self.depths.copy()
+    result.stacks = self.stacks.copy()
+    return result
+
+  def as_dict(self, routine_names=None, limit=None):
+    """Return the histograms as a dictionary, ready to encode as JSON,
+    with the LIMIT most frequent program counters and routines, or
+    all of them if LIMIT is None."""
+    routine_names = routine_names or {}
+    routines = []
+    for address, count in self.routines.most_common(limit):
+      if address is None:
+        name = MAIN_NAME
+      else:
+        name = routine_name(address, routine_names)
+      routines.append([name, count])
+    return {
+      'samples': self.samples,
+      'pcs': [['0x%05x' % pc, count]
+              for pc, count in self.pcs.most_common(limit)],
+      'routines': routines,
+      'depths': dict((str(depth), count)
+                     for depth, count in sorted(self.depths.items())),
+      }
+
+  def write_collapsed(self, output, routine_names=None):
+    """Write the sampled call stacks to the file OUTPUT in the
+    collapsed-stack format, weighted by their number of samples."""
+    write_collapsed_stacks(output, self.stacks, routine_names or {})
+
+
+class ZSamplingProfiler(object):
+  """Samples the program counter and call stack of running machines
+  from a background thread, every INTERVAL seconds.
+
+  Unlike ZProfiler, this costs the machines nothing between samples,
+  so it can be left on for live sessions.  Any number of machines can
+  be added; the samples of the machines added under the same name go
+  into the same ZSampleHistogram.
+
+  The histograms are only read or written under a lock, which is
+  reentrant so that the signal handler installed by
+  install_signal_handler() can't deadlock when it interrupts the main
+  thread holding it."""
+
+  def __init__(self, interval=0.005, routine_names=None):
+    self.interval = interval
+    self._routine_names = routine_names or {}
+    self._lock = threading.RLock()
+    # Maps each machine to the histogram of its name.
+    self._machines = {}
+    self._histograms = {}
+    self._thread = None
+    self._stop_event = threading.Event()
+    # Samples taken while no machine was executing, e.g. all waiting
+    # for input.
+    self.idle_samples = 0
+
+  def add(self, machine, name='default'):
+    """Start sampling MACHINE into the histogram called NAME."""
+    with self._lock:
+      histogram = self._histograms.get(name)
+      if histogram is None:
+        histogram = self._histograms[name] = ZSampleHistogram()
+      self._machines[machine] = histogram
+
+  def remove(self, machine):
+    """Stop sampling MACHINE.  Its samples stay in its histogram."""
+    with self._lock:
+      self._machines.pop(machine, None)
+
+  def histograms(self):
+    """Return a dictionary of copies of the histograms as they are now,
+    keyed by name."""
+    with self._lock:
+      return dict((name, histogram.copy())
+                  for name, histogram in self._histograms.items())
+
+  def start(self):
+    """Start the sampling thread."""
+    if self._thread is not None:
+      raise ZProfilerError("Sampling profiler already started")
+    self._stop_event.clear()
+    self._thread = threading.Thread(target=self._sample_loop,
+                                    name="ZSamplingProfiler")
+    self._thread.daemon = True
+    self._thread.start()
+
+  def stop(self):
+    """Stop the sampling thread, and wait for it to finish."""
+    if self._thread is None:
+      raise ZProfilerError("Sampling profiler not started")
+    self._stop_event.set()
+    self._thread.join()
+    self._thread = None
+
+  def __enter__(self):
+    self.start()
+    return self
+
+  def __exit__(self, *exc_info):
+    self.stop()
+
+  def _sample_loop(self):
+    while not self._stop_event.wait(self.interval):
+      self.sample()
+
+  def sample(self):
+    """Take one sample of each machine."""
+    idle = True
+    with self._lock:
+      for machine, histogram in self._machines.items():
+        if not machine._cpu.executing:
+          continue
+        idle = False
+        # The machine runs on in another thread, so the stack may be
+        # a little ahead of the program counter; that's the price of
+        # not stopping it.
+        pc = machine._opdecoder.program_counter
+        histogram.add_sample(pc,
+                             machine._stackmanager.get_routine_addresses())
+      if idle:
+        self.idle_samples += 1
+
+  def dump(self, output, limit=None):
+    """Write all the histograms to the file OUTPUT as JSON.  See
+    ZSampleHistogram.as_dict() for LIMIT."""
+    result = {
+      'interval': self.interval,
+      'idle_samples': self.idle_samples,
+      'histograms': dict((name, histogram.as_dict(self._routine_names,
+                                                   limit))
+                         for name, histogram
+                         in self.histograms().items()),
+      }
+    json.dump(result, output, indent=2, sort_keys=True)
+    output.write('\n')
+
+  def install_signal_handler(self, path, signum=None, limit=None):
+    """Dump the histograms to the file at PATH whenever the process
+    receives the signal SIGNUM, by default SIGUSR1 (where available).
+    Must be called from the main thread."""
+    if signum is None:
+      signum = signal.SIGUSR1
+    def dump_on_signal(signum, frame):
+      with open(path, 'w') as output:
+        self.dump(output, limit)
+    signal.signal(signum, dump_on_signal)
@@ -0,0 +1,371 @@
+#
+# An asyncio server which hosts many concurrent Z-Machine sessions of
+# one story in a single process.
+#
+# Each connection to the server is one player's session.  The client
+# sends one command per line, in UTF-8; for each command, the server
+# runs the session's machine until it asks for more input, and replies
+# with one line of JSON:
+#
+#   {"session": 1, "state": "input", "input": "line", "output": "...",
+#    "error": null}
+#
+# state is "input" while the story waits for the next command, and
+# "ended" once the story stopped, after which the server closes the
+# connection.  input tells whether the story waits for a whole "line",
+# or a single "char", which is taken from the start of the next
+# command (an empty command is a carriage return).  A reply is also
+# sent as soon as a client connects, carrying the story's output up to
+# its first request for input.
+#
+# For the license of this file, please consult the LICENSE file in the
+# root directory of this distribution.
+#
+
+import asyncio
+import json
+import logging
+from timeit import default_timer
+
+from . import headlesszui
+from . import zcpu
+from .zsession import ZSessionFactory
+
+STATE_INPUT = 'input'
+STATE_ENDED = 'ended'
+
+# The number of instructions a session runs before letting the other
+# sessions have a turn.
+DEFAULT_TIME_SLICE = 10000
+
+# The seconds a session waits before resuming a turn which ran over its
+# budget, multiplied by the number of times the turn did so.
+OVERRUN_DELAY = 0.01
+
+log = logging.getLogger(__name__)
+
+
+class ZServerError(Exception):
+  "General exception for the session server."
+  pass
+
+
+class ZSessionMetrics(object):
+  """Turn accounting for one session.  A turn is the time from a
+  command arriving to the machine asking for the next one."""
+
+  def __init__(self):
+    self.turns = 0
+    self.instructions = 0
+    self.total_seconds = 0.0
+    self.max_seconds = 0.0
+    self.last_seconds = 0.0
+    # The number of times turns ran over their budget, and the highest
+    # fraction of its budget a turn used.
+    self.budget_overruns = 0
+    self.peak_budget_usage = 0.0
+
+  def add_turn(self, instructions, seconds, budget_overruns=0,
+               budget_usage=None):
+    self.turns += 1
+    self.instructions += instructions
+    self.total_seconds += seconds
+    self.last_seconds = seconds
+    if seconds > self.max_seconds:
+      self.max_seconds = seconds
+    self.budget_overruns += budget_overruns
+    if budget_usage is not None and budget_usage > self.peak_budget_usage:
+      self.peak_budget_usage = budget_usage
+
+  def merge(self, other):
+    """Add the turns of the ZSessionMetrics OTHER to these."""
+    self.turns += other.turns
+    self.instructions += other.instructions
+    self.total_seconds += other.total_seconds
+    self.max_seconds = max(self.max_seconds, other.max_seconds)
+    self.budget_overruns += other.budget_overruns
+    self.peak_budget_usage = max(self.peak_budget_usage,
+                                 other.peak_budget_usage)
+
+  def as_dict(self):
+    turns = self.turns or 1
+    return {
+      'turns': self.turns,
+      'instructions': self.instructions,
+      'instructions_per_turn': self.instructions / turns,
+      'mean_turn_seconds': self.total_seconds / turns,
+      'max_turn_seconds': self.max_seconds,
+      'last_turn_seconds': self.last_seconds,
+      'budget_overruns': self.budget_overruns,
+      'peak_budget_usage': self.peak_budget_usage,
+      }
+
+
+class ZServerSession(object):
+  """One player's machine, and its accounting."""
+
+  def __init__(self, session_id, factory, max_turns=None,
+               max_instructions=None, time_slice=DEFAULT_TIME_SLICE,
+               turn_instructions=None, turn_seconds=None,
+               max_overruns=None):
+    self.session_id = session_id
+    # Input comes through step(), never from the keyboard.
+    self._ui = headlesszui.create_zui([])
+    self.machine = factory.new_session(self._ui)
+    self.machine.set_turn_budget(turn_instructions, turn_seconds)
+    self._max_overruns = max_overruns
+    self._max_turns = max_turns
+    self._max_instructions = max_instructions
+    self._time_slice = time_slice
+    self.metrics = ZSessionMetrics()
+    self.state = STATE_INPUT
+    # The kind of input the story is waiting for.
+    self.wants = None
+
+  async def play(self, command=None):
+    """Run the machine with COMMAND as its next input, or with no
+    input to start it, until it asks for more input or stops.  Return
+    the reply to send to the client.
+
+    The machine runs in slices of a fixed number of instructions,
+    yielding to the event loop in between."""
+    if self.state == STATE_ENDED:
+      raise ZServerError("Session %d has ended" % self.session_id)
+    input = command
+    if command is not None and self.wants == zcpu.STEP_NEEDS_CHAR:
+      input = ord(command[0]) if command else 13
+
+    cpu = self.machine._cpu
+    start_count = cpu.instruction_count
+    start = default_timer()
+    result = None
+    error = None
+    overruns = 0
+    try:
+      while True:
+        result = self.machine.step(self._time_slice, input)
+        input = None
+        if result.status == zcpu.STEP_OVER_BUDGET:
+          overruns += 1
+          if (self._max_overruns is not None
+              and overruns > self._max_overruns):
+            error = ("Turn exceeded its budget more than %d times"
+                     % self._max_overruns)
+            break
+          # Let the sessions within their budget go first.
+          await asyncio.sleep(OVERRUN_DELAY * overruns)
+          continue
+        if result.status != zcpu.STEP_RUNNING:
+          break
+        error = self._check_instructions(cpu.instruction_count
+                                         - start_count)
+        if error is not None:
+          break
+        await asyncio.sleep(0)
+    except Exception as e:
+      # The other sessions play on, but the traceback is kept.
+      log.exception("Session %d failed", self.session_id)
+      error = "%s: %s" % (e.__class__.__name__, e)
+    self.metrics.add_turn(cpu.instruction_count - start_count,
+                          default_timer() - start, overruns,
+                          cpu.peak_budget_usage)
+
+    waiting = error is None and result.status in (zcpu.STEP_NEEDS_LINE,
+                                                  zcpu.STEP_NEEDS_CHAR)
+    if waiting:
+      error = self._check_turns() or self._check_instructions(0)
+      waiting = error is None
+    if waiting:
+      self.wants = result.status
+    else:
+      self.state = STATE_ENDED
+      self.wants = None
+
+    screen = self._ui.screen
+    output = screen.get_output()
+    screen.clear_output()
+    return {
+      'session': self.session_id,
+      'state': self.state,
+      'input': self.wants,
+      'output': output,
+      'error': error,
+      }
+
+  def _check_turns(self):
+    """Return a description of the turn quota, if the session has used
+    it up."""
+    # The first turn only starts the story, and isn't a command.
+    if (self._max_turns is not None
+        and self.metrics.turns > self._max_turns):
+      return "Session exceeded its quota of %d turns" % self._max_turns
+    return None
+
+  def _check_instructions(self, turn_instructions):
+    """Return a description of the instruction quota, if the session
+    has used it up, counting TURN_INSTRUCTIONS executed so far in the
+    current turn."""
+    if (self._max_instructions is not None
+        and (self.metrics.instructions + turn_instructions
+             > self._max_instructions)):
+      return ("Session exceeded its quota of %d instructions"
+              % self._max_instructions)
+    return None
+
+
+class ZSessionServer(object):
+  """Serves sessions of one story to clients on a local socket.
+
+  All sessions share the story's pristine memory image (see
+  ZSessionFactory).  Every session runs in the server's event loop,
+  in slices of TIME_SLICE instructions, so that a long turn doesn't
+  hold up the other sessions.
+
+  MAX_SESSIONS limits the number of concurrent sessions; clients
+  connecting beyond it are sent an ended reply with an error.
+  MAX_TURNS and MAX_INSTRUCTIONS, if not None, end a session once it
+  has played that many commands or executed that many instructions.
+  IDLE_TIMEOUT, if not None, closes a session which sends no command
+  for that many seconds.
+
+  TURN_INSTRUCTIONS and TURN_SECONDS, if not None, budget the
+  instructions each turn may execute, and the seconds it may spend
+  executing them.  A turn which runs over budget is put back behind
+  the other sessions for a while, and ends its session once it has run
+  over MAX_OVERRUNS times.
+
+  SAMPLER, if given, is a zprofiler.ZSamplingProfiler which samples
+  all the sessions into its histogram named 'sessions'."""
+
+  def __init__(self, story, max_sessions=1000, max_turns=None,
+               max_instructions=None, idle_timeout=None,
+               time_slice=DEFAULT_TIME_SLICE, turn_instructions=None,
+               turn_seconds=None, max_overruns=3, sampler=None):
+    self._factory = ZSessionFactory(story)
+    self._sampler = sampler
+    self._time_slice = time_slice
+    self._turn_instructions = turn_instructions
+    self._turn_seconds = turn_seconds
+    self._max_overruns = max_overruns
+    self._max_sessions = max_sessions
+    self._max_turns = max_turns
+    self._max_instructions = max_instructions
+    self._idle_timeout = idle_timeout
+    self._sessions = {}
+    self._next_session_id = 1
+    self._server = None
+    # Totals over the sessions which have already ended.
+    self._finished = ZSessionMetrics()
+    self._finished_sessions = 0
+    self._rejected_sessions = 0
+
+  async def start(self, path):
+    """Start listening for clients on the Unix socket at PATH."""
+    self._server = await asyncio.start_unix_server(
+      self.handle_connection, path)
+
+  async def close(self):
+    """Stop listening, and release the story.  Sessions in progress
+    are dropped."""
+    if self._server is not None:
+      self._server.close()
+      await self._server.wait_closed()
+      self._server = None
+    self._factory.close()
+
+  async def handle_connection(self, reader, writer):
+    """Play one session with the client at the other end of READER and
+    WRITER."""
+    try:
+      if len(self._sessions) >= self._max_sessions:
+        self._rejected_sessions += 1
+        await self._send(writer, {
+          'session': None, 'state': STATE_ENDED, 'input': None,
+          'output': '', 'error': "Too many sessions" })
+        return
+
+      session = ZServerSession(self._next_session_id, self._factory,
+                               self._max_turns, self._max_instructions,
+                               self._time_slice, self._turn_instructions,
+                               self._turn_seconds, self._max_overruns)
+      self._next_session_id += 1
+      self._sessions[session.session_id] = session
+      if self._sampler is not None:
+        self._sampler.add(session.machine, 'sessions')
+      try:
+        await self._serve_session(session, reader, writer)
+      finally:
+        if self._sampler is not None:
+          self._sampler.remove(session.machine)
+        del self._sessions[session.session_id]
+        self._finished.merge(session.metrics)
+        self._finished_sessions += 1
+    finally:
+      writer.close()
+
+  async def _serve_session(self, session, reader, writer):
+    await self._send(writer, await session.play())
+    while session.state != STATE_ENDED:
+      try:
+        line = await asyncio.wait_for(reader.readline(),
+                                      self._idle_timeout)
+      except asyncio.TimeoutError:
+        return
+      if not line:
+        return
+      command = line.decode('utf-8', 'replace').rstrip('\r\n')
+      await self._send(writer, await session.play(command))
+
+  async def _send(self, writer, reply):
+    writer.write(json.dumps(reply).encode('utf-8') + b'\n')
+    await writer.drain()
+
+  def metrics(self):
+    """Return a dictionary of the server's metrics: totals over all
+    sessions so far, and the metrics of each active session, keyed by
+    session id."""
+    totals = ZSessionMetrics()
+    totals.merge(self._finished)
+    for session in self._sessions.values():
+      totals.merge(session.metrics)
+    result = totals.as_dict()
+    del result['last_turn_seconds']
+    result['active_sessions'] = len(self._sessions)
+    result['finished_sessions'] = self._finished_sessions
+    result['rejected_sessions'] = self._rejected_sessions
+    result['sessions'] = dict((session_id, session.metrics.as_dict())
+                              for session_id, session
+                              in self._sessions.items())
+    return result
+
+
+class ZSessionClient(object):
+  """A client for a ZSessionServer, standing in for a real frontend."""
+
+  def __init__(self, reader, writer):
+    self._reader = reader
+    self._writer = writer
+
+  @classmethod
+  async def connect(cls, path):
+    """Connect to the server on the Unix socket at PATH."""
+    reader, writer = await asyncio.open_unix_connection(path)
+    return cls(reader, writer)
+
+  async def read_reply(self):
+    """Return the server's next reply, or None once the server has
+    closed the connection."""
+    line = await self._reader.readline()
+    if not line:
+      return None
+    return json.loads(line.decode('utf-8'))
+
+  async def send(self, command):
+    """Send COMMAND to the session, and return the reply."""
+    self._writer.write(command.encode('utf-8') + b'\n')
+    await self._writer.drain()
+    return await self.read_reply()
+
+  async def close(self):
+    self._writer.close()
+    await self._writer.wait_closed()
@@ -0,0 +1,39 @@
+#
+# A factory of Z-Machine sessions which all play the same story,
+# sharing as much of its memory image as possible.
+#
+# For the license of this file, please consult the LICENSE file in the
+# root directory of this distribution.
+#
+
+from .zmachine import ZMachine
+from .zmemory import ZMemory
+
+
+class ZSessionFactory(object):
+  """Parses and validates a story once, then starts any number of
+  ZMachine sessions on it.
+
+  Static and high memory can never change, so all the sessions read
+  them from the factory's single pristine image of the story.  Each
+  session only gets a private copy of dynamic memory, which is all
+  that its play can modify."""
+
+  def __init__(self, story):
+    """STORY is the bytes of a story file."""
+    self._pristine_mem = ZMemory(story)
+    self._closed = False
+
+  def new_session(self, ui, **kwargs):
+    """Return a new ZMachine playing the story through UI.  Other
+    keyword arguments are passed on to ZMachine."""
+    if self._closed:
+      raise ValueError("new_session() on a closed ZSessionFactory")
+    return ZMachine(self._pristine_mem, ui,
+                    zmem=self._pristine_mem.copy(share_static=True),
+                    **kwargs)
+
+  def close(self):
+    """Stop starting sessions.  Sessions already started keep playing
+    on the story."""
+    self._closed = True
@@ -8,6 +8,8 @@
 # root directory of this distribution.
 #
 
+from array import array
+
 from .zlogging import log
 
 class ZStackError(Exception):
@@ -30,72 +32,56 @@ class ZStackPopError(ZStackError):
   "Nothing to pop from stack!"
   pass
 
-# Helper class used by ZStackManager; a 'routine' object which
-# includes its own private stack of data.
-class ZRoutine(object):
-
-  def __init__(self, start_addr, return_addr, zmem, args,
-               local_vars=None, stack=None):
-    """Initialize a routine object beginning at START_ADDR in ZMEM,
-    with initial argument values in list ARGS.  If LOCAL_VARS is None,
-    then parse them from START_ADDR."""
-
-    self.start_addr = start_addr
-    self.return_addr = return_addr
-    self.program_counter = 0    # used when execution interrupted
-
-    if stack is None:
-      self.stack = []
-    else:
-      self.stack = stack[:]
-
-    if local_vars is not None:
-      self.local_vars = local_vars[:]
-    else:
-      num_local_vars = zmem[self.start_addr]
-      if not (0 <= num_local_vars <= 15):
-        log("num local vars is %d" % num_local_vars)
-        raise ZStackError
-      self.start_addr += 1
-
-      # Initialize the local vars in the ZRoutine's dictionary. This is
-      # only needed on machines v1 through v4. In v5 machines, all local
-      # variables are preinitialized to zero.
-      self.local_vars = [0 for _ in range(15)]
-      if 1 <= zmem.version <= 4:
-        for i in range(num_local_vars):
-          self.local_vars[i] = zmem.read_word(self.start_addr)
-          self.start_addr += 2
-      elif zmem.version != 5:
-        raise ZStackUnsupportedVersion
-
-    # Place call arguments into local vars, if available
-    for i in range(0, len(args)):
-      self.local_vars[i] = args[i]
-
-
-  def pretty_print(self):
-    "Display a ZRoutine nicely, for debugging purposes."
 
-    log("ZRoutine:        start address: %d" % self.start_addr)
-    log("ZRoutine: return value address: %d" % self.return_addr)
-    log("ZRoutine:      program counter: %d" % self.program_counter)
-    log("ZRoutine:      local variables: %d" % self.local_vars)
-
-
-class ZStackBottom(object):
-
-  def __init__(self):
-    self.program_counter = 0  # used as a cache only
+# The fields of a frame record.  Each routine on the call stack has
+# one record of FRAME_SIZE consecutive entries in
+# ZStackManager._frames:
+#
+#   RETURN_PC    the caller's program counter, to resume it at
+#   STORE_VAR    the variable to store the result in, or DISCARD_RESULT
+#   NUM_ARGS     the number of arguments the routine was called with
+#   BASE         the index of the routine's first local variable in
+#                the data stack; its own data stack follows its locals
+#   NUM_LOCALS   the number of local variables of the routine
+#   ROUTINE_ADDR the address of the routine's header
+FRAME_RETURN_PC = 0
+FRAME_STORE_VAR = 1
+FRAME_NUM_ARGS = 2
+FRAME_BASE = 3
+FRAME_NUM_LOCALS = 4
+FRAME_ROUTINE_ADDR = 5
+FRAME_SIZE = 6
+
+DISCARD_RESULT = -1
 
 
 class ZStackManager(object):
+  """The data stack and call stack of a running story.
+
+  The local variables of all routines on the call stack, and all the
+  values on the data stack, are kept in a single array of 16-bit
+  words.  Each routine's locals are followed by the values it pushed,
+  so calling a routine appends to the array, and returning from it
+  truncates the array back to where the routine's locals began.  The
+  call stack is a second array of integers holding one frame record
+  (see FRAME_SIZE) per routine."""
 
   def __init__(self, zmem):
 
     self._memory = zmem
-    self._stackbottom = ZStackBottom()
-    self._call_stack = [self._stackbottom]
+    self._stack = array('H')
+    self._frames = array('l')
+    # The locals of the current routine, cached out of its frame.
+    self._frame_base = 0
+    self._num_locals = 0
+
+    # Parsed routine headers, keyed by the address of the routine, as
+    # (defaults, start_addr): the initial values of its locals, and the
+    # address of its first instruction.  Only routines that start in
+    # static or high memory are cached, as those can never be modified
+    # by the story.
+    self._routine_cache = {}
+    self._cache_start = zmem.static_start
 
 
   def get_local_variable(self, varnum):
@@ -103,15 +89,9 @@ class ZStackManager(object):
     routine.  VARNUM must be a value between 0 and 15, and must
     exist."""
 
-    if self._call_stack[-1] == self._stackbottom:
-      raise ZStackNoRoutine
-
-    if not 0 <= varnum <= 15:
-      raise ZStackNoSuchVariable
-
-    current_routine = self._call_stack[-1]
-
-    return current_routine.local_vars[varnum]
+    if not 0 <= varnum < self._num_locals:
+      self._bad_local(varnum)
+    return self._stack[self._frame_base + varnum]
 
 
   def set_local_variable(self, varnum, value):
@@ -119,45 +99,112 @@ class ZStackManager(object):
     currently-running routine.  VARNUM must be a value between 0 and
     15, and must exist."""
 
-    if self._call_stack[1] == self._stackbottom:
-      raise ZStackNoRoutine
+    if not 0 <= varnum < self._num_locals:
+      self._bad_local(varnum)
+    self._stack[self._frame_base + varnum] = value
 
-    if not 0 <= varnum <= 15:
-      raise ZStackNoSuchVariable
 
-    current_routine = self._call_stack[-1]
-
-    current_routine.local_vars[varnum] = value
+  def _bad_local(self, varnum):
+    if not self._frames:
+      raise ZStackNoRoutine
+    log("routine has %d local vars, not %d"
+        % (self._num_locals, varnum + 1))
+    raise ZStackNoSuchVariable
 
 
   def push_stack(self, value):
     "Push VALUE onto the top of the current routine's data stack."
 
-    current_routine = self._call_stack[-1]
-    current_routine.stack.append(value)
+    self._stack.append(value)
 
 
   def pop_stack(self):
     "Remove and return value from the top of the data stack."
 
-    current_routine = self._call_stack[-1]
-    return current_routine.stack.pop()
+    if len(self._stack) <= self._frame_base + self._num_locals:
+      raise ZStackPopError
+    return self._stack.pop()
 
 
   def get_stack_frame_index(self):
     "Return current stack frame number.  For use by 'catch' opcode."
 
-    return len(self._call_stack) - 1
+    return len(self._frames) // FRAME_SIZE
+
+
+  def get_routine_addresses(self):
+    """Return a tuple of the header addresses of the routines on the
+    call stack, outermost first."""
+
+    return tuple(self._frames[FRAME_ROUTINE_ADDR::FRAME_SIZE])
+
+
+  def get_frames(self):
+    """Return a list of the routines on the call stack, outermost
+    first, as tuples of (return_pc, store_var, num_args, local_vars,
+    stack_values), with store_var None if the result is discarded.
+    The values on the data stack outside of any routine come first,
+    as a frame with a return_pc and num_args of 0 and no locals.  This
+    is the layout of a Quetzal Stks chunk."""
+
+    frames = array('l', [0, DISCARD_RESULT, 0, 0, 0, 0])
+    frames.extend(self._frames)
+    result = []
+    for i in range(0, len(frames), FRAME_SIZE):
+      (return_pc, store_var, num_args, base,
+       num_locals) = frames[i:i + FRAME_ROUTINE_ADDR]
+      if i + FRAME_SIZE < len(frames):
+        end = frames[i + FRAME_SIZE + FRAME_BASE]
+      else:
+        end = len(self._stack)
+      if store_var == DISCARD_RESULT:
+        store_var = None
+      result.append((return_pc, store_var, num_args,
+                     self._stack[base:base + num_locals].tolist(),
+                     self._stack[base + num_locals:end].tolist()))
+    return result
+
+
+  def snapshot(self):
+    """Return a copy of the data stack and call stack, for restore()."""
+
+    return (self._stack[:], self._frames[:])
+
+
+  def restore(self, snapshot):
+    """Put back the data stack and call stack from a SNAPSHOT returned
+    by snapshot()."""
+
+    stack, frames = snapshot
+    self._stack = stack[:]
+    self._frames = frames[:]
+    if frames:
+      top = len(frames) - FRAME_SIZE
+      self._frame_base = frames[top + FRAME_BASE]
+      self._num_locals = frames[top + FRAME_NUM_LOCALS]
+    else:
+      self._frame_base = 0
+      self._num_locals = 0
 
 
   # Used by quetzal save-file parser to reconstruct stack-frames.
-  def push_routine(self, routine):
-    """Blindly push a ZRoutine object to the call stack.
+  def push_frame(self, return_pc, store_var, num_args, local_vars,
+                 stack_values, routine_addr=0):
+    """Blindly push a routine to the call stack, with the given list
+    of LOCAL_VARS and its data stack holding STACK_VALUES.
     WARNING: do not use this unless you know what you're doing; you
-    probably want the more full-featured start_routine() belowe
+    probably want the more full-featured start_routine() below
     instead."""
 
-    self._call_stack.append(routine)
+    if store_var is None:
+      store_var = DISCARD_RESULT
+    base = len(self._stack)
+    self._frames.extend((return_pc, store_var, num_args, base,
+                         len(local_vars), routine_addr))
+    self._stack.extend(local_vars)
+    self._stack.extend(stack_values)
+    self._frame_base = base
+    self._num_locals = len(local_vars)
 
 
   # ZPU should call this whenever it decides to call a new routine.
@@ -166,15 +213,63 @@ class ZStackManager(object):
     """Save the state of the currenly running routine (by examining
     the current value of the PROGRAM_COUNTER), and prepare for
     execution of a new routine at ROUTINE_ADDR with list of initial
-    arguments ARGS."""
+    arguments ARGS.  The routine's result will be stored in variable
+    RETURN_ADDR, or discarded if it is None.  Return the address of
+    the routine's first instruction."""
 
-    new_routine = ZRoutine(routine_addr, return_addr,
-                           self._memory, args)
-    current_routine = self._call_stack[-1]
-    current_routine.program_counter = program_counter
-    self._call_stack.append(new_routine)
+    header = self._routine_cache.get(routine_addr)
+    if header is None:
+      header = self._parse_routine_header(routine_addr)
+      if routine_addr >= self._cache_start:
+        self._routine_cache[routine_addr] = header
+    defaults, start_addr = header
 
-    return new_routine.start_addr
+    # Place call arguments into local vars, if available
+    stack = self._stack
+    base = len(stack)
+    num_locals = len(defaults)
+    if args:
+      num_args = min(len(args), num_locals)
+      stack.extend(args[:num_args])
+      stack.extend(defaults[num_args:])
+    else:
+      stack.extend(defaults)
+
+    if return_addr is None:
+      return_addr = DISCARD_RESULT
+    self._frames.extend((program_counter, return_addr, len(args), base,
+                         num_locals, routine_addr))
+    self._frame_base = base
+    self._num_locals = num_locals
+
+    return start_addr
+
+
+  def _parse_routine_header(self, routine_addr):
+    """Return the header of the routine at ROUTINE_ADDR, as a tuple of
+    an array of the initial values of its locals, and the address of
+    its first instruction."""
+
+    zmem = self._memory
+    num_locals = zmem[routine_addr]
+    if not (0 <= num_locals <= 15):
+      log("num local vars is %d" % num_locals)
+      raise ZStackError
+    start_addr = routine_addr + 1
+
+    # Only machines v1 through v4 give the local vars initial values
+    # in the routine's header; in v5 machines, all local variables are
+    # preinitialized to zero.
+    defaults = array('H')
+    if 1 <= zmem.version <= 4:
+      for i in range(num_locals):
+        defaults.append(zmem.read_word(start_addr))
+        start_addr += 2
+    elif zmem.version == 5:
+      defaults.extend([0] * num_locals)
+    else:
+      raise ZStackUnsupportedVersion
+    return defaults, start_addr
 
 
   # ZPU should call this whenever it decides to return from current
@@ -185,19 +280,27 @@ class ZStackManager(object):
     Return the previous routine's program counter address, so that
     execution can resume where from it left off."""
 
-    exiting_routine = self._call_stack.pop()
-    current_routine = self._call_stack[-1]
+    frames = self._frames
+    if not frames:
+      raise ZStackNoRoutine
+    top = len(frames) - FRAME_SIZE
+    (program_counter, store_var, num_args,
+     base) = frames[top:top + FRAME_NUM_LOCALS]
+    del frames[top:]
+    del self._stack[base:]
+    if frames:
+      self._frame_base = frames[top - FRAME_SIZE + FRAME_BASE]
+      self._num_locals = frames[top - FRAME_SIZE + FRAME_NUM_LOCALS]
+    else:
+      self._frame_base = 0
+      self._num_locals = 0
 
     # Depending on many things, return stuff.
-    if exiting_routine.return_addr != None:
-      if exiting_routine.return_addr == 0: # Push to stack
-        self.push_stack(return_value)
-      elif 0 < exiting_routine.return_addr < 10: # Store in local var
-        self.set_local_variable(exiting_routine.return_addr,
-                                return_value)
-      else: # Store in global var
-        self._memory.write_global(exiting_routine.return_addr,
-                                  return_value)
-
-    return current_routine.program_counter
-
+    if store_var == 0: # Push to stack
+      self.push_stack(return_value)
+    elif 0 < store_var < 0x10: # Store in local var
+      self.set_local_variable(store_var - 1, return_value)
+    elif store_var > 0: # Store in global var
+      self._memory.write_global(store_var, return_value)
+
+    return program_counter
@@ -5,6 +5,22 @@
 # root directory of this distribution.
 #
 
+# Kinds of input a story can ask for.
+INPUT_LINE = 'line'
+INPUT_CHAR = 'char'
+
+class ZInputPending(Exception):
+  """Raised by an input stream which has no input ready yet, instead
+  of blocking.  The CPU parks the reading instruction and stops; the
+  next call to its run() retries the read.
+
+  kind is INPUT_LINE or INPUT_CHAR, or None if unknown."""
+
+  def __init__(self, kind=None):
+    Exception.__init__(self, kind)
+    self.kind = kind
+
+
 class ZOutputStream(object):
   """Abstract class representing an output stream for a z-machine."""
 
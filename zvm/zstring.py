@@ -5,8 +5,11 @@
 # root directory of this distribution.
 #
 
+import functools
 import itertools
 
+from .zmemory import ZMemoryOutOfBounds
+
 
 class ZStringEndOfString(Exception):
     """No more data left in string."""
@@ -19,10 +22,23 @@ class ZStringIllegalAbbrevInString(Exception):
 class ZStringTranslator(object):
     def __init__(self, zmem):
         self._mem = zmem
+        self._raw = zmem.raw
+        self._static_raw = zmem.static_raw
+        self._static_start = zmem.static_start
+
+    def _read_word(self, addr):
+        if addr >= self._static_start:
+            return (self._static_raw[addr] << 8) + self._static_raw[addr + 1]
+        if addr + 1 < self._static_start:
+            return (self._raw[addr] << 8) + self._raw[addr + 1]
+        # The word straddles the start of static memory.
+        return (self._raw[addr] << 8) + self._static_raw[addr + 1]
 
     def get(self, addr):
-        from .bitfield import BitField
-        pos = (addr, BitField(self._mem.read_word(addr)), 0)
+        # Only the start of the string is range checked; a string
+        # running off the end of memory raises IndexError.
+        self._mem.check_range(addr, 2)
+        pos = (addr, self._read_word(addr), 0)
 
         s = []
         try:
@@ -31,17 +47,17 @@ class ZStringTranslator(object):
                 pos = self._next_pos(pos)
         except ZStringEndOfString:
             return s
+        except IndexError:
+            raise ZMemoryOutOfBounds
 
     def _read_char(self, pos):
-        offset = (2 - pos[2]) * 5
-        return pos[1][offset:offset+5]
+        # Each word holds three 5-bit Z-characters, first one highest.
+        return (pos[1] >> ((2 - pos[2]) * 5)) & 0x1F
 
     def _is_final(self, pos):
-        return pos[1][15] == 1
+        return pos[1] & 0x8000
 
     def _next_pos(self, pos):
-        from .bitfield import BitField
-
         offset = pos[2] + 1
         # Overflowing from current block?
         if offset == 3:
@@ -51,13 +67,33 @@ class ZStringTranslator(object):
                 raise ZStringEndOfString
             # Get and return the next block.
             return (pos[0] + 2,
-                    BitField(self._mem.read_word(pos[0] + 2)),
+                    self._read_word(pos[0] + 2),
                     0)
 
         # Just increment the intra-block counter.
         return (pos[0], pos[1], offset)
 
 
+# The states of the ZCharTranslator decoder: expecting an ordinary
+# Z-character, the number of an abbreviation, or the top or bottom
+# half of a 10-bit ZSCII code.
+_STATE_CHAR = 0
+_STATE_ABBREV = 1
+_STATE_ZSCII_HIGH = 2
+_STATE_ZSCII_LOW = 3
+
+# Markers in the Z-character tables for characters which don't output
+# a ZSCII code directly.
+_ZCHAR_SPECIAL = -1
+_ZCHAR_ESCAPE = -2
+
+# The kinds of special Z-characters.
+_SPECIAL_NEWLINE = 0
+_SPECIAL_SHIFT = 1
+_SPECIAL_SHIFT_LOCK = 2
+_SPECIAL_ABBREV = 3
+
+
 class ZCharTranslator(object):
 
     # The default alphabet tables for ZChar translation.
@@ -80,9 +116,12 @@ class ZCharTranslator(object):
         else:
             self._alphabet = self.ALPHA
 
-        # Initialize the special state handlers
+        # Initialize the special character codes
         self._load_specials()
 
+        # Build the Z-character decoding tables
+        self._load_zchar_tables()
+
         # Initialize the abbreviations (if supported)
         self._load_abbrev_tables()
 
@@ -99,9 +138,11 @@ class ZCharTranslator(object):
         return [alphabet[0:26], alphabet[26:52], alphabet[52:78]]
 
     def _load_abbrev_tables(self):
-        self._abbrevs = {}
+        # The pre-decoded ZSCII of each abbreviation, indexed by
+        # (32 * subtable) + abbreviation number.
+        self._abbrevs = []
 
-        # If the ZM doesn't do abbrevs, just return an empty dict.
+        # If the ZM doesn't do abbrevs, just return an empty list.
         if self._mem.version == 1:
             return
 
@@ -114,7 +155,7 @@ class ZCharTranslator(object):
                 zaddr = self._mem.read_word(zoff)
                 zstr = xlator.get(self._mem.word_address(zaddr))
                 zchr = self.get(zstr, allow_abbreviations=False)
-                self._abbrevs[(num, i)] = zchr
+                self._abbrevs.append(zchr)
 
         abbrev_base = self._mem.read_word(0x18)
         _load_subtable(0, abbrev_base)
@@ -125,119 +166,113 @@ class ZCharTranslator(object):
             _load_subtable(2, abbrev_base)
 
     def _load_specials(self):
-        """Load the special character code handlers for the current
-        machine version.
+        """Load the special character codes for the current machine
+        version, as a dictionary mapping Z-characters to (SPECIAL_*,
+        argument) tuples.
         """
-        # The following three functions define the three possible
-        # special character code handlers.
-        def newline(state):
-            """Append ZSCII 13 (newline) to the output."""
-            state['zscii'].append(13)
-
-        def shift_alphabet(state, direction, lock):
-            """Shift the current alphaber up or down. If lock is
-            False, the alphabet will revert to the previous alphabet
-            after outputting 1 character. Else, the alphabet will
-            remain unchanged until the next shift.
-            """
-            state['curr_alpha'] = (state['curr_alpha'] + direction) % 3
-            if lock:
-                state['prev_alpha'] = state['curr_alpha']
-
-        def abbreviation(state, abbrev):
-            """Insert the given abbreviation from the given table into
-            the output stream.
-
-            This character was an abbreviation table number. The next
-            character will be the offset within that table of the
-            abbreviation. Set up a state handler to intercept the next
-            character and output the right abbreviation."""
-            def write_abbreviation(state, c, subtable):
-                state['zscii'] += self._abbrevs[(subtable, c)]
-                del state['state_handler']
-
-            # If we're parsing an abbreviation, there should be no
-            # nested abbreviations. So this is just a sanity check for
-            # people feeding us bad stories.
-            if not state['allow_abbreviations']:
-                raise ZStringIllegalAbbrevInString
-
-            state['state_handler'] = lambda s,c: write_abbreviation(s, c,
-                                                                    abbrev)
-
-        # Register the specials handlers depending on machine version.
+        # The three possible special characters are: a newline; a
+        # shift of the current alphabet up or down (by the argument)
+        # for the next character only, or locked until the next shift;
+        # and an abbreviation from the subtable given by the argument,
+        # whose number is the next character.
         if self._mem.version == 1:
             self._specials = {
-                1: lambda s: newline(s),
-                2: lambda s: shift_alphabet(s, +1, False),
-                3: lambda s: shift_alphabet(s, -1, False),
-                4: lambda s: shift_alphabet(s, +1, True),
-                5: lambda s: shift_alphabet(s, -1, True),
+                1: (_SPECIAL_NEWLINE, None),
+                2: (_SPECIAL_SHIFT, +1),
+                3: (_SPECIAL_SHIFT, -1),
+                4: (_SPECIAL_SHIFT_LOCK, +1),
+                5: (_SPECIAL_SHIFT_LOCK, -1),
                 }
         elif self._mem.version == 2:
             self._specials = {
-                1: lambda s: abbreviation(s, 0),
-                2: lambda s: shift_alphabet(s, +1, False),
-                3: lambda s: shift_alphabet(s, -1, False),
-                4: lambda s: shift_alphabet(s, +1, True),
-                5: lambda s: shift_alphabet(s, -1, True),
+                1: (_SPECIAL_ABBREV, 0),
+                2: (_SPECIAL_SHIFT, +1),
+                3: (_SPECIAL_SHIFT, -1),
+                4: (_SPECIAL_SHIFT_LOCK, +1),
+                5: (_SPECIAL_SHIFT_LOCK, -1),
                 }
         else: # ZM v3-5
             self._specials = {
-                1: lambda s: abbreviation(s, 0),
-                2: lambda s: abbreviation(s, 1),
-                3: lambda s: abbreviation(s, 2),
-                4: lambda s: shift_alphabet(s, +1, False),
-                5: lambda s: shift_alphabet(s, -1, False),
+                1: (_SPECIAL_ABBREV, 0),
+                2: (_SPECIAL_ABBREV, 1),
+                3: (_SPECIAL_ABBREV, 2),
+                4: (_SPECIAL_SHIFT, +1),
+                5: (_SPECIAL_SHIFT, -1),
                 }
 
-    def _special_zscii(self, state, char):
-        if 'zscii_char' not in list(state.keys()):
-            state['zscii_char'] = char
-        else:
-            zchar = (state['zscii_char'] << 5) + char
-            state['zscii'].append(zchar)
-            del state['zscii_char']
-            del state['state_handler']
+    def _load_zchar_tables(self):
+        """Build, for each of the three alphabets, a list mapping all
+        32 Z-characters to the ZSCII code they output, or to one of
+        the negative _ZCHAR_* markers."""
+        self._zchar_tables = []
+        for alpha in range(3):
+            table = []
+            for c in range(32):
+                if c in self._specials:
+                    table.append(_ZCHAR_SPECIAL)
+                elif c == 0:
+                    # A space.
+                    table.append(32)
+                elif alpha == 2 and c == 6:
+                    # The strange A2/6 character, introducing a 10-bit
+                    # ZSCII code in the next two characters.
+                    table.append(_ZCHAR_ESCAPE)
+                elif alpha == 2:
+                    # The symbol alphabet table only has 25 chars
+                    # because of the A2/6 special char, so we need to
+                    # adjust differently.
+                    table.append(self._alphabet[alpha][c-7])
+                else:
+                    table.append(self._alphabet[alpha][c-6])
+            self._zchar_tables.append(table)
 
     def get(self, zstr, allow_abbreviations=True):
-        state = {
-            'curr_alpha': 0,
-            'prev_alpha': 0,
-            'zscii': [],
-            'allow_abbreviations': allow_abbreviations,
-            }
+        zscii = []
+        tables = self._zchar_tables
+        curr_alpha = prev_alpha = 0
+        state = _STATE_CHAR
 
         for c in zstr:
-            if 'state_handler' in list(state.keys()):
-                # If a special handler has registered itself, then hand
-                # processing over to it.
-                state['state_handler'](state, c)
-            elif c in list(self._specials.keys()):
-                # Hand off per-ZM version special char handling.
-                self._specials[c](state)
-            elif state['curr_alpha'] == 2 and c == 6:
-                # Handle the strange A2/6 character
-                state['state_handler'] = self._special_zscii
-            else:
-                # Do the usual Thing: append a zscii code to the
-                # decoded sequence and revert to the "previous"
-                # alphabet (or not, if it hasn't recently changed or
-                # was locked)
-                if c == 0:
-                    # Append a space.
-                    z = 32
-                elif state['curr_alpha'] == 2:
-                    # The symbol alphabet table only has 25 chars
-                    # because of the A2/6 special char, so we need to
-                    # adjust differently.
-                    z = self._alphabet[state['curr_alpha']][c-7]
+            if state == _STATE_CHAR:
+                z = tables[curr_alpha][c]
+                if z >= 0:
+                    # Do the usual Thing: append a zscii code to the
+                    # decoded sequence and revert to the "previous"
+                    # alphabet (or not, if it hasn't recently changed
+                    # or was locked)
+                    zscii.append(z)
+                    curr_alpha = prev_alpha
+                elif z == _ZCHAR_ESCAPE:
+                    state = _STATE_ZSCII_HIGH
                 else:
-                    z = self._alphabet[state['curr_alpha']][c-6]
-                state['zscii'].append(z)
-                state['curr_alpha'] = state['prev_alpha']
+                    # Hand off per-ZM version special char handling.
+                    special, arg = self._specials[c]
+                    if special == _SPECIAL_SHIFT:
+                        curr_alpha = (curr_alpha + arg) % 3
+                    elif special == _SPECIAL_ABBREV:
+                        # If we're parsing an abbreviation, there
+                        # should be no nested abbreviations. So this is
+                        # just a sanity check for people feeding us bad
+                        # stories.
+                        if not allow_abbreviations:
+                            raise ZStringIllegalAbbrevInString
+                        abbrev_base = 32 * arg
+                        state = _STATE_ABBREV
+                    elif special == _SPECIAL_SHIFT_LOCK:
+                        curr_alpha = prev_alpha = (curr_alpha + arg) % 3
+                    else:
+                        zscii.append(13)
+            elif state == _STATE_ABBREV:
+                zscii.extend(self._abbrevs[abbrev_base + c])
+                state = _STATE_CHAR
+            elif state == _STATE_ZSCII_HIGH:
+                zscii_high = c
+                state = _STATE_ZSCII_LOW
+            else:
+                zscii.append((zscii_high << 5) + c)
+                state = _STATE_CHAR
 
-        return state['zscii']
+        return zscii
 
 
 class ZsciiTranslator(object):
@@ -396,13 +431,52 @@ class ZsciiTranslator(object):
 
 
 class ZStringFactory(object):
-    def __init__(self, zmem):
+    # Default number of decoded strings kept by each factory.
+    DEFAULT_CACHE_SIZE = 1024
+
+    def __init__(self, zmem, cache_size=DEFAULT_CACHE_SIZE):
+        """Build a string factory for the given memory.
+
+        Strings in static and high memory can never change, so up to
+        CACHE_SIZE of them are kept decoded, least recently used
+        first out.  A CACHE_SIZE of None keeps every string, and 0
+        disables the cache.  Strings in dynamic memory are always
+        decoded afresh."""
         self._mem = zmem
         self.zstr = ZStringTranslator(zmem)
         self.zchr = ZCharTranslator(zmem)
         self.zscii = ZsciiTranslator(zmem)
 
-    def get(self, addr):
+        # An optional ZStringIndex of pre-decoded strings.
+        self._index = None
+
+        self._cache_start = zmem.static_start
+        if cache_size == 0:
+            self._get_cached = self._decode
+        else:
+            self._get_cached = functools.lru_cache(cache_size)(self._decode)
+
+    def _decode(self, addr):
         zstr = self.zstr.get(addr)
         zchr = self.zchr.get(zstr)
         return self.zscii.get(zchr)
+
+    def set_index(self, index):
+        """Serve the strings of the given ZStringIndex (or of none,
+        if INDEX is None) without decoding them."""
+        self._index = index
+
+    def get(self, addr):
+        index = self._index
+        if index is not None:
+            string = index.get(addr)
+            if string is not None:
+                return string
+        if addr >= self._cache_start:
+            return self._get_cached(addr)
+        return self._decode(addr)
+
+    def cache_info(self):
+        """Return the hit/miss statistics of the string cache, as a
+        functools.lru_cache named tuple, or None if it is disabled."""
+        return getattr(self._get_cached, 'cache_info', lambda: None)()
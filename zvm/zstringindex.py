@@ -0,0 +1,263 @@
+#
+# A load-time index of the decoded strings of a story.
+#
+# Walks the code of a story from its entry point, following direct
+# calls, branches and jumps, and decodes every string that the code
+# prints directly (inline 'print'/'print_ret' text and constant
+# 'print_paddr' operands), along with the object short names and the
+# abbreviations. A ZStringFactory which is given the index then serves
+# those strings without decoding them again.
+#
+# For the license of this file, please consult the LICENSE file in the
+# root directory of this distribution.
+#
+
+import sys
+import threading
+
+from .zlogging import log
+from .zmemory import ZMemoryOutOfBounds
+from .zopdecoder import ZOpDecoder, OPERAND_CONSTANT
+from .zobjectparser import ZObjectParser, ZObjectIllegalObjectNumber
+from .zstring import ZStringEndOfString, ZStringIllegalAbbrevInString
+from .ztables import (OPCODE_0OP, OPCODE_1OP, OPCODE_2OP, OPCODE_VAR,
+                      CALL_OPCODES)
+
+# Ways of building the index: in the constructor of the ZMachine, or in
+# a background thread while the story starts running.
+PRECOMPILE_EAGER = 'eager'
+PRECOMPILE_BACKGROUND = 'background'
+
+# Opcodes after which execution never falls through to the next
+# instruction.
+TERMINATING_OPCODES = frozenset([
+  (OPCODE_0OP, 0),  # rtrue
+  (OPCODE_0OP, 1),  # rfalse
+  (OPCODE_0OP, 3),  # print_ret
+  (OPCODE_0OP, 7),  # restart
+  (OPCODE_0OP, 8),  # ret_popped
+  (OPCODE_0OP, 10), # quit
+  (OPCODE_1OP, 11), # ret
+  (OPCODE_1OP, 12), # jump
+  (OPCODE_2OP, 28), # throw
+  ])
+
+# The errors raised by decoding something which isn't a valid string.
+STRING_ERRORS = (ZMemoryOutOfBounds, IndexError, ZStringEndOfString,
+                 ZStringIllegalAbbrevInString)
+
+PRINT_PADDR_OPCODE = (OPCODE_1OP, 13)
+JUMP_OPCODE = (OPCODE_1OP, 12)
+
+
+class ZStringIndex(object):
+  """An index of decoded strings, keyed by the address of their
+  encoded text.
+
+  Strings in static and high memory can never change, and are
+  returned as is. Strings in dynamic memory (object short names, and
+  abbreviations in most stories) are stored with their encoded bytes,
+  and only returned while memory still holds those bytes."""
+
+  def __init__(self, zmem, stringfactory):
+    self._memory = zmem
+    self._stringfactory = stringfactory
+    self._static_start = zmem.static_start
+    self._objects = ZObjectParser(zmem, stringfactory)
+    self._static = {}
+    self._dynamic = {}
+
+  def __len__(self):
+    return len(self._static) + len(self._dynamic)
+
+  def get(self, addr):
+    """Return the decoded string at address ADDR, or None if it isn't
+    in the index."""
+    if addr >= self._static_start:
+      return self._static.get(addr)
+    entry = self._dynamic.get(addr)
+    if entry is None:
+      return None
+    encoded, string = entry
+    if self._memory.raw[addr:addr + len(encoded)] != encoded:
+      return None
+    return string
+
+  def memory_usage(self):
+    """Return the approximate number of bytes used by the index."""
+    total = sys.getsizeof(self._static) + sys.getsizeof(self._dynamic)
+    for string in self._static.values():
+      total += sys.getsizeof(string)
+    for encoded, string in self._dynamic.values():
+      total += (sys.getsizeof((encoded, string)) + sys.getsizeof(encoded)
+                + sys.getsizeof(string))
+    return total
+
+  def build(self):
+    """Decode all the strings found in the story, then hand the index
+    to the string factory."""
+    # The index decodes with its own factory, so that it can run in a
+    # thread of its own.
+    factory = self._stringfactory.__class__(self._memory, cache_size=0)
+    for addr in self._find_strings():
+      self._add(factory, addr)
+    log("String index built: %d strings, %d bytes"
+        % (len(self), self.memory_usage()))
+    self._stringfactory.set_index(self)
+
+  def build_in_background(self):
+    """Start building the index in a daemon thread, and return the
+    thread. The string factory decodes strings as usual until the
+    index is complete."""
+    thread = threading.Thread(target=self.build, name="ZStringIndex")
+    thread.daemon = True
+    thread.start()
+    return thread
+
+  def _add(self, factory, addr):
+    try:
+      string = factory.get(addr)
+    except STRING_ERRORS:
+      # Whatever was found there, it wasn't a valid string.
+      return
+    if addr >= self._static_start:
+      self._static[addr] = string
+      return
+    # Record the encoded text, which ends with the first word having
+    # its top bit set.
+    raw = self._memory.raw
+    end = addr
+    while not raw[end] & 0x80:
+      end += 2
+    encoded = bytes(raw[addr:end + 2])
+    # Skip strings which changed while they were being decoded.
+    if factory.get(addr) == string:
+      self._dynamic[addr] = (encoded, string)
+
+  def _find_strings(self):
+    """Return the set of addresses of the strings to index."""
+    addresses = set(self._find_code_strings())
+    addresses.update(self._find_shortname_strings())
+    addresses.update(self._find_abbreviation_strings())
+    return addresses
+
+  def _find_code_strings(self):
+    """Walk the code reachable from the start of the story, and yield
+    the addresses of the strings it prints."""
+    mem = self._memory
+    version = mem.version
+    decoder = ZOpDecoder(mem, None)
+    pending = [mem.read_word(0x06)]
+    pending.extend(self._find_property_routines())
+    seen = set()
+
+    while pending:
+      pc = pending.pop()
+      while pc not in seen:
+        seen.add(pc)
+        try:
+          (opcode_class, opcode_number, operands, store, branch,
+           zstring, next_pc) = decoder._decode_instruction(pc)
+        except (ZMemoryOutOfBounds, IndexError):
+          # Not actually code.
+          break
+        opcode = (opcode_class, opcode_number)
+
+        if zstring is not None:
+          yield zstring
+        constants = [value for kind, value in operands[:1]
+                     if kind == OPERAND_CONSTANT]
+        if constants and opcode == PRINT_PADDR_OPCODE:
+          addr = self._unpack(constants[0])
+          if addr is not None:
+            yield addr
+        if constants and CALL_OPCODES.get(opcode, 6) <= version:
+          routine = self._get_routine_start(constants[0])
+          if routine is not None:
+            pending.append(routine)
+        if branch is not None and branch[1] not in (0, 1):
+          pending.append(next_pc + branch[1] - 2)
+        if opcode == JUMP_OPCODE and constants:
+          offset = constants[0]
+          if offset & 0x8000:
+            offset -= 0x10000
+          pending.append(next_pc + offset - 2)
+        if opcode in TERMINATING_OPCODES:
+          break
+        pc = next_pc
+
+  def _unpack(self, packed_address):
+    """Return the byte address of PACKED_ADDRESS, or None if it is
+    out of bounds."""
+    try:
+      addr = self._memory.packed_address(packed_address)
+    except ZMemoryOutOfBounds:
+      return None
+    if addr >= self._memory.size:
+      return None
+    return addr
+
+  def _get_routine_start(self, packed_address):
+    """Return the address of the first instruction of the routine at
+    the given packed address, or None if there is no routine there."""
+    if packed_address == 0:
+      return None
+    addr = self._unpack(packed_address)
+    if addr is None:
+      return None
+    num_locals = self._memory[addr]
+    if num_locals > 15:
+      return None
+    if self._memory.version < 5:
+      # Skip the initial values of the local variables.
+      return addr + 1 + (2 * num_locals)
+    return addr + 1
+
+  def _find_property_routines(self):
+    """Return the starts of the routines whose packed addresses are
+    stored in word-sized object properties, which is how stories
+    attach most of their code to objects."""
+    routines = []
+    for objectnum in self._get_object_numbers():
+      for addr, size in self._objects.get_all_properties(objectnum).values():
+        for i in range(0, size - 1, 2):
+          packed_address = self._memory.read_word(addr + i)
+          routine = self._get_routine_start(packed_address)
+          if routine is not None and routine >= self._memory.high_start:
+            routines.append(routine)
+    return routines
+
+  def _get_object_numbers(self):
+    """Return the range of valid object numbers."""
+    # The object table is immediately followed by the property
+    # tables, so the first property table marks its end.
+    objects = self._objects
+    objectnum = 1
+    end = None
+    try:
+      while end is None or objects._get_object_addr(objectnum) < end:
+        addr = objects._get_proptable_addr(objectnum)
+        if end is None or addr < end:
+          end = addr
+        objectnum += 1
+    except (ZMemoryOutOfBounds, IndexError, ZObjectIllegalObjectNumber):
+      # Ran off the end of memory or the object numbers.
+      pass
+    return range(1, objectnum)
+
+  def _find_shortname_strings(self):
+    """Yield the addresses of the short names of all the objects."""
+    for objectnum in self._get_object_numbers():
+      addr = self._objects._get_proptable_addr(objectnum)
+      if self._memory.raw[addr]:
+        yield addr + 1
+
+  def _find_abbreviation_strings(self):
+    """Yield the addresses of the abbreviations."""
+    mem = self._memory
+    if mem.version == 1:
+      return
+    num_abbrevs = 32 if mem.version == 2 else 96
+    base = mem.read_word(0x18)
+    for i in range(num_abbrevs):
+      yield mem.word_address(mem.read_word(base + (2 * i)))
@@ -0,0 +1,121 @@
+#
+# Precomputed lookup tables for the bit-packed bytes the interpreter
+# decodes over and over: opcode bytes, operand type bytes, branch
+# bytes and property headers.  Every table has one entry for each of
+# the 256 possible byte values, so decoding is a single list index
+# instead of a round of bit twiddling.
+#
+# For the license of this file, please consult the LICENSE file in the
+# root directory of this distribution.
+#
+
+# Constants defining the known instruction types. These types are
+# related to the number of operands the opcode has: for each operand
+# count, there is a separate opcode table, and the actual opcode
+# number is an index into that table.
+OPCODE_0OP = 0
+OPCODE_1OP = 1
+OPCODE_2OP = 2
+OPCODE_VAR = 3
+OPCODE_EXT = 4
+
+# Constants defining the possible operand types.
+LARGE_CONSTANT = 0x0
+SMALL_CONSTANT = 0x1
+VARIABLE = 0x2
+ABSENT = 0x3
+
+# Opcodes whose first operand is the packed address of a routine to
+# call, mapped to the first version in which they exist.
+CALL_OPCODES = {
+  (OPCODE_VAR, 0): 1,  # call / call_vs
+  (OPCODE_1OP, 8): 4,  # call_1s
+  (OPCODE_2OP, 25): 4, # call_2s
+  (OPCODE_VAR, 12): 4, # call_vs2
+  (OPCODE_1OP, 15): 5, # call_1n
+  (OPCODE_2OP, 26): 5, # call_2n
+  (OPCODE_VAR, 25): 5, # call_vn
+  (OPCODE_VAR, 26): 5, # call_vn2
+  }
+
+
+def _opcode_form(byte):
+  """Return the (opcode-class, opcode-number, operand-types) decoding
+  of an opcode byte (section 4.3 of the spec).  operand-types is None
+  for the variable form, whose operand types are given by the types
+  byte(s) following the opcode."""
+  if not byte & 0x80:
+    # Long form: always 2OP, with the types of the two operands in
+    # bits 6 and 5.
+    types = tuple(VARIABLE if byte & bit else SMALL_CONSTANT
+                  for bit in (0x40, 0x20))
+    return (OPCODE_2OP, byte & 0x1F, types)
+  elif not byte & 0x40:
+    # Short form: one operand, or none if its type is absent.
+    operand_type = (byte >> 4) & 0x3
+    if operand_type == ABSENT:
+      return (OPCODE_0OP, byte & 0xF, ())
+    return (OPCODE_1OP, byte & 0xF, (operand_type,))
+  elif byte & 0x20:
+    return (OPCODE_VAR, byte & 0x1F, None)
+  else:
+    return (OPCODE_2OP, byte & 0x1F, None)
+
+
+def _operand_types(byte):
+  """Return the tuple of operand types given by an operand types
+  byte, most significant bits first, stopping at the first absent
+  operand (section 4.4.3 of the spec)."""
+  types = []
+  for shift in (6, 4, 2, 0):
+    operand_type = (byte >> shift) & 0x3
+    if operand_type == ABSENT:
+      break
+    types.append(operand_type)
+  return tuple(types)
+
+
+def _branch_byte(byte):
+  """Return the (branch-if-true, is-short, offset) decoding of the
+  first byte of a branch (section 4.7 of the spec).  For a short
+  branch the offset is complete; otherwise it is the signed high part
+  of a 14-bit offset, to which the next byte must be added."""
+  branch_if_true = bool(byte & 0x80)
+  if byte & 0x40:
+    return (branch_if_true, True, byte & 0x3F)
+  offset = (byte & 0x3F) << 8
+  if byte & 0x20:
+    offset -= 0x4000
+  return (branch_if_true, False, offset)
+
+
+def _property_header_v3(byte):
+  """Return the (property-number, size) decoding of a version 1-3
+  property size byte (section 12.4.1 of the spec)."""
+  return (byte & 0x1F, (byte >> 5) + 1)
+
+
+def _property_header_v4(byte):
+  """Return the (property-number, size) decoding of the first byte of
+  a version 4+ property header (section 12.4.2 of the spec).  The size
+  is None when it is given by a second size byte."""
+  if byte & 0x80:
+    return (byte & 0x3F, None)
+  elif byte & 0x40:
+    return (byte & 0x3F, 2)
+  else:
+    return (byte & 0x3F, 1)
+
+
+def _property_size_v4(byte):
+  """Return the property size given by the second byte of a version
+  4+ property header, where a size of 0 means 64."""
+  return (byte & 0x3F) or 64
+
+
+OPCODE_FORMS = [_opcode_form(b) for b in range(256)]
+OPERAND_TYPES = [_operand_types(b) for b in range(256)]
+BRANCH_BYTES = [_branch_byte(b) for b in range(256)]
+PROPERTY_HEADERS_V3 = [_property_header_v3(b) for b in range(256)]
+PROPERTY_HEADERS_V4 = [_property_header_v4(b) for b in range(256)]
+PROPERTY_SIZES_V4 = [_property_size_v4(b) for b in range(256)]
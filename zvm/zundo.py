@@ -0,0 +1,207 @@
+#
+# An in-memory ring buffer of snapshots of a running story, for the
+# save_undo and restore_undo opcodes.
+#
+# Each snapshot holds the changes to dynamic memory since the snapshot
+# before it, compressed like the CMem chunk of a Quetzal file: the old
+# and new bytes are XORed together, and the resulting runs of zeros
+# are run-length encoded.  Only the pages of memory written since the
+# previous snapshot, as seen by a watch on dynamic memory, are
+# compared, so that taking a snapshot costs in proportion to what the
+# story changed, not to the size of dynamic memory.
+#
+# For the license of this file, please consult the LICENSE file in the
+# root directory of this distribution.
+#
+
+import collections
+import re
+
+from .zmemory import PAGE_SHIFT, PAGE_SIZE
+
+# The number of snapshots a ZUndoBuffer keeps by default.
+DEFAULT_UNDO_DEPTH = 10
+
+_ZERO_RUNS = re.compile(b'\x00+')
+
+
+def _xor(a, b):
+  """Return the bytes of A XORed with the bytes of B, of equal length."""
+  return (int.from_bytes(a, 'big')
+          ^ int.from_bytes(b, 'big')).to_bytes(len(a), 'big')
+
+
+def encode_delta(old, new):
+  """Return the changes from the bytes OLD to the bytes NEW, of equal
+  length, in the run-length encoding of a Quetzal CMem chunk: changed
+  bytes hold OLD XOR NEW, and each run of up to 256 unchanged bytes is
+  a zero followed by the length of the run minus one.  Trailing
+  unchanged bytes are left out."""
+  xored = _xor(old, new)
+  result = bytearray()
+  pos = 0
+  for match in _ZERO_RUNS.finditer(xored):
+    start, end = match.span()
+    result += xored[pos:start]
+    pos = end
+    if end == len(xored):
+      break
+    run = end - start
+    while run > 0:
+      length = min(run, 256)
+      result += bytes((0, length - 1))
+      run -= length
+  else:
+    result += xored[pos:]
+  return bytes(result)
+
+
+def apply_delta(old, delta):
+  """Return the bytes OLD changed by DELTA, as returned by
+  encode_delta()."""
+  xored = bytearray()
+  pos = 0
+  while pos < len(delta):
+    zero = delta.find(b'\x00', pos)
+    if zero == -1:
+      xored += delta[pos:]
+      break
+    xored += delta[pos:zero]
+    xored += bytes(delta[zero + 1] + 1)
+    pos = zero + 2
+  xored += bytes(len(old) - len(xored))
+  return _xor(old, xored)
+
+
+# One snapshot in a ZUndoBuffer.  DELTA is a tuple of (page, encoded
+# changes) pairs, taking the pages from the previous snapshot to this
+# one.  STACK is a snapshot of the ZStackManager.  PROGRAM_COUNTER is
+# the address to resume execution at, and STORE_VAR the variable to
+# store the result of save_undo in.  SIZE is the bytes taken by the
+# encoded changes and the stacks.
+ZUndoLevel = collections.namedtuple(
+  'ZUndoLevel', ['delta', 'stack', 'program_counter', 'store_var', 'size'])
+
+
+class ZUndoBuffer(object):
+  """Keeps up to DEPTH snapshots of the dynamic memory and stacks of a
+  story, for restoring the most recent one.  Once there are more, the
+  oldest snapshot is dropped; so are old snapshots while they take
+  more than MAX_BYTES in all, if not None.
+
+  From the first snapshot on, the buffer keeps a copy of dynamic
+  memory as it was at the latest snapshot, and watches dynamic memory
+  for the pages written since."""
+
+  def __init__(self, zmem, zstack, depth=DEFAULT_UNDO_DEPTH,
+               max_bytes=None):
+    self._memory = zmem
+    self._stackmanager = zstack
+    self._depth = depth
+    self._max_bytes = max_bytes
+    self._levels = collections.deque()
+    # Dynamic memory as of the latest snapshot, taken on the first
+    # save(), along with the watch filling _changed_pages.  Stories
+    # which never save don't pay for watching their writes.
+    self._reference = None
+    self._watch = None
+    # The pages which may differ from the reference.
+    self._changed_pages = set()
+    # The total size of the levels.
+    self._size = 0
+
+  def __len__(self):
+    return len(self._levels)
+
+  def _written(self, address, length):
+    """Note a write of LENGTH bytes at ADDRESS to dynamic memory."""
+    self._changed_pages.update(
+      range(address >> PAGE_SHIFT, ((address + length - 1) >> PAGE_SHIFT) + 1))
+
+  def _page_range(self, page):
+    start = page << PAGE_SHIFT
+    return start, min(start + PAGE_SIZE, len(self._reference))
+
+  def save(self, program_counter, store_var):
+    """Take a snapshot of the story, which will resume at
+    PROGRAM_COUNTER, storing the result of save_undo in STORE_VAR."""
+    raw = self._memory.raw
+    delta = []
+    if self._reference is None:
+      static_start = self._memory.static_start
+      self._reference = bytearray(raw[:static_start])
+      self._watch = self._memory.watch(0, static_start, self._written)
+    else:
+      reference = self._reference
+      for page in sorted(self._changed_pages):
+        start, end = self._page_range(page)
+        if start >= end:
+          continue
+        current = raw[start:end]
+        if current != reference[start:end]:
+          delta.append((page, encode_delta(reference[start:end], current)))
+          reference[start:end] = current
+    self._changed_pages = set()
+
+    stack = self._stackmanager.snapshot()
+    size = (sum(len(changes) for page, changes in delta)
+            + sum(len(values) * values.itemsize for values in stack))
+    self._levels.append(ZUndoLevel(tuple(delta), stack, program_counter,
+                                   store_var, size))
+    self._size += size
+    self._trim()
+
+  def _trim(self):
+    """Drop the oldest levels beyond the depth or size limits."""
+    levels = self._levels
+    while (len(levels) > self._depth
+           or (self._max_bytes is not None and self._size > self._max_bytes
+               and len(levels) > 1)):
+      self._size -= levels.popleft().size
+      if not levels:
+        break
+      # The changes leading up to the oldest level are only needed to
+      # restore the levels before it, so they can go too.
+      oldest = levels[0]
+      delta_size = sum(len(changes) for page, changes in oldest.delta)
+      levels[0] = oldest._replace(delta=(), size=oldest.size - delta_size)
+      self._size -= delta_size
+
+  def restore(self):
+    """Restore the story to the latest snapshot, and forget it.
+    Return the (program_counter, store_var) it was taken with, or None
+    if there are no snapshots."""
+    if not self._levels:
+      return None
+    level = self._levels.pop()
+    self._size -= level.size
+
+    # Memory is written through ZMemory, for its watches to see.
+    zmem = self._memory
+    reference = self._reference
+    raw = zmem.raw
+    for page in sorted(self._changed_pages):
+      start, end = self._page_range(page)
+      if start < end and raw[start:end] != reference[start:end]:
+        zmem[start:end] = reference[start:end]
+    self._stackmanager.restore(level.stack)
+
+    # The reference goes back to the previous snapshot.
+    for page, changes in level.delta:
+      start, end = self._page_range(page)
+      reference[start:end] = apply_delta(reference[start:end], changes)
+    self._changed_pages = set(page for page, changes in level.delta)
+    return level.program_counter, level.store_var
+
+  def memory_usage(self):
+    """Return the bytes taken by the snapshots, including the copy of
+    dynamic memory as of the latest one, which is kept from the first
+    snapshot on."""
+    if self._reference is None:
+      return self._size
+    return self._size + len(self._reference)
+
+  def level_sizes(self):
+    """Return a list of the bytes taken by each snapshot, oldest
+    first."""
+    return [level.size for level in self._levels]